@@ -1,11 +1,19 @@
 # Copyright (C) 2023 IKUS Software. All rights reserved.
 # IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
 # Use is subject to license terms.
-from pkg_resources import DistributionNotFound
-
 try:
-    import pkg_resources
+    # Avoid pkg_resources, it's slow to import.
+    from importlib.metadata import PackageNotFoundError
+    from importlib.metadata import version as _get_version
+except ImportError:  # Python 3.7
+    from pkg_resources import DistributionNotFound as PackageNotFoundError
+    from pkg_resources import get_distribution
+
+    def _get_version(name):
+        return get_distribution(name).version
 
-    __version__ = pkg_resources.get_distribution("minarca_client").version
-except DistributionNotFound:
+
+try:
+    __version__ = _get_version("minarca_client")
+except PackageNotFoundError:
     __version__ = "DEV"
@@ -7,30 +7,44 @@ Created on Jun. 7, 2021
 @author: Patrik Dufresne <patrik@ikus-soft.com>
 '''
 
+import contextlib
 import datetime
+import functools
 import logging
 import os
 import re
 import subprocess
+import tempfile
 import threading
 import time
-from datetime import timedelta
+import weakref
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import psutil
-import requests
 from psutil import NoSuchProcess
-from requests.compat import urljoin
-from requests.exceptions import ConnectionError, HTTPError, InvalidSchema, MissingSchema
 
-from minarca_client.core import compat
+from minarca_client.core import autoexclude, compat, download, engine, history, journal, scan, shard
 from minarca_client.core.compat import IS_WINDOWS, Scheduler, get_minarca_exe, ssh_keygen
-from minarca_client.core.config import Datetime, Patterns, Settings, Status
+from minarca_client.core.config import (
+    _RUNNING_DELAY,
+    Datetime,
+    Patterns,
+    Settings,
+    SettingsStore,
+    Shards,
+    Status,
+    StatusStore,
+    Tier,
+    _file_signature,
+)
 from minarca_client.core.exceptions import (
+    BackupError,
     CaptureException,
     HttpAuthenticationError,
     HttpConnectionError,
     HttpInvalidUrlError,
     HttpServerError,
+    MultipleBackupError,
     NoPatternsError,
     NotConfiguredError,
     NotRunningError,
@@ -40,15 +54,46 @@ from minarca_client.core.exceptions import (
     RepositoryNameExistsError,
     RunningError,
 )
+from minarca_client.core.progress import Progress, format_size
 from minarca_client.locale import _
 
 _REPOSITORY_NAME_PATTERN = "^[a-zA-Z0-9][a-zA-Z0-9\\-\\.]*$"
 
-_RUNNING_DELAY = 5  # 5 seconds
+_NAME_PATTERN = "^[a-zA-Z0-9][a-zA-Z0-9\\-]*$"
+
+_PREEMPT_DELAY = 60  # Interval in seconds to check if a tier of higher priority is due.
+
+# Above this number of patterns, patterns are written into a filelist instead of the command line.
+_MAX_PATTERN_ARGS = 100
+
+# Differences reported by `rdiff-backup compare`.
+# Differences reported by `rdiff-backup compare`. With `--method hash`, the
+# reason is like `metadata the same, data changed`.
+_COMPARE_REPORT = re.compile(r'^(new|deleted|[a-z ,]*changed): (.*)$')
+
+_CONTROL_PERSIST = 60  # Master SSH connection exit after 60 seconds without session.
+
+_CONTROL_TIMEOUT = 60  # Time to wait for SSH master connection to be established.
 
 logger = logging.getLogger(__name__)
 
 
+class _SessionSkipped(Exception):
+    """
+    Raised by a session that doesn't need to run. The message is the reason.
+    """
+
+    pass
+
+
+class _Preempted(Exception):
+    """
+    Raised when the backup of a tier is cancelled to run a tier of higher priority.
+    """
+
+    pass
+
+
 def _sh_quote(args):
     """
     Used for logging only. Escape command line.
@@ -80,17 +125,77 @@ def _escape_path(path):
         return "'" + path + "'"
 
 
+class _SharedSelection:
+    """
+    Selection of a root shared by the sessions of every destinations. The
+    files are scanned once, by the first session requiring them. Caches and
+    build artifacts are detected from the scanned files.
+    """
+
+    def __init__(self, backup, root, patterns, source=None):
+        self.root = root
+        self.patterns = patterns
+        # Patterns of the root before sharding, as watched by the agent.
+        self.source = source
+        self.auto_exclude = backup.get_settings('auto_exclude')
+        self._backup = backup
+        self._entries = None
+        self._excluded = None
+        self._lock = threading.Lock()
+
+    def entries(self):
+        """
+        Return the files selected by the patterns, including the content of
+        the directories automatically excluded.
+        """
+        with self._lock:
+            if self._entries is None:
+                self._entries = scan.scan(self.root, self.patterns)
+            return self._entries
+
+    def exclude(self, entries=None):
+        """
+        Return the patterns with caches and build artifacts detected in the
+        entries excluded and the list of `Detected` directories.
+        """
+        if not self.auto_exclude:
+            return self.patterns, []
+        if entries is None:
+            entries = self.entries()
+        with self._lock:
+            if self._excluded is None or self._excluded[0] is not entries:
+                self._excluded = (entries, self._backup._auto_exclude(self.root, self.patterns, entries))
+            return self._excluded[1]
+
+    def changes(self, previous, entries, detected):
+        """
+        Return the list of paths created, modified or deleted since the
+        previous scan, ignoring the content of the excluded directories.
+        """
+        if not self.auto_exclude:
+            return scan.changes(previous, entries)
+        # Directories no longer excluded or newly excluded are changes too.
+        before = autoexclude.detect(self.root, self.patterns, previous)
+        changed = sorted({d.path for d in before} ^ {d.path for d in detected})
+        return changed + scan.changes(
+            autoexclude.exclude_entries(previous, detected), autoexclude.exclude_entries(entries, detected)
+        )
+
+
 class _UpdateStatus(threading.Thread):
     """
     Update the status while the backup is running.
     """
 
-    def __init__(self, status, action='backup'):
+    def __init__(self, status, action='backup', tier=None):
         assert action in ['backup', 'restore']
         self.status = status
         self.action = action
+        self.tier = tier
         super(_UpdateStatus, self).__init__()
         self._stop_event = threading.Event()
+        self._lock = threading.Lock()
+        self._progress = {}
 
     def __enter__(self):
         try:
@@ -103,8 +208,21 @@ class _UpdateStatus(threading.Thread):
         except Exception:
             logger.warn("failed to set keep awake", exc_info=1)
         logger.info("%s START", self.action)
+        # Clear status of sessions from previous run. A backup only clears the
+        # sessions of its own tier to keep the result of the other tiers.
+        if self.action == 'backup':
+            names = self.status.tier_sessions(self.tier)
+            self.status[self._tier_key('sessions')] = ''
+        else:
+            names = [name for name, unused, unused in self.status.sessions()]
+        for name in names:
+            self.status.pop('lastresult.' + name, None)
+            self.status.pop('details.' + name, None)
+            for key in [k for k in self.status if k.startswith('progress.%s.' % name)]:
+                del self.status[key]
         self._update_status()
         self.start()
+        return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         # Wait for thread to stop.
@@ -113,17 +231,13 @@ class _UpdateStatus(threading.Thread):
             self.join()
         if exc_type is None:
             logger.info("%s SUCCESS", self.action)
-            self.status['lastresult'] = 'SUCCESS'
-            self.status['lastsuccess'] = Datetime()
-            self.status['lastdate'] = self.status['lastsuccess']
-            self.status['details'] = ''
-            self.status.save()
+            self._set_result('SUCCESS')
+        elif exc_type is _Preempted:
+            logger.info("%s INTERRUPTED: %s", self.action, exc_val)
+            self._set_result('INTERRUPT', str(exc_val))
         else:
             logger.exception("%s FAILED", self.action)
-            self.status['lastresult'] = 'FAILURE'
-            self.status['lastdate'] = Datetime()
-            self.status['details'] = str(exc_val)
-            self.status.save()
+            self._set_result('FAILURE', str(exc_val))
         try:
             from wakepy import unset_keepawake
 
@@ -133,6 +247,28 @@ class _UpdateStatus(threading.Thread):
         except Exception:
             logger.warn("failed to unset keep awake", exc_info=1)
 
+    def _tier_key(self, field):
+        return 'tier.%s.%s' % (self.tier, field) if self.tier else 'tier.%s' % field
+
+    def _set_result(self, result, details=''):
+        """
+        Record the result of the execution. The result of a backup is kept
+        for its tier, the overall result being updated once every tiers
+        completed.
+        """
+        with self._lock:
+            self.status['lastdate'] = Datetime()
+            if self.action == 'backup':
+                self.status[self._tier_key('lastresult')] = result
+                self.status[self._tier_key('details')] = details
+                # Each tier is scheduled according to its own last success.
+                if result == 'SUCCESS':
+                    self.status[self._tier_key('lastsuccess') if self.tier else 'lastsuccess'] = self.status['lastdate']
+            else:
+                self.status['lastresult'] = result
+                self.status['details'] = details
+            self.status.save()
+
     def run(self):
         while not self.stopped():
             self._update_status()
@@ -144,13 +280,61 @@ class _UpdateStatus(threading.Thread):
     def stopped(self):
         return self._stop_event.is_set()
 
+    def set_session_status(self, name, result, details='', skipped=False):
+        """
+        Record the result of a single rdiff-backup session (e.g.: one per root
+        and destination). The last success of a backup session is recorded
+        unless `skipped`, the mirror being unchanged.
+        """
+        assert result in Status.LAST_RESULTS
+        with self._lock:
+            self.status['lastresult.' + name] = result
+            self.status['details.' + name] = details
+            if result == 'SUCCESS' and self.action == 'backup' and not skipped:
+                self.status['stats.%s.lastsuccess' % name] = Datetime()
+            progress = self._progress.get(name)
+            if progress:
+                self._save_progress(name, progress)
+                # Keep statistics of successful session to estimate duration of next session.
+                if result == 'SUCCESS' and 'ElapsedTime' in progress.stats:
+                    self.status['stats.%s.elapsed' % name] = progress.stats['ElapsedTime']
+                    if 'SourceFileSize' in progress.stats:
+                        self.status['stats.%s.size' % name] = int(progress.stats['SourceFileSize'])
+                    sent = progress.stats.get('NewFileSize', 0) + progress.stats.get('ChangedSourceSize', 0)
+                    if sent and progress.stats['ElapsedTime'] > 0:
+                        self.status['stats.%s.rate' % name] = int(sent / progress.stats['ElapsedTime'])
+            self.status.save()
+
+    def progress(self, name, root=None):
+        """
+        Create a Progress object to collect progress of the given session.
+        """
+        progress = Progress(root=root, previous_elapsed=self.status.previous_elapsed(name))
+        with self._lock:
+            self._progress[name] = progress
+            if self.action == 'backup':
+                self.status[self._tier_key('sessions')] = ','.join(self.status.tier_sessions(self.tier) + [name])
+        return progress
+
+    def _save_progress(self, name, progress):
+        for key, value in progress.to_dict().items():
+            if value is None:
+                self.status.pop('progress.%s.%s' % (name, key), None)
+            else:
+                self.status['progress.%s.%s' % (name, key)] = value
+
     def _update_status(self):
-        self.status['pid'] = os.getpid()
-        self.status['lastresult'] = 'RUNNING'
-        self.status['lastdate'] = Datetime()
-        self.status['details'] = ''
-        self.status['action'] = self.action
-        self.status.save()
+        with self._lock:
+            for name, progress in self._progress.items():
+                self._save_progress(name, progress)
+            self.status['pid'] = os.getpid()
+            self.status['lastresult'] = 'RUNNING'
+            if self.action == 'backup':
+                self.status[self._tier_key('lastresult')] = 'RUNNING'
+            self.status['lastdate'] = Datetime()
+            self.status['details'] = ''
+            self.status['action'] = self.action
+            self.status.save()
 
 
 class Backup:
@@ -165,17 +349,47 @@ class Backup:
         self.config_file = os.path.join(compat.get_config_home(), "minarca.properties")
         self.patterns_file = os.path.join(compat.get_config_home(), "patterns")
         self.status_file = os.path.join(compat.get_data_home(), 'status.properties')
-        self.scheduler = Scheduler()
-
-    def start(self, action='backup', force=False, patterns=None):
+        self.journal_file = os.path.join(compat.get_data_home(), 'journal.dat')
+        self.shards_file = os.path.join(compat.get_config_home(), 'shards.properties')
+        self.listing_file = os.path.join(compat.get_data_home(), 'estimate.json.gz')
+        self.history_file = os.path.join(compat.get_data_home(), 'history.json.gz')
+        self.status_store = StatusStore(self.status_file)
+        self.settings_store = SettingsStore(self.config_file)
+        self._scheduler = None
+        # Used to cancel rdiff-backup sessions running in this process.
+        self._cancel_event = threading.Event()
+        self._processes = set()
+        self._processes_lock = threading.Lock()
+        # Path to SSH control socket of each destination when master connection is established.
+        self._control_paths = {}
+        # Fork server used by the fork engine.
+        self._fork_server = None
+        # Signature of the patterns file and whether it defines patterns, by filename.
+        self._has_patterns_cache = {}
+
+    @property
+    def scheduler(self):
+        # Created on first use, the scheduler may execute external commands.
+        if self._scheduler is None:
+            self._scheduler = Scheduler()
+        return self._scheduler
+
+    @scheduler.setter
+    def scheduler(self, value):
+        self._scheduler = value
+
+    def start(self, action='backup', force=False, patterns=None, restore_time=None):
         """
         Trigger execution of minarca in detach mode.
         """
-        assert action in ['backup', 'restore']
+        assert action in ['backup', 'restore', 'agent']
         # Fork process
         args = [get_minarca_exe(), action]
         if force:
             args += ['--force']
+        if restore_time:
+            assert action == 'restore'
+            args += ['--restore-time', str(restore_time)]
         if patterns:
             assert action == 'restore'
             args += [p.pattern for p in patterns]
@@ -199,23 +413,95 @@ class Backup:
         Execute the rdiff-backup process.
         Set `force` to True to run backup process event when it's not the time to run.
         Set `force_patterns` with patterns to use instead of default one from settings.
-        Set `fork` to True to run the backup processing in a separate process.
+        The rdiff-backup processes are started by the fork server when available.
         """
         # Check if it'S time to run a backup
         if self.is_running():
             raise RunningError()
         if not force and not self.is_backup_time():
             raise NotScheduleError()
+        # Before starting threads.
+        self.start_fork_server()
 
         # Clear pause if backup started with force
         if self.get_settings('pause_until'):
             self.set_settings('pause_until', None)
 
+        # Skip roots without changes since last backup.
+        skip_unchanged = not force and self.get_settings('skip_unchanged')
+
+        if force_patterns is not None:
+            try:
+                self._backup_tier(Tier(None, self.get_settings('schedule')), force_patterns, skip_unchanged)
+            finally:
+                self._update_result([t.name for t in self.get_tiers() if t.name] + [None])
+            return
+
+        # Run the tiers due in priority order. A tier interrupted by a tier of
+        # higher priority is executed again once the higher tiers completed.
+        tiers = self.get_tiers()
+        try:
+            self._backup_tiers(tiers, force, skip_unchanged)
+        finally:
+            self._update_result([t.name for t in tiers])
+
+    def _backup_tiers(self, tiers, force=False, skip_unchanged=False):
+        """
+        Execute the backup of the tiers due in priority order.
+        """
+        pending = [t for t in tiers if force or self._tier_backup_time(t) <= Datetime()]
+        if not pending:
+            # Called without being due, run the tier the closest to be due.
+            pending = [min(tiers, key=self._tier_backup_time)]
+        errors = {}
+        while pending:
+            tier = pending.pop(0)
+            higher = [t for t in tiers[: tiers.index(tier)] if t not in pending]
+            try:
+                self._backup_tier(tier, self.get_patterns(tier.name), skip_unchanged, preempt_by=higher)
+            except _Preempted:
+                due = [t for t in higher if self._tier_backup_time(t) <= Datetime()]
+                pending = due + [tier] + pending
+            except BackupError as e:
+                errors[tier.name or _('default')] = e
+
+        # Report errors.
+        if len(errors) == 1:
+            raise next(iter(errors.values()))
+        elif errors:
+            raise MultipleBackupError(errors)
+
+    def _update_result(self, tiers):
+        """
+        Set the overall result to the worst result of the given tiers. A
+        tier still reported as running got killed before completion.
+        """
+        status = Status(self.status_file)
+        results = {}
+        for tier in tiers:
+            result, details = status.tier_result(tier)
+            result = 'INTERRUPT' if result in ['RUNNING', 'STALE'] else result
+            results.setdefault(result, []).append((tier, details))
+        worst = next((r for r in ['FAILURE', 'INTERRUPT', 'SUCCESS'] if r in results), None)
+        if worst is None:
+            return
+        status['lastresult'] = worst
+        if len(tiers) == 1:
+            status['details'] = results[worst][0][1]
+        else:
+            status['details'] = '; '.join('%s: %s' % (t or _('default'), d) for t, d in results[worst] if d)
+        status.save()
+
+    def _backup_tier(self, tier, patterns, skip_unchanged=False, preempt_by=None):
+        """
+        Execute the backup of the given patterns into the repository of the
+        tier. Raise `_Preempted` when interrupted by one of the `preempt_by`
+        tiers becoming due.
+        """
         # Start a thread to update backup status.
         status = Status(self.status_file)
-        with _UpdateStatus(status=status):
-            # Pick the right patterns
-            patterns = force_patterns if force_patterns is not None else Patterns(self.patterns_file)
+        status['fork_pid'] = self._fork_server.pid if self._fork_server else None
+        with _UpdateStatus(status=status, tier=tier.name) as update_status:
             if not patterns:
                 raise NoPatternsError()
 
@@ -223,34 +509,445 @@ class Backup:
             # (C:\, D:\, etc). To support this scenario, we need to run
             # rdiff-backup multiple time on the same computer. Once for each Root
             # to be backup (if required).
+            # Each root is scanned once for every destinations.
+            destinations = [d.name for d in self.get_settings().destinations()]
+            sessions = []
             for drive, patterns in patterns.group_by_roots():
-                if IS_WINDOWS:
-                    args = [
-                        '--no-hard-links',
-                        '--exclude-symbolic-links',
-                        '--create-full-path',
-                        '--no-compression',
-                    ]
+                for index, sublist in self._shards(drive, patterns, tier.name):
+                    selection = _SharedSelection(self, drive, sublist, source=patterns)
+                    for destination in destinations:
+                        name = self._session_name(drive, index, tier.name, destination)
+                        progress = update_status.progress(name, root=drive)
+                        func = functools.partial(
+                            self._backup_root, selection, progress, skip_unchanged, index, tier.name, destination
+                        )
+                        sessions.append((name, func))
+            # Tiers already due when starting are not preempting this tier, to
+            # avoid looping on a failing tier.
+            preempt_by = [t for t in preempt_by or [] if self._tier_backup_time(t) > Datetime()]
+            with contextlib.ExitStack() as stack:
+                for destination in destinations:
+                    stack.enter_context(self._ssh_multiplexing(enabled=len(sessions) > 1, destination=destination))
+                preempted = stack.enter_context(self._preemption(preempt_by))
+                try:
+                    self._run_sessions(update_status, sessions)
+                except BackupError:
+                    if not preempted:
+                        raise
+                if preempted:
+                    raise _Preempted(_('interrupted by tier %s') % preempted[0])
+
+    @contextlib.contextmanager
+    def _preemption(self, tiers):
+        """
+        Watch the given tiers while the sessions are running. Cancel the
+        sessions as soon as one of them is due. Yield a list receiving the
+        name of the tier when the sessions get cancelled.
+        """
+        preempted = []
+        stop_event = threading.Event()
+
+        def _watch():
+            while not stop_event.wait(_PREEMPT_DELAY):
+                for tier in tiers:
+                    if self._tier_backup_time(tier) <= Datetime():
+                        logger.info('tier %s is due, interrupting running backup', tier.name)
+                        preempted.append(tier.name)
+                        self._cancel()
+                        return
+
+        watcher = threading.Thread(target=_watch, name='preemption', daemon=True)
+        if tiers:
+            watcher.start()
+        try:
+            yield preempted
+        finally:
+            stop_event.set()
+            if tiers:
+                watcher.join()
+
+    def _backup_root(self, selection, progress, skip_unchanged=False, shard=0, tier=None, destination=None):
+        """
+        Execute a rdiff-backup session for a single root or a shard of it.
+        """
+        drive = selection.root
+        if IS_WINDOWS:
+            args = [
+                '--no-hard-links',
+                '--exclude-symbolic-links',
+                '--create-full-path',
+                '--no-compression',
+            ]
+        else:
+            args = [
+                '--exclude-sockets',
+                '--no-compression',
+            ]
+        # Print statistics to collect session duration.
+        args.append('--print-statistics')
+
+        def _run(patterns):
+            with contextlib.ExitStack() as stack:
+                extra_args = args + self._selection_args(drive, patterns, stack)
+                func = functools.partial(self._rdiff_backup, extra_args=extra_args, path=drive, on_line=progress.parse)
+                if shard:
+                    func = functools.partial(func, shard=shard)
+                if tier:
+                    func = functools.partial(func, tier=tier)
+                if destination:
+                    func = functools.partial(func, destination=destination)
+                func()
+
+        if skip_unchanged:
+            self._backup_if_changed(_run, selection, shard, tier, destination)
+        else:
+            # The mirror get updated, the manifest is no longer valid.
+            scan.Manifest(self._manifest_file(drive, shard, tier, destination)).delete()
+            patterns, unused = selection.exclude()
+            _run(patterns)
+
+    def _session_name(self, root, shard=0, tier=None, destination=None):
+        name = '%s#%d' % (root, shard) if shard else root
+        if tier:
+            name = '%s:%s' % (tier, name)
+        return '%s@%s' % (name, destination) if destination else name
+
+    def _shards(self, root, patterns, tier=None, persist=True):
+        """
+        Return a list of `(shard, patterns)` to backup the given root. When
+        sharding is enabled, the assignment of each directory is persisted
+        to restore them from the right repository. Set `persist` to False
+        to leave the assignment and the listing cache untouched.
+        """
+        count = self.get_settings('shards')
+        if count <= 1:
+            return [(0, patterns)]
+        shards = Shards(self.shards_file)
+        # Only directories never assigned get walked to compute their size.
+        cache = scan.ListingCache(self.listing_file)
+        sizes = shard.units(root, patterns, cache, known={path: size for path, (unused, size) in shards.items()})
+        if persist:
+            cache.save()
+        # The load of each shard is the size of its last session to the primary destination.
+        status = self.get_status()
+        loads = [status.previous_size(self._session_name(root, index, tier)) for index in range(count)]
+        assignment = shard.assign(sizes, count, shards, loads)
+        # Directories no longer existing are kept to be restored.
+        shards.update({path: (index, sizes[path]) for path, index in assignment.items()})
+        if persist:
+            shards.save()
+        return shard.split(patterns, assignment, count)
+
+    def _selection_args(self, drive, patterns, stack):
+        """
+        Return rdiff-backup arguments to select the patterns of the given root.
+        """
+        args = []
+        if len(patterns) > _MAX_PATTERN_ARGS:
+            # Avoid command line limit with large number of patterns.
+            filelist = stack.enter_context(self._filelist(patterns))
+            args.extend(['--include-globbing-filelist', filelist])
+        else:
+            for p in patterns:
+                args.append('--include' if p.include else '--exclude')
+                args.append(p.pattern)
+        args.extend(['--exclude', '%s**' % drive])
+        return args
+
+    def dry_run(self, force_patterns=None):
+        """
+        Predict what the next backup would transfer without running it.
+        Return a list of dict, one per root and destination, with `root`, `new`, `changed`,
+        `deleted`, `bytes`, `eta` and `snapshot`.
+
+        Local files are compared with a snapshot of the mirror metadata cached
+        in the manifest of the root. When not available, the snapshot is
+        retrieved once from the server using `rdiff-backup compare`.
+        """
+        if force_patterns is not None:
+            jobs = [(None, force_patterns)]
+        else:
+            jobs = [(t.name, self.get_patterns(t.name)) for t in self.get_tiers()]
+        if not any(patterns for unused, patterns in jobs):
+            raise NoPatternsError()
+        status = self.get_status()
+        results = []
+        sessions = [
+            (tier, drive, index, sublist)
+            for tier, patterns in jobs
+            for drive, patterns in patterns.group_by_roots()
+            for index, sublist in self._shards(drive, patterns, tier, persist=False)
+        ]
+        # Each root is scanned once for every destinations.
+        destinations = [d.name for d in self.get_settings().destinations()]
+        for tier, drive, index, patterns in sessions:
+            selection = _SharedSelection(self, drive, patterns)
+            unused, detected = selection.exclude()
+            entries = autoexclude.exclude_entries(selection.entries(), detected)
+            for destination in destinations:
+                snapshot, snapshot_time = self._get_snapshot(
+                    drive, patterns, selection.entries(), index, tier, destination
+                )
+                snapshot = autoexclude.exclude_entries(snapshot, detected)
+                new = [p for p, values in entries.items() if values and p not in snapshot]
+                changed = [p for p, values in entries.items() if values and snapshot.get(p, values) != values]
+                deleted = [p for p, values in snapshot.items() if values and p not in entries]
+                size = sum(entries[p][0] for p in new + changed)
+                name = self._session_name(drive, index, tier, destination)
+                rate = status.previous_rate(name)
+                results.append(
+                    {
+                        'root': name,
+                        'new': len(new),
+                        'changed': len(changed),
+                        'deleted': len(deleted),
+                        'bytes': size,
+                        'eta': int(size / rate) if rate else None,
+                        'snapshot': snapshot_time,
+                    }
+                )
+        return results
+
+    def _get_snapshot(self, root, patterns, entries, shard=0, tier=None, destination=None):
+        """
+        Return the entries of the mirror as seen on last backup and the time
+        of the last successful backup of the tier or None if unknown.
+        Entries are selected by the patterns, before automatic exclusion.
+        """
+        digest = self._manifest_digest(root, patterns, destination)
+        manifest = scan.Manifest(self._manifest_file(root, shard, tier, destination))
+        previous_digest, unused, snapshot = manifest.load()
+        # The mirror is as it was on the last successful session to the destination.
+        lastsuccess = self.get_status().session_lastsuccess(self._session_name(root, shard, tier, destination), tier)
+        if previous_digest == digest:
+            return snapshot, lastsuccess
+        # Ask the server for the differences with the mirror.
+        logger.info('retrieving mirror metadata of %s', root)
+        snapshot = dict(entries)
+        unknown = (-1, -1, -1, -1)
+
+        def _on_line(line):
+            m = _COMPARE_REPORT.match(line.rstrip('\r\n'))
+            if m and m.group(2) != '.':
+                path = root.rstrip('/') + '/' + m.group(2)
+                if m.group(1) == 'new':
+                    snapshot.pop(path, None)
                 else:
-                    args = [
-                        '--exclude-sockets',
-                        '--no-compression',
-                    ]
-                for p in patterns:
-                    args.append('--include' if p.include else '--exclude')
-                    args.append(p.pattern)
-                args.extend(['--exclude', '%s**' % drive])
-                self._rdiff_backup(extra_args=args, path=drive)
+                    snapshot[path] = unknown
+
+        with contextlib.ExitStack() as stack:
+            args = ['--exclude-symbolic-links' if IS_WINDOWS else '--exclude-sockets', '--method', 'meta']
+            args.extend(self._selection_args(root, patterns, stack))
+            self._rdiff_backup(
+                'compare',
+                extra_args=args,
+                path=root,
+                on_line=_on_line,
+                shard=shard,
+                tier=tier,
+                destination=destination,
+            )
+        # Cache the snapshot, unless a backup is updating it.
+        if not self.is_running():
+            manifest.save(digest, snapshot)
+        return snapshot, lastsuccess
 
-    def get_patterns(self):
+    def _auto_exclude(self, root, patterns, entries):
         """
-        Return list of include/exclude patterns
+        Return the patterns with caches and build artifacts detected in the
+        scanned entries excluded and the list of `Detected` directories.
         """
-        return Patterns(self.patterns_file)
+        detected = autoexclude.detect(root, patterns, entries)
+        for d in detected:
+            logger.debug('excluding %s (%s): %s', d.path, d.rule.id, format_size(d.size))
+        if detected:
+            logger.info(
+                'automatically excluding %s directories from %s, avoided %s',
+                len(detected),
+                root,
+                format_size(sum(d.size for d in detected)),
+            )
+        return autoexclude.exclude(patterns, detected), detected
+
+    @contextlib.contextmanager
+    def _filelist(self, patterns=[], paths=[]):
+        """
+        Write the patterns into a temporary globbing filelist for rdiff-backup
+        or the absolute paths into a filelist.
+        """
+        fd, filename = tempfile.mkstemp(prefix='selection-', suffix='.txt', dir=compat.get_data_home())
+        try:
+            with open(fd, 'w', encoding='utf-8', errors='surrogateescape') as f:
+                if patterns:
+                    scan.write_filelist(f, patterns)
+                for path in paths:
+                    f.write(path + '\n')
+            yield filename
+        finally:
+            os.remove(filename)
+
+    def _backup_if_changed(self, func, selection, shard=0, tier=None, destination=None):
+        """
+        Scan the files of the selection and compare them with the manifest
+        of the last successful backup. Execute the session only when
+        something changed by calling `func` with the patterns to backup.
+
+        The journal is only used when the agent watches the `source`
+        patterns of the root, otherwise a full scan is executed. The
+        manifest keep the files before automatic exclusion, so caches and
+        build artifacts are detected from the rescanned files.
+        """
+        root = selection.root
+        digest = self._manifest_digest(root, selection.patterns, destination)
+        manifest = scan.Manifest(self._manifest_file(root, shard, tier, destination))
+        previous_digest, previous_position, previous = manifest.load()
+        # Get position in journal before scanning, changes made after are considered on next run.
+        dirty = None
+        position = None
+        if self.get_settings('watch_changes'):
+            watched = self.get_watched_roots()
+            changes_journal = journal.Journal(self.journal_file)
+            position = changes_journal.position(journal.roots_digest(watched))
+            if (root, selection.source) not in watched:
+                logger.debug('%s not watched for changes, fallback to full scan', root)
+                position = None
+            if previous_digest == digest:
+                dirty = changes_journal.read(previous_position)
+        if dirty is not None:
+            logger.debug('scanning %s dirty directories in %s', len(dirty), root)
+            entries = scan.rescan(root, selection.patterns, previous, dirty)
+        else:
+            entries = selection.entries()
+        patterns, detected = selection.exclude(entries)
+        if previous_digest == digest:
+            changes = selection.changes(previous, entries, detected)
+            if not changes:
+                logger.info('skipping %s: no changes since last backup', root)
+                raise _SessionSkipped(_('skipped, no changes since last backup'))
+            logger.debug('%s changes found in %s, e.g.: %s', len(changes), root, changes[0])
+        # Files modified during the session are detected on next run.
+        manifest.delete()
+        func(patterns)
+        manifest.save(digest, entries, position)
+
+    def _manifest_digest(self, root, patterns, destination=None):
+        """
+        Return the digest of the configuration used to create the manifest
+        of a root. The manifest keep the files selected by the patterns,
+        before automatic exclusion.
+        """
+        dest = self._get_destination(destination)
+        return scan.digest(dest.remotehost, dest.repositoryname, root, self.get_settings('auto_exclude'), *patterns)
+
+    def _manifest_file(self, root, shard=0, tier=None, destination=None):
+        name = re.sub('[^a-zA-Z0-9]', '', root) or 'root'
+        if shard:
+            name += '-shard%d' % shard
+        if tier:
+            name = tier + '-' + name
+        if destination:
+            name += '@' + destination
+        return os.path.join(compat.get_data_home(), 'manifest-%s.gz' % name)
+
+    def estimate_patterns(self, patterns=None):
+        """
+        Return the number of files and bytes selected by each pattern as a
+        dictionary of `Pattern` to `(files, bytes)`. For include patterns,
+        it's the files added to the backup. For exclude patterns, it's the
+        files that would have been included otherwise.
+        """
+        patterns = patterns if patterns is not None else self.get_patterns()
+        # Patterns may get rewritten when grouped by roots.
+        originals = {}
+        for p in patterns:
+            pattern = p.pattern.replace('\\', '/') if IS_WINDOWS else p.pattern
+            originals.setdefault((p.include, pattern), p)
+            if p.is_wildcard() and not p.include:
+                originals.setdefault((p.include, '**/' + pattern), p)
+        result = {p: (0, 0) for p in patterns}
+        cache = scan.ListingCache(self.listing_file)
+        for root, sublist in patterns.group_by_roots():
+            added, removed = scan.estimate(root, sublist, cache=cache)
+            for p, (files, size) in list(added.items()) + list(removed.items()):
+                original = originals.get((p.include, p.pattern))
+                if original is not None:
+                    result[original] = (result[original][0] + files, result[original][1] + size)
+        cache.save()
+        return result
+
+    def get_patterns(self, tier=None):
+        """
+        Return list of include/exclude patterns of the given tier. By
+        default, return the patterns of the default tier.
+        """
+        return Patterns(self._patterns_file(tier))
+
+    def _patterns_file(self, tier=None):
+        if tier:
+            return os.path.join(compat.get_config_home(), 'patterns.%s' % tier)
+        return self.patterns_file
+
+    def get_watched_roots(self):
+        """
+        Return the list of `(root, patterns)` of every tier to be watched
+        for changes. A root is listed once for every tier selecting it.
+        """
+        roots = []
+        for tier in self.get_tiers():
+            for item in self.get_patterns(tier.name).group_by_roots():
+                if item not in roots:
+                    roots.append(item)
+        return roots
+
+    def get_tiers(self):
+        """
+        Return the list of `Tier` to be backup, highest priority first. The
+        default tier, using the schedule and patterns from settings, is last.
+        Tiers without patterns are ignored.
+        """
+        config = self.get_settings()
+        tiers = [t for t in config.tiers() if self._has_patterns(t.name)]
+        if not tiers or self._has_patterns():
+            tiers.append(Tier(None, config['schedule']))
+        return tiers
+
+    def _has_patterns(self, tier=None):
+        """
+        Return True if the given tier has patterns. The patterns file is
+        parsed again only when its signature changed.
+        """
+        filename = self._patterns_file(tier)
+        signature = _file_signature(filename)
+        cached = self._has_patterns_cache.get(filename)
+        if signature is None or cached is None or cached[0] != signature:
+            cached = (signature, bool(Patterns(filename)))
+            self._has_patterns_cache[filename] = cached
+        return cached[1]
+
+    def add_tier(self, name, schedule=None):
+        """
+        Define a new tier with lower priority than existing tiers or update
+        the schedule of an existing tier.
+        """
+        if not name or not re.match(_NAME_PATTERN, name):
+            raise ValueError("tier must only contains letters, numbers and dash (-)")
+        config = self.get_settings()
+        values = {}
+        names = [t.name for t in config.tiers()]
+        if name not in names:
+            values['tiers'] = ','.join(names + [name])
+        if schedule is not None:
+            values['tier.%s.schedule' % name] = schedule
+        elif 'tier.%s.schedule' % name not in config:
+            values['tier.%s.schedule' % name] = config['schedule']
+        if values:
+            self.update_settings(values)
 
     def get_repo_url(self, page='browse'):
         """
-        Return a URL to browse data.
+        Return a URL to browse data of the repository of the first root.
+        Directories assigned to another shard or files of another tier are
+        not listed in this repository, see `get_repo_urls()`.
         """
         assert page in ['browse', 'settings']
         settings = self.get_settings()
@@ -265,6 +962,24 @@ class Backup:
             repo = settings['repositoryname']
         return "%s/%s/%s/%s" % (settings['remoteurl'], page, settings['username'], repo)
 
+    def get_repo_urls(self, page='browse'):
+        """
+        Return a URL to browse data of each repository receiving the backup:
+        one for each root, shard and tier.
+        """
+        assert page in ['browse', 'settings']
+        settings = self.get_settings()
+        return [
+            "%s/%s/%s/%s"
+            % (
+                settings['remoteurl'],
+                page,
+                settings['username'],
+                self._repository_path(settings['repositoryname'], root, index, tier).rstrip('/'),
+            )
+            for root, index, tier in self._repositories()
+        ]
+
     def get_help_url(self):
         """
         Return a URL to help.
@@ -274,41 +989,33 @@ class Backup:
 
     def get_settings(self, key=None):
         """
-        Return configuration.
+        Return configuration. The settings file is only parsed again when it
+        get modified.
         """
-        config = Settings(self.config_file)
+        config = self.settings_store.get()
         if key:
             return config[key]
         return config
 
     def set_settings(self, key, value):
         """
-        Return configuration.
+        Update a single configuration value.
+        """
+        self.update_settings({key: value})
+
+    def update_settings(self, values):
+        """
+        Update multiple configuration values with a single write.
         """
-        config = Settings(self.config_file)
-        config[key] = value
-        config.save()
+        self.settings_store.update(values)
 
     def get_status(self, key=None):
         """
         Return a backup status. Read data from the status file and make
-        interpretation of it.
+        interpretation of it. The status file is only parsed again when it
+        get modified.
         """
-        # TODO We should cache the status file and only return a new value if
-        # the modification time changed.
-        now = Datetime()
-        status = Status(self.status_file)
-        # After reading the status file, let determine the real status.
-        if status['lastresult'] == 'RUNNING':
-            # Get pid and checkif process is running.
-            try:
-                is_running = status['pid'] and psutil.Process(int(status['pid'])).is_running()
-            except (ValueError, NoSuchProcess):
-                is_running = False
-            if not is_running:
-                status['lastresult'] = 'INTERRUPT'
-            elif status['lastdate'] and now - status['lastdate'] > timedelta(seconds=_RUNNING_DELAY * 2):
-                status['lastresult'] = 'STALE'
+        status = self.status_store.get()
         if key:
             return status[key]
         return status
@@ -324,18 +1031,33 @@ class Backup:
         """
         Check if it's time to backup.
         """
+        return self.next_backup_time() <= Datetime()
+
+    def next_backup_time(self):
+        """
+        Return the time when the next backup should run according to the
+        schedule, the pause and the last successful backup of each tier.
+        """
+        next_time = min(self._tier_backup_time(t) for t in self.get_tiers())
         # Check if paused.
         pause_until = self.get_settings('pause_until')
-        if pause_until and Datetime() < pause_until:
-            return False
+        if pause_until and next_time < pause_until:
+            next_time = pause_until
+        return next_time
+
+    def _tier_backup_time(self, tier):
+        """
+        Return the time when the given tier should run according to its
+        schedule and its last successful backup.
+        """
+        status = self.get_status()
+        lastsuccess = status.tier_lastsuccess(tier.name)
         # Check if backup ever ran.
-        lastsuccess = self.get_status('lastsuccess')
         if lastsuccess is None:
-            return True
+            return Datetime()
         # Check if interval passed
-        interval = datetime.timedelta(hours=self.get_settings('schedule') * 98.0 / 100)
-        time_since_last_backup = Datetime() - lastsuccess
-        return interval < time_since_last_backup
+        interval = datetime.timedelta(hours=tier.schedule * 98.0 / 100)
+        return lastsuccess + interval
 
     def is_running(self):
         """
@@ -344,16 +1066,19 @@ class Backup:
         # Check status for running backup.
         return self.get_status('lastresult') == 'RUNNING'
 
-    def link(self, remoteurl, username, password, repository_name, force=False):
+    def link(self, remoteurl, username, password, repository_name, force=False, destination=None):
         """
         Link the computer with minarca server.
         Set `force` to True to link event if the repository name already exists.
+        Set `destination` to link an additional server receiving the same backup.
         """
         # Validate the repository name
         if not repository_name or not re.match(_REPOSITORY_NAME_PATTERN, repository_name):
             raise ValueError("repository must only contains letters, numbers, dash (-) and dot (.)")
+        if destination is not None and not re.match(_NAME_PATTERN, destination):
+            raise ValueError("destination must only contains letters, numbers and dash (-)")
 
-        try:
+        with self._http_errors(remoteurl):
             # Check if the repository already exists for the guven user.
             rdiffweb = Rdiffweb(remoteurl, username, password)
             current_user = rdiffweb.get_current_user_info()
@@ -365,21 +1090,38 @@ class Backup:
                 raise RepositoryNameExistsError(repository_name)
 
             # Generate SSH Keys
-            self._push_identity(rdiffweb, repository_name)
+            self._push_identity(rdiffweb, repository_name, destination)
 
             # Store minarca identity
             minarca_info = rdiffweb.get_minarca_info()
-            with open(self.known_hosts, 'w') as f:
+            with open(self._identity_files(destination)[2], 'w') as f:
                 f.write(minarca_info['identity'])
 
+            if destination:
+                # Additional destination use the schedule and patterns of the primary destination.
+                names = [d.name for d in self.get_settings().destinations()[1:]]
+                values = {
+                    'destination.%s.username' % destination: username,
+                    'destination.%s.repositoryname' % destination: repository_name,
+                    'destination.%s.remotehost' % destination: minarca_info['remotehost'],
+                    'destination.%s.remoteurl' % destination: remoteurl,
+                }
+                if destination not in names:
+                    values['destinations'] = ','.join(names + [destination])
+                self.update_settings(values)
+                self.test_server(destination)
+                return
+
             # Create default config
-            config = self.get_settings()
-            config['username'] = username
-            config['repositoryname'] = repository_name
-            config['remotehost'] = minarca_info['remotehost']
-            config['remoteurl'] = remoteurl
-            config['schedule'] = Settings.DAILY
-            config.save()
+            self.update_settings(
+                {
+                    'username': username,
+                    'repositoryname': repository_name,
+                    'remotehost': minarca_info['remotehost'],
+                    'remoteurl': remoteurl,
+                    'schedule': Settings.DAILY,
+                }
+            )
 
             # Only test the connection
             self.test_server()
@@ -396,8 +1138,18 @@ class Backup:
             status.save()
 
             # etc.
-            config['configured'] = True
-            config.save()
+            self.set_settings('configured', True)
+
+    @contextlib.contextmanager
+    def _http_errors(self, remoteurl):
+        """
+        Translate errors raised by requests while communicating with Rdiffweb.
+        """
+        # Lazy import, requests is slow to import.
+        from requests.exceptions import ConnectionError, HTTPError, InvalidSchema, MissingSchema
+
+        try:
+            yield
         except ConnectionError:
             # Raised with invalid url or port
             raise HttpConnectionError(remoteurl)
@@ -409,6 +1161,17 @@ class Backup:
                 raise HttpAuthenticationError(e)
             raise HttpServerError(e)
 
+    def get_rdiffweb(self, password, destination=None):
+        """
+        Return an authenticated `Rdiffweb` session to the given destination.
+        The password is never stored, so it must be provided by the user.
+        """
+        config = self._get_destination(destination)
+        if not config.remoteurl or not config.username:
+            raise NotConfiguredError()
+        with self._http_errors(config.remoteurl):
+            return Rdiffweb(config.remoteurl, config.username, password)
+
     def pause(self, delay):
         """
         Used to prevent execution of backup for a given periode of time in hours.
@@ -420,59 +1183,302 @@ class Backup:
         else:
             self.set_settings('pause_until', None)
 
-    def _push_identity(self, rdiffweb, name):
+    def _push_identity(self, rdiffweb, name, destination=None):
+        private_key_file, public_key_file, unused = self._identity_files(destination)
         # Check if ssh keys exists, if not generate new keys.
-        if not os.path.exists(self.public_key_file) and not os.path.exists(self.private_key_file):
+        if not os.path.exists(public_key_file) and not os.path.exists(private_key_file):
             logger.debug(_('generating identity'))
-            ssh_keygen(self.public_key_file, self.private_key_file)
+            ssh_keygen(public_key_file, private_key_file)
 
         # Push SSH Keys to Minarca server
         try:
-            with open(self.public_key_file) as f:
+            with open(public_key_file) as f:
                 logger.debug(_('exchanging identity with minarca server'))
                 rdiffweb.add_ssh_key(name, f.read())
         except Exception:
             # Probably a duplicate SSH Key, let generate new identity
             logger.debug(_('generating new identity'))
-            ssh_keygen(self.public_key_file, self.private_key_file)
+            ssh_keygen(public_key_file, private_key_file)
             # Publish new identify
-            with open(self.public_key_file) as f:
+            with open(public_key_file) as f:
                 logger.debug(_('exchanging new identity with minarca server'))
                 rdiffweb.add_ssh_key(name, f.read())
 
-    def _rdiff_backup(self, action='backup', extra_args=[], path=None):
+    def _get_destination(self, name=None):
         """
-        Make a call to rdiff-backup executable
+        Return the `Destination` with the given name. By default, return
+        the primary destination.
         """
-        assert action in ['backup', 'restore', 'test']
-        # Read config file for remote host
-        config = self.get_settings()
-        if not config['remotehost']:
-            raise NotConfiguredError()
-        if not config['repositoryname']:
-            raise NotConfiguredError()
-        remote_host, unused, remote_port = config['remotehost'].partition(':')
-        repositoryname = config['repositoryname']
+        for d in self.get_settings().destinations():
+            if d.name == name:
+                return d
+        raise NotConfiguredError()
 
-        # base command line
-        args = [get_minarca_exe(), 'rdiff-backup', '-v', '5', '--remote-schema']
-        remote_schema = _escape_path(compat.get_ssh())
-        remote_schema += " -oBatchMode=yes -oPreferredAuthentications=publickey"
+    def _identity_files(self, destination=None):
+        """
+        Return the private key, the public key and the known hosts files
+        used to connect to the given destination.
+        """
+        if not destination:
+            return self.private_key_file, self.public_key_file, self.known_hosts
+        return (
+            '%s-%s' % (self.private_key_file, destination),
+            '%s-%s.pub' % (self.private_key_file, destination),
+            '%s-%s' % (self.known_hosts, destination),
+        )
+
+    def _ssh_args(self, remote_port=None, escape=False, destination=None):
+        """
+        Return the ssh command line used to connect to minarca server.
+        Set `escape` to True to escape file path to be used within rdiff-backup remote schema.
+        """
+        private_key_file, unused, known_hosts = self._identity_files(destination)
+        args = [_escape_path(compat.get_ssh()) if escape else compat.get_ssh()]
+        args += ['-oBatchMode=yes', '-oPreferredAuthentications=publickey']
         if os.environ.get('MINARCA_ACCEPT_HOST_KEY', False) in ['true', '1', 'True']:
-            remote_schema += ' -oStrictHostKeyChecking=no'
+            args.append('-oStrictHostKeyChecking=no')
         if remote_port:
-            remote_schema += ' -p %s' % remote_port
+            args += ['-p', remote_port]
         # SSH options need extract escaping
-        remote_schema += " -oUserKnownHostsFile=%s" % _escape_path(self.known_hosts).replace(' ', '\\ ')
-        remote_schema += " -oIdentitiesOnly=yes"
+        if escape:
+            args.append('-oUserKnownHostsFile=%s' % _escape_path(known_hosts).replace(' ', '\\ '))
+        else:
+            args.append('-oUserKnownHostsFile=%s' % known_hosts)
+        args.append('-oIdentitiesOnly=yes')
         # Identity file must be escape if it contains spaces
-        remote_schema += " -i %s" % _escape_path(self.private_key_file)
+        args += ['-i', _escape_path(private_key_file) if escape else private_key_file]
+        return args
+
+    @contextlib.contextmanager
+    def _ssh_multiplexing(self, enabled=True, destination=None):
+        """
+        Establish a master SSH connection with minarca server to be shared by
+        every rdiff-backup sessions executed within this context. If the master
+        connection cannot be established, rdiff-backup create it's own SSH
+        connection as usual.
+        """
+        config = self.get_settings()
+        remotehost = self._get_destination(destination).remotehost if config['ssh_multiplexing'] else None
+        if not enabled or destination in self._control_paths or not remotehost:
+            yield
+            return
+        remote_host, unused, remote_port = remotehost.partition(':')
+        control_path = os.path.join(compat.get_data_home(), 'ssh-%s' % os.getpid())
+        if destination:
+            control_path += '-' + destination
+        # Start the master connection in background (-f) once authenticated.
+        args = self._ssh_args(remote_port, destination=destination) + [
+            '-M',
+            '-N',
+            '-f',
+            '-oControlPath=%s' % control_path,
+            '-oControlPersist=%s' % _CONTROL_PERSIST,
+            'minarca@%s' % remote_host,
+        ]
+        logger.debug(_('executing command: %s') % _sh_quote(args))
+        try:
+            exit_code = subprocess.call(
+                args,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=_CONTROL_TIMEOUT,
+            )
+        except (OSError, subprocess.TimeoutExpired):
+            logger.debug('fail to start ssh master connection', exc_info=1)
+            exit_code = None
+        if exit_code != 0:
+            logger.info('fail to establish ssh master connection, continue without multiplexing')
+            yield
+            return
+        self._control_paths[destination] = control_path
+        try:
+            yield
+        finally:
+            del self._control_paths[destination]
+            # Tear down the master connection.
+            args = self._ssh_args(remote_port, destination=destination) + [
+                '-oControlPath=%s' % control_path,
+                '-O',
+                'exit',
+                'minarca@%s' % remote_host,
+            ]
+            try:
+                subprocess.call(
+                    args,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                    timeout=_CONTROL_TIMEOUT,
+                )
+            except (OSError, subprocess.TimeoutExpired):
+                logger.debug('fail to stop ssh master connection', exc_info=1)
+
+    def _cancel(self):
+        """
+        Cancel rdiff-backup sessions running or pending in this process.
+        """
+        self._cancel_event.set()
+        with self._processes_lock:
+            processes = list(self._processes)
+        for p in processes:
+            logger.info('terminating process %s' % p.pid)
+            try:
+                p.terminate()
+            except OSError:
+                pass
+
+    def _run_sessions(self, update_status, sessions, max_parallel=None):
+        """
+        Execute the given rdiff-backup sessions. Each session is a tuple with a
+        name (e.g.: the root) and a function to be called. The function may
+        return details to be reported with the status of the session.
+
+        Sessions are executed concurrently with a maximum of `max_parallel`
+        workers, by default according to the settings. A failing session
+        doesn't prevent the other sessions from running. Errors are raised
+        once every sessions completed.
+        """
+        self._cancel_event.clear()
+        if max_parallel is None:
+            # Shards of a root are always backup concurrently. Each root is also
+            # backup concurrently to every destinations to read the files once
+            # from the disk, the other sessions reading them from the OS cache.
+            config = self.get_settings()
+            max_parallel = max(1, config['max_parallel'], config['shards']) * len(config.destinations())
+        max_parallel = max(1, max_parallel)
+        errors = {}
+
+        def _run(name, func):
+            if self._cancel_event.is_set():
+                update_status.set_session_status(name, 'INTERRUPT')
+                return
+            update_status.set_session_status(name, 'RUNNING')
+            try:
+                details = func()
+            except _SessionSkipped as e:
+                update_status.set_session_status(name, 'SUCCESS', str(e), skipped=True)
+            except Exception as e:
+                logger.debug('session %s failed', name, exc_info=1)
+                update_status.set_session_status(name, 'FAILURE', str(e))
+                errors[name] = e
+            else:
+                update_status.set_session_status(name, 'SUCCESS', details or '')
+
+        if max_parallel == 1 or len(sessions) <= 1:
+            for name, func in sessions:
+                _run(name, func)
+        else:
+            with ThreadPoolExecutor(max_workers=min(max_parallel, len(sessions))) as executor:
+                futures = [executor.submit(_run, name, func) for name, func in sessions]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except BaseException:
+                    # On KeyboardInterrupt, stop every sessions.
+                    for future in futures:
+                        future.cancel()
+                    self._cancel()
+                    raise
+
+        # Report errors.
+        if len(errors) == 1:
+            raise next(iter(errors.values()))
+        elif errors:
+            raise MultipleBackupError(errors)
+
+    def start_fork_server(self):
+        """
+        Start the fork server when the fork engine is enabled and return it.
+        The fork server must be started before any thread, otherwise
+        rdiff-backup sessions fall back to the subprocess engine. A fork
+        server killed by another process (e.g.: `minarca stop`) is replaced
+        under the same condition.
+        """
+        if self._fork_server and not self._fork_server.is_alive():
+            # Killed by another process, start a new one if possible.
+            logger.info('fork server is not running, restarting it')
+            self._fork_server.close()
+            self._fork_server = None
+        if self._fork_server is None and self._get_engine() == engine.ENGINE_FORK:
+            try:
+                self._fork_server = engine.ForkServer()
+            except RuntimeError:
+                logger.debug('cannot start fork server with threads running, fallback to subprocess engine')
+                self._fork_server = False
+            else:
+                weakref.finalize(self, self._fork_server.close)
+        return self._fork_server or None
+
+    def _get_engine(self):
+        """
+        Return the engine to be used to execute rdiff-backup.
+        """
+        value = self.get_settings('engine')
+        if not engine.is_supported(value):
+            logger.debug('engine %s not supported, fallback to %s', value, engine.ENGINE_SUBPROCESS)
+            return engine.ENGINE_SUBPROCESS
+        return value
+
+    def _remote_schema(self, remote_port, destination=None):
+        """
+        Return the rdiff-backup remote schema to connect to the given destination.
+        """
+        remote_schema = ' '.join(self._ssh_args(remote_port, escape=True, destination=destination))
+        # Re-use the master connection if available.
+        control_path = self._control_paths.get(destination)
+        if control_path:
+            remote_schema += " -oControlMaster=no -oControlPath=%s" % _escape_path(control_path).replace(' ', '\\ ')
         # Litera "%s" will get replace by rdiff-backup
         remote_schema += " %s"
         # Add user agent as command line
         remote_schema += " '%s'" % compat.get_user_agent()
+        return remote_schema
 
-        args.append(remote_schema)
+    def _repository_path(self, repositoryname, path, shard=0, tier=None):
+        """
+        Return the location of a local path inside the repository of the
+        given tier and shard.
+        """
+        if tier:
+            repositoryname += '.%s' % tier
+        if shard:
+            repositoryname += '.shard%d' % shard
+        if IS_WINDOWS:
+            return f"{repositoryname}/{path[0]}/{path[3:]}"
+        return f"{repositoryname}{path}"
+
+    def _rdiff_backup(
+        self,
+        action='backup',
+        extra_args=[],
+        path=None,
+        on_line=None,
+        shard=0,
+        tier=None,
+        destination=None,
+        target=None,
+    ):
+        """
+        Make a call to rdiff-backup executable. If defined, `on_line` is
+        called with every line of output. `tier` and `shard` select the
+        repository of a tier or a shard instead of the repository of the root.
+        `destination` select the server instead of the primary destination.
+        `target` restore the path into another location.
+        """
+        assert action in ['backup', 'restore', 'test', 'compare', 'list']
+        # Read config file for remote host
+        config = self._get_destination(destination)
+        if not config.remotehost:
+            raise NotConfiguredError()
+        if not config.repositoryname:
+            raise NotConfiguredError()
+        remote_host, unused, remote_port = config.remotehost.partition(':')
+
+        # base command line
+        # Keep the output of list free of info messages.
+        args = [get_minarca_exe(), 'rdiff-backup', '-v', '3' if action == 'list' else '5', '--remote-schema']
+        args.append(self._remote_schema(remote_port, destination))
         # Force operation on restore.
         if action == 'restore':
             args.append('--force')
@@ -480,18 +1486,18 @@ class Backup:
         args.extend(extra_args)
 
         if path:
-            if IS_WINDOWS:
-                remote = f"minarca@{remote_host}::{repositoryname}/{path[0]}/{path[3:]}"
-            else:
-                remote = f"minarca@{remote_host}::{repositoryname}{path}"
-        if action == 'backup':
+            remote = f"minarca@{remote_host}::" + self._repository_path(config.repositoryname, path, shard, tier)
+        if action in ['backup', 'compare']:
             # For backup local to remote
             args.append(path)
             args.append(remote)
         elif action == 'restore':
             # For restore remote to local
             args.append(remote)
-            args.append(path)
+            args.append(target or path)
+        elif action == 'list':
+            # For list of increments or files
+            args.append(remote)
         elif action == 'test':
             # For test-server
             args.append(f"minarca@{remote_host}::.")
@@ -500,20 +1506,32 @@ class Backup:
         capture = CaptureException()
         logger.debug(_('executing command: %s') % _sh_quote(args))
         try:
-            p = subprocess.Popen(
-                args,
-                stdin=subprocess.DEVNULL,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                encoding='utf-8',
-                errors='replace',
-            )
-            # stream the output of rdiff-backup.
-            for line in p.stdout:
-                logger.debug(line.rstrip())
-                capture.parse(line)
-            # Check return code
-            exit_code = p.wait()
+            fork_server = self.start_fork_server()
+            if fork_server:
+                p = fork_server.run(args[2:])
+            else:
+                p = subprocess.Popen(
+                    args,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    encoding='utf-8',
+                    errors='replace',
+                )
+            with self._processes_lock:
+                self._processes.add(p)
+            try:
+                # stream the output of rdiff-backup.
+                for line in p.stdout:
+                    logger.debug(line.rstrip())
+                    capture.parse(line)
+                    if on_line:
+                        on_line(line)
+                # Check return code
+                exit_code = p.wait()
+            finally:
+                with self._processes_lock:
+                    self._processes.discard(p)
         except Exception as e:
             if capture.exception:
                 raise capture.exception
@@ -525,23 +1543,309 @@ class Backup:
             if exit_code not in [0, 2, 8]:
                 raise RdiffBackupExitError(exit_code)
 
-    def restore(self, restore_time=None, patterns=None):
+    def restore(
+        self, restore_time=None, patterns=None, destination=None, rdiffweb=None, differential=False, verify=False
+    ):
         """
         Used to run a complete restore of data backup for the given date or latest date is not defined.
+        Set `destination` to restore from an additional destination.
+        Set `rdiffweb` to download the files over HTTP instead of using rdiff-backup.
+        Set `differential` to only restore the files that differ from the
+        backup, compared by size and modification time or, with `verify`, by
+        content hash.
         """
+        if differential and rdiffweb:
+            raise ValueError('differential restore is not supported over HTTP')
         if self.is_running():
             raise RunningError()
+        # Before starting threads.
+        self.start_fork_server()
         status = Status(self.status_file)
-        with _UpdateStatus(status=status, action='restore'):
+        status['fork_pid'] = self._fork_server.pid if self._fork_server else None
+        with _UpdateStatus(status=status, action='restore') as update_status:
             # Loop on each pattern to be restored and execute rdiff-backup.
-            patterns = patterns or self.get_patterns()
-            for p in patterns:
-                if p.include and not p.is_wildcard():
-                    self._rdiff_backup(
+            tiers = self._tier_includes()
+            if patterns:
+                targets = [
+                    (tier, p.pattern)
+                    for p in patterns
+                    if p.include and not p.is_wildcard()
+                    for tier in self._restore_tiers(p.pattern, tiers)
+                ]
+            else:
+                targets = [(tier, path) for tier, paths in tiers.items() for path in paths]
+            # Directories of sharded roots are restored from their own repository.
+            assignment = {path: index for path, (index, unused) in Shards(self.shards_file).items()}
+            sources = [(tier, source) for tier, pattern in targets for source in shard.sources(pattern, assignment)]
+            # Paths are restored concurrently, largest first, to reduce the
+            # overall duration. The size known from the backup is used as an
+            # estimate. A path is restored once its parents are restored,
+            # otherwise the restore of the parent would delete it.
+            keys = [scan.normpath(path).rstrip('/') + '/' for unused, (path, index) in sources]
+            sizes = self._restore_sizes(sources, destination)
+            depths = [sum(1 for other in keys if other != key and key.startswith(other)) for key in keys]
+            order = sorted(range(len(sources)), key=lambda i: (depths[i], -sizes[i]))
+            sessions = []
+            done = {}
+            for i in order:
+                tier, (path, index) = sources[i]
+                name = self._session_name(path, index, tier, destination)
+                progress = update_status.progress(name, root=path)
+                if rdiffweb:
+                    func = functools.partial(
+                        self._restore_http, rdiffweb, path, restore_time, progress, index, tier, destination
+                    )
+                elif differential:
+                    func = functools.partial(
+                        self._restore_differential,
+                        path,
+                        restore_time,
+                        progress,
+                        index,
+                        tier,
+                        destination,
+                        'hash' if verify else 'meta',
+                    )
+                else:
+                    func = functools.partial(
+                        self._rdiff_backup,
                         'restore',
                         ['--at', restore_time or "now"],
-                        path=p.pattern,
+                        path=path,
+                        on_line=progress.parse,
+                        shard=index,
+                        tier=tier,
+                        destination=destination,
+                    )
+                wait_for = [event for j, event in done.items() if keys[i].startswith(keys[j])]
+                done[i] = threading.Event()
+                sessions.append((name, functools.partial(self._restore_session, func, wait_for, done[i])))
+            with self._ssh_multiplexing(enabled=len(sessions) > 1 and not rdiffweb, destination=destination):
+                self._run_sessions(update_status, sessions, max_parallel=self.get_settings('max_parallel_restore'))
+
+    def _restore_sizes(self, sources, destination=None):
+        """
+        Return the size of each `(tier, (path, shard))` as known from the
+        backup, without reading the target: the files recorded in the
+        manifest of the last backup, the directories assigned to shards or
+        the size of the last session of the root, prorated by the number of
+        files of the path in the history index. Return 0 when unknown.
+        """
+        status = Status(self.status_file)
+        assignment = Shards(self.shards_file)
+        files = history.History(self.history_file)
+        roots = {}
+        manifests = {}
+        sizes = []
+        for tier, (path, index) in sources:
+            if tier not in roots:
+                roots[tier] = [drive for drive, unused in self.get_patterns(tier).group_by_roots()]
+            key = scan.normpath(path).rstrip('/')
+            root = next((r for r in roots[tier] if (key + '/').startswith(scan.normpath(r))), None)
+            if root is None:
+                sizes.append(0)
+                continue
+            if (root, index, tier) not in manifests:
+                manifest = scan.Manifest(self._manifest_file(root, index, tier, destination))
+                manifests[(root, index, tier)] = manifest.load()[2]
+            inside = lambda p: p == key or p.startswith(key + '/')  # noqa: E731
+            size = sum(v[0] for p, v in manifests[(root, index, tier)].items() if v and inside(p))
+            size = size or sum(s for p, (unused, s) in assignment.items() if inside(p))
+            if not size:
+                name = self._session_name(root, index, tier, destination)
+                size = status.previous_size(name) or 0
+                total = files.count(name, root)
+                if key + '/' != scan.normpath(root):
+                    size = size * files.count(name, key) // total if total else 0
+            sizes.append(size)
+        return sizes
+
+    def _restore_session(self, func, wait_for, done):
+        """
+        Execute the restore of a single path once the given events are set.
+        """
+        try:
+            for event in wait_for:
+                while not event.wait(1):
+                    if self._cancel_event.is_set():
+                        raise RdiffBackupException(_('restore interrupted'))
+            return func()
+        finally:
+            done.set()
+
+    def _restore_differential(self, path, restore_time, progress, shard=0, tier=None, destination=None, method='meta'):
+        """
+        Restore the files of the given path that differ from the backup
+        using `rdiff-backup compare`. Files only found locally are kept.
+        The differences are restored by a single rdiff-backup session.
+        Return a summary of the files restored and the bytes skipped.
+        """
+        func = functools.partial(self._rdiff_backup, shard=shard, tier=tier, destination=destination)
+        at = restore_time or "now"
+        if not os.path.isdir(path):
+            # Nothing to compare with.
+            func('restore', ['--at', at], path=path, on_line=progress.parse)
+            return None
+        root = scan.normpath(path).rstrip('/')
+        differences = []
+
+        def _on_line(line):
+            m = _COMPARE_REPORT.match(line.rstrip('\r\n'))
+            if m and m.group(1) != 'new' and m.group(2) != '.':
+                differences.append(root + '/' + m.group(2))
+
+        args = ['--exclude-symbolic-links' if IS_WINDOWS else '--exclude-sockets', '--method', method, '--at', at]
+        func('compare', args, path=path, on_line=_on_line)
+        # Existing directories with different metadata are ignored. The
+        # content of a missing directory is reported by the comparison.
+        targets = [p for p in sorted(differences) if not os.path.isdir(p)]
+        skipped = scan.du(path) - sum(scan.du(p) for p in targets)
+        if targets:
+            # rdiff-backup doesn't support file selection when restoring a
+            # sub-path of the repository. Restore from the repository root
+            # with the absolute path of each file in the filelist.
+            drive = root[:3] if IS_WINDOWS else '/'
+            with self._filelist(paths=targets) as filelist:
+                args = ['--at', at, '--include-filelist', filelist, '--exclude', '**']
+                func('restore', args, path=drive, on_line=progress.parse)
+        return _('%s files restored, %s identical skipped') % (len(targets), format_size(max(0, skipped)))
+
+    def _restore_http(self, rdiffweb, path, restore_time, progress, shard=0, tier=None, destination=None):
+        """
+        Download the given path from Rdiffweb and extract it on the fly.
+        """
+        config = self._get_destination(destination)
+        if not config.repositoryname:
+            raise NotConfiguredError()
+        repo_path = self._repository_path(config.repositoryname, path, shard, tier)
+
+        def _on_file(name):
+            if self._cancel_event.is_set():
+                raise RdiffBackupException(_('restore interrupted'))
+            progress.file(name)
+
+        request = functools.partial(rdiffweb.restore, repo_path, download.epoch(restore_time))
+        download.restore(request, path, on_file=_on_file)
+
+    def fetch_patterns(self, rdiffweb=None, restore_time=None, destination=None):
+        """
+        Return the list of patterns of the default tier as backup on the
+        server. Only the patterns file is restored into a temporary folder
+        using the SSH identity, or downloaded from Rdiffweb when a session
+        is given. Local configuration and status are left untouched.
+        """
+        config = self._get_destination(destination)
+        if not config.repositoryname:
+            raise NotConfiguredError()
+        tier = self._restore_tiers(self.patterns_file, self._tier_includes())[0]
+        assignment = {path: index for path, (index, unused) in Shards(self.shards_file).items()}
+        path, index = shard.sources(self.patterns_file, assignment)[0]
+        if rdiffweb is None:
+            with tempfile.TemporaryDirectory(prefix='patterns-', dir=compat.get_data_home()) as tmp:
+                target = os.path.join(tmp, os.path.basename(path))
+                self._rdiff_backup(
+                    'restore',
+                    ['--at', restore_time or 'now'],
+                    path=path,
+                    shard=index,
+                    tier=tier,
+                    destination=destination,
+                    target=target,
+                )
+                try:
+                    with open(target, encoding='utf-8', errors='replace') as f:
+                        return Patterns.parse(f.read().splitlines())
+                except FileNotFoundError:
+                    return []
+        repo_path = self._repository_path(config.repositoryname, path, index, tier)
+        with self._http_errors(config.remoteurl):
+            response = rdiffweb.restore(repo_path, download.epoch(restore_time))
+            return Patterns.parse(response.content.decode('utf-8', errors='replace').splitlines())
+
+    def _repositories(self):
+        """
+        Return the list of `(root, shard, tier)` of every repository
+        receiving the backup, including the repository of each shard.
+        """
+        assignment = Shards(self.shards_file)
+        repositories = []
+        for tier in self.get_tiers():
+            for root, unused in self.get_patterns(tier.name).group_by_roots():
+                prefix = scan.normpath(root).rstrip('/') + '/'
+                indexes = {0} | {index for path, (index, unused) in assignment.items() if path.startswith(prefix)}
+                repositories.extend((root, index, tier.name) for index in sorted(indexes))
+        return repositories
+
+    def update_history(self):
+        """
+        Update the local index of the backup history with the files of the
+        latest increment and return the `History`. Repositories without new
+        backup session since the last update are not listed.
+        """
+        status = Status(self.status_file)
+        destinations = [d.name for d in self.get_settings().destinations()]
+        repositories = []
+        for root, index, tier in self._repositories():
+            # Each destination is indexed according to its own last successful session.
+            for destination in destinations:
+                key = self._session_name(root, index, tier, destination)
+                lastsuccess = status.session_lastsuccess(key, tier)
+                repositories.append((key, root, index, tier, destination, int(lastsuccess) if lastsuccess else None))
+        index = history.History(self.history_file)
+        index.remove([r[0] for r in repositories])
+        outdated = [r for r in repositories if not index.is_current(r[0], r[5])]
+        for destination in destinations:
+            sessions = [r for r in outdated if r[4] == destination]
+            with self._ssh_multiplexing(enabled=len(sessions) > 0, destination=destination):
+                for key, root, shard_index, tier, destination, lastsuccess in sessions:
+                    list_func = functools.partial(
+                        self._list, path=root, shard=shard_index, tier=tier, destination=destination
                     )
+                    increments = history.parse_increments(list_func(['increments']))
+                    index.update(
+                        key,
+                        root,
+                        lastsuccess,
+                        increments,
+                        lambda epoch: history.parse_files(list_func(['files', '--at', str(epoch)])),
+                        destination=destination,
+                    )
+        index.save()
+        return index
+
+    def _list(self, extra_args, path, shard=0, tier=None, destination=None):
+        """
+        Return the lines printed by `rdiff-backup list`.
+        """
+        lines = []
+        self._rdiff_backup(
+            'list', extra_args, path=path, on_line=lines.append, shard=shard, tier=tier, destination=destination
+        )
+        return lines
+
+    def _tier_includes(self):
+        """
+        Return a dictionary with the folders included by each tier.
+        """
+        return {
+            t.name: [p.pattern for p in self.get_patterns(t.name) if p.include and not p.is_wildcard()]
+            for t in self.get_tiers()
+        }
+
+    def _restore_tiers(self, path, tiers):
+        """
+        Return the name of the tiers including the given path, something
+        inside it or one of its parents. Default to the default tier.
+        """
+        path = scan.normpath(path).rstrip('/') + '/'
+        found = []
+        for name, includes in tiers.items():
+            for include in includes:
+                include = scan.normpath(include).rstrip('/') + '/'
+                if include.startswith(path) or path.startswith(include):
+                    found.append(name)
+                    break
+        return found or [None]
 
     def schedule_job(self, run_if_logged_out=None):
         """
@@ -558,9 +1862,9 @@ class Backup:
         else:
             self.scheduler.create()
 
-    def set_patterns(self, patterns):
+    def set_patterns(self, patterns, tier=None):
         assert isinstance(patterns, list), 'patterns should be a list'
-        p = Patterns(self.patterns_file)
+        p = self.get_patterns(tier)
         p.clear()
         # Make sure patterns are uniq
         p.extend(patterns)
@@ -582,19 +1886,39 @@ class Backup:
         p = psutil.Process(pid)
         if not p.is_running():
             raise NotRunningError()
+        # The resident agent must survive, only the backup get interrupted.
+        from minarca_client.core.agent import Agent
+
+        agent_pid = Agent(self).get_pid()
+        # The fork server is kept to execute the next sessions of the agent.
+        try:
+            fork_pid = int(status['fork_pid'])
+        except (KeyError, TypeError, ValueError):
+            fork_pid = None
+        # On Windows, terminate() kills the process without signal handler.
+        # When the agent runs the backup, killing its children is enough.
+        kill_parent = not (IS_WINDOWS and pid == agent_pid)
         # Send appropriate signal
         logger.info('terminating process %s' % pid)
         try:
             # To terminate the backup, the best is to kill the SSH connection.
-            for child in p.children(recursive=True):
+            # Then terminate every rdiff-backup sessions that may run concurrently.
+            children = [c for c in p.children(recursive=True) if c.pid not in (agent_pid, fork_pid, os.getpid())]
+            for child in children:
                 if 'ssh.exe' in child.name() or 'ssh' in child.name():
                     child.terminate()
-            p.terminate()
+            for child in children:
+                try:
+                    child.terminate()
+                except NoSuchProcess:
+                    pass
+            if kill_parent:
+                p.terminate()
         except SystemError:
             logger.warn('error trying to stop minarca', exc_info=1)
         # Wait until process get killed
         count = 1
-        while p.is_running() and count < 10:
+        while kill_parent and p.is_running() and count < 10:
             time.sleep(0.1)
             count += 1
         # Replace status by INTERRUPT
@@ -605,18 +1929,28 @@ class Backup:
         status['details'] = ''
         status.save()
 
-    def test_server(self):
+    def test_server(self, destination=None):
         """
         Check connectivity to the remote server using rdiff-backup.
         """
         # Since v2.2.x, we need to pass an existing repository nave for test.
         # Otherwise the test fail if the folder doesn't exists on the remote server.
-        self._rdiff_backup('test')
+        if destination:
+            self._rdiff_backup('test', destination=destination)
+        else:
+            self._rdiff_backup('test')
 
-    def unlink(self):
+    def unlink(self, destination=None):
         """
-        Disconnect this client from minarca server.
+        Disconnect this client from minarca server. Set `destination` to
+        only remove an additional destination.
         """
+        if destination:
+            names = [d.name for d in self.get_settings().destinations()[1:]]
+            if destination not in names:
+                raise NotConfiguredError()
+            self.set_settings('destinations', ','.join(n for n in names if n != destination))
+            return
         self.set_settings('configured', False)
         # Remove scheduler
         self.scheduler.delete()
@@ -627,6 +1961,11 @@ class Rdiffweb:
         # Create HTTP Session using authentication
         assert username
         assert password
+        # Lazy import, requests is slow to import.
+        import requests
+        from requests.compat import urljoin
+        from requests.exceptions import ConnectionError
+
         self.username = username
         self.session = requests.Session()
         self.session.allow_redirects = False
@@ -654,6 +1993,24 @@ class Rdiffweb:
         self.raise_for_status(response)
         return response.json()
 
+    def restore(self, repo_path, date, offset=0):
+        """
+        Return the streamed response of the given path restored at the
+        given epoch. A directory is returned as a tar archive. Set `offset`
+        to resume an interrupted download.
+        """
+        from requests.utils import quote
+
+        headers = {'Range': 'bytes=%d-' % offset} if offset else {}
+        response = self.session.get(
+            self.remote_url + 'restore/%s/%s' % (quote(self.username), quote(repo_path.strip('/'))),
+            params={'date': date, 'kind': 'tar'},
+            headers=headers,
+            stream=True,
+        )
+        self.raise_for_status(response)
+        return response
+
     def get_minarca_info(self):
         """
         Return a dict with `version`, `remotehost`, `identity`
@@ -691,4 +2048,6 @@ class Rdiffweb:
             http_error_msg = f"{response.status_code} Server Error: {reason} for url: {response.url}"
 
         if http_error_msg:
+            from requests.exceptions import HTTPError
+
             raise HTTPError(http_error_msg, response=response)
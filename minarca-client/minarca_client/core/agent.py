@@ -0,0 +1,176 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+'''
+Resident agent running backups at the exact time they are due.
+
+When enabled, the agent replace the execution of `minarca backup` every 15
+minutes by the OS scheduler. The agent keep settings and status in memory,
+compute the next due time and sleep until then. The OS scheduler entry is
+only used as a watchdog to restart the agent when it's not running.
+'''
+import contextlib
+import datetime
+import logging
+import os
+import signal
+import threading
+
+import psutil
+
+from minarca_client.core import Backup, journal
+from minarca_client.core.compat import get_data_home
+from minarca_client.core.config import Datetime
+from minarca_client.core.exceptions import AgentRunningError, BackupError
+
+logger = logging.getLogger(__name__)
+
+# Maximum time to sleep before checking for settings or status changes.
+_POLL_DELAY = 60
+
+# Time to wait before retrying a failed backup. Same as the OS scheduler.
+_RETRY_DELAY = 15 * 60
+
+
+class _BackupInterrupted(BaseException):
+    """
+    Raised in the main thread to interrupt the running backup.
+    """
+
+    pass
+
+
+class Agent:
+    def __init__(self, backup=None):
+        self.backup = backup or Backup()
+        self.pid_file = os.path.join(get_data_home(), 'agent.pid')
+        self._stop_event = threading.Event()
+        self._running_backup = False
+        self._watcher = None
+
+    def get_pid(self):
+        """
+        Return the pid of the running agent or None.
+        """
+        try:
+            with open(self.pid_file, 'r') as f:
+                pid = int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+        try:
+            if psutil.Process(pid).is_running():
+                return pid
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+        return None
+
+    def is_running(self):
+        """
+        Return True if an agent is running.
+        """
+        return self.get_pid() is not None
+
+    def _create_pid_file(self):
+        """
+        Create the pid file or raise AgentRunningError if another agent
+        owns it. The file is created exclusively so two agents starting
+        at the same time cannot both own it.
+        """
+        for unused in range(2):
+            try:
+                fd = os.open(self.pid_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                pid = self.get_pid()
+                if pid and pid != os.getpid():
+                    raise AgentRunningError(pid)
+                # Left behind by an agent that died, replace it.
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(self.pid_file)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(str(os.getpid()))
+            return
+        raise AgentRunningError(self.get_pid())
+
+    def next_run_delay(self):
+        """
+        Return the number of seconds until next backup.
+        """
+        next_time = self.backup.next_backup_time()
+        # Wait before retrying a failed backup.
+        status = self.backup.get_status()
+        if status['lastresult'] in ['FAILURE', 'INTERRUPT'] and status['lastdate']:
+            next_time = max(next_time, status['lastdate'] + datetime.timedelta(seconds=_RETRY_DELAY))
+        return max(0, (next_time.epoch_ms - Datetime().epoch_ms) / 1000)
+
+    def run(self):
+        """
+        Run until stopped.
+        """
+        self._create_pid_file()
+        signal.signal(signal.SIGTERM, self._terminate)
+        logger.info('agent started')
+        # Before starting the watcher thread.
+        self.backup.start_fork_server()
+        try:
+            while not self._stop_event.is_set():
+                self._update_watcher()
+                delay = self.next_run_delay()
+                if delay > 0 or not self.backup.is_linked() or self.backup.is_running():
+                    # Sleep until the next backup. Wake up regularly to
+                    # consider modification of settings or status.
+                    self._stop_event.wait(min(delay or _POLL_DELAY, _POLL_DELAY))
+                    continue
+                self._run_backup()
+                # Avoid a busy loop if the backup didn't update the status.
+                if self.next_run_delay() <= 0:
+                    self._stop_event.wait(_POLL_DELAY)
+        finally:
+            self._stop_watcher()
+            if self.get_pid() == os.getpid():
+                os.remove(self.pid_file)
+            logger.info('agent stopped')
+
+    def _update_watcher(self):
+        """
+        Start or stop the watcher according to settings and patterns.
+        """
+        settings = self.backup.get_settings()
+        roots = None
+        if settings['watch_changes'] and settings['skip_unchanged']:
+            roots = self.backup.get_watched_roots()
+        if self._watcher and self._watcher.roots == roots:
+            return
+        self._stop_watcher()
+        if roots:
+            self._watcher = journal.create_watcher(journal.Journal(self.backup.journal_file), roots)
+            self._watcher.start()
+
+    def _stop_watcher(self):
+        if self._watcher:
+            self._watcher.stop()
+            self._watcher.join()
+            self._watcher = None
+
+    def _run_backup(self):
+        self._running_backup = True
+        try:
+            self.backup.backup()
+        except BackupError as e:
+            logger.info(str(e))
+        except _BackupInterrupted:
+            logger.info('backup interrupted')
+        except Exception:
+            logger.exception("unexpected error during backup")
+        finally:
+            self._running_backup = False
+
+    def _terminate(self, signum, frame):
+        # When a backup is running, `minarca stop` only interrupt the backup.
+        if self._running_backup:
+            self._running_backup = False
+            raise _BackupInterrupted()
+        self.stop()
+
+    def stop(self):
+        self._stop_event.set()
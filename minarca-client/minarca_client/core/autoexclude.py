@@ -0,0 +1,153 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+'''
+Automatic exclusion of caches and build artifacts.
+
+Before a backup, the files returned by the scan are used to detect
+directories that could be regenerated: dependencies (node_modules,
+virtualenv), build output (target), compiled files (__pycache__), browser
+caches and directories tagged with `CACHEDIR.TAG`. Detection is based on the name of the directory
+and marker files inside the directory or next to it, never on the name
+alone for generic names like `target`.
+
+Detected directories are excluded from the backup unless a include pattern
+explicitly select them or something inside them.
+'''
+import bisect
+import logging
+import os
+import re
+from collections import namedtuple
+
+from minarca_client.core import scan
+from minarca_client.core.compat import IS_WINDOWS
+from minarca_client.core.config import Pattern
+
+logger = logging.getLogger(__name__)
+
+# See https://bford.info/cachedir/
+_CACHEDIR_SIGNATURE = b'Signature: 8a477f597d28d172789f06886806bc55'
+
+# A directory matches a rule when its name match `name` (any name if None),
+# when it contains one of the `inside` files and when its parent contains one of
+# the `sibling` files. Empty lists are ignored.
+Rule = namedtuple('Rule', ['id', 'name', 'inside', 'sibling'])
+
+RULES = [
+    Rule('cachedir-tag', None, ['CACHEDIR.TAG'], []),
+    Rule('node-modules', 'node_modules', [], ['package.json']),
+    Rule('python-venv', None, ['pyvenv.cfg'], []),
+    Rule('python-cache', '__pycache__', [], []),
+    Rule('cargo-target', 'target', [], ['Cargo.toml']),
+    Rule('maven-target', 'target', [], ['pom.xml']),
+    Rule('gradle-cache', '.gradle', [], ['build.gradle', 'build.gradle.kts', 'settings.gradle']),
+    Rule('firefox-cache', 'cache2', ['entries'], []),
+    Rule('chrome-cache', 'Cache_Data', ['index'], []),
+]
+
+# Result of the detection.
+Detected = namedtuple('Detected', ['path', 'rule', 'size'])
+
+
+def _is_cachedir_tag(path):
+    try:
+        with open(os.path.join(path, 'CACHEDIR.TAG'), 'rb') as f:
+            return f.read(len(_CACHEDIR_SIGNATURE)) == _CACHEDIR_SIGNATURE
+    except OSError:
+        return False
+
+
+def _match(rules, path, names, siblings):
+    """
+    Return the first rule matching the given directory.
+    """
+    name = os.path.basename(path)
+    for rule in rules:
+        if rule.name is not None and rule.name != name:
+            continue
+        if rule.inside and not any(n in names for n in rule.inside):
+            continue
+        if rule.sibling and not any(n in siblings for n in rule.sibling):
+            continue
+        if rule.id == 'cachedir-tag' and not _is_cachedir_tag(path):
+            continue
+        return rule
+    return None
+
+
+def _overridden(path, patterns):
+    """
+    Return True if a include pattern select the given directory
+    explicitly or something inside it.
+    """
+    prefix = path + '/'
+    for p in patterns:
+        if not p.include:
+            continue
+        pattern = scan.normpath(p.pattern).rstrip('/')
+        if p.is_wildcard():
+            if re.match('^' + scan.glob_to_regex(pattern) + '$', path, re.IGNORECASE if IS_WINDOWS else 0):
+                return True
+        elif pattern == path or pattern.startswith(prefix):
+            return True
+    return False
+
+
+def detect(root, patterns, entries, rules=RULES):
+    """
+    Return the list of `Detected` directories that could be excluded from
+    the entries returned by `scan.scan()` for the given patterns. Directories
+    selected explicitly by a include pattern are ignored. The size of each
+    directory is computed from the entries.
+    """
+    prefix = scan.normpath(root).rstrip('/') + '/'
+    children = {}
+    for path in entries:
+        parent, unused, name = path.rpartition('/')
+        children.setdefault(parent or '/', set()).add(name)
+    paths = sorted(entries)
+    detected = {}
+    for path in sorted(children):
+        if not path.startswith(prefix) or _inside(path, detected):
+            continue
+        rule = _match(rules, path, children[path], children.get(path.rpartition('/')[0] or '/', set()))
+        if rule and _overridden(path, patterns):
+            logger.debug('%s not excluded, selected by include pattern', path)
+        elif rule:
+            inside = paths[bisect.bisect_left(paths, path + '/') : bisect.bisect_left(paths, path + '0')]
+            size = sum(entries[p][0] for p in inside if entries[p] and p not in children)
+            detected[path] = Detected(path, rule, size)
+    return list(detected.values())
+
+
+def _inside(path, detected):
+    """
+    Return True if one of the parents of the path was detected.
+    """
+    parent = path.rpartition('/')[0]
+    while parent:
+        if parent in detected:
+            return True
+        parent = parent.rpartition('/')[0]
+    return False
+
+
+def exclude_entries(entries, detected):
+    """
+    Return a copy of the entries without the detected directories and their content.
+    """
+    if not detected:
+        return entries
+    paths = {d.path for d in detected}
+    prefixes = tuple(d.path + '/' for d in detected)
+    return {p: values for p, values in entries.items() if p not in paths and not p.startswith(prefixes)}
+
+
+def exclude(patterns, detected):
+    """
+    Return a copy of the patterns with the detected directories excluded.
+    Exclude patterns are defined first, so they take precedence over the
+    patterns including their parent directories.
+    """
+    return [Pattern(False, scan.escape(d.path), None) for d in detected] + list(patterns)
@@ -17,8 +17,6 @@ import tempfile
 from logging import FileHandler
 from logging.handlers import RotatingFileHandler
 
-import pkg_resources
-
 from minarca_client.locale import _
 
 IS_WINDOWS = os.name == 'nt'
@@ -148,7 +146,7 @@ def _get_path():
     path = os.environ.get('PATH', 'C:\\Windows\\system32' if IS_WINDOWS else '/usr/bin')
     path = os.path.dirname(sys.executable) + os.pathsep + path
     if IS_WINDOWS:
-        ssh_path = pkg_resources.resource_filename(__name__, 'openssh\\win_%s' % platform.machine().lower())
+        ssh_path = os.path.join(os.path.dirname(__file__), 'openssh', 'win_%s' % platform.machine().lower())
         path = ssh_path + os.pathsep + path
     return path
 
@@ -158,7 +156,9 @@ def get_rdiff_backup_version():
     Return the version of rdiff-backup
     """
     try:
-        return pkg_resources.get_distribution("rdiff-backup").version
+        from minarca_client import _get_version
+
+        return _get_version("rdiff-backup")
     except Exception:
         return 'unknown'
 
@@ -195,7 +195,7 @@ def get_temp():
 
 
 def get_user_agent():
-    from minarca_client.main import __version__
+    from minarca_client import __version__
 
     return "minarca/{minarca_version} rdiff-backup/{rdiff_backup_version} ({os_name} {os_version} {os_arch})".format(
         minarca_version=__version__,
@@ -427,10 +427,12 @@ if IS_MAC:
     Scheduler = MacScheduler
 
 if IS_LINUX:
-    from crontab import CronTab
 
     class CrontabScheduler:
         def __init__(self):
+            # Lazy import, python-crontab is slow to import.
+            from crontab import CronTab
+
             self.cron = CronTab(user=True)
             minarca = get_minarca_exe()
             assert minarca
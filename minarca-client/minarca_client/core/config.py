@@ -6,18 +6,35 @@ Created on Jun. 8, 2021
 
 @author: Patrik Dufresne <patrik@ikus-soft.com>
 '''
+import contextlib
+import copy
 import datetime
+import logging
 import os
 import re
+import tempfile
+import threading
 import time
 from collections import namedtuple
 from functools import total_ordering
 
 import javaproperties
+import psutil
 
+from minarca_client.core import scan
 from minarca_client.core.compat import IS_LINUX, IS_MAC, IS_WINDOWS, get_config_home, get_home, get_temp
 from minarca_client.locale import _
 
+logger = logging.getLogger(__name__)
+
+_RUNNING_DELAY = 5  # 5 seconds
+
+_PID_TTL = 2  # Seconds to remember if a process is running.
+
+_RACY_DELAY = 2  # Seconds during which a file signature could not be trusted.
+
+_REPLACE_RETRY = 10  # Number of attempts to replace a file opened by another process.
+
 
 @total_ordering
 class Datetime:
@@ -60,6 +77,52 @@ class Datetime:
         raise ValueError()
 
 
+def _file_signature(filename):
+    """
+    Return a signature of the given file to detect modification or None if
+    the file doesn't exists. A file modified very recently may get modified
+    again without changing the signature, so None is also returned in that
+    case to force the file to be read again.
+    """
+    try:
+        s = os.stat(filename)
+    except OSError:
+        return None
+    if time.time() - s.st_mtime_ns / 1e9 <= _RACY_DELAY:
+        return None
+    return (s.st_mtime_ns, s.st_size, s.st_ino)
+
+
+@contextlib.contextmanager
+def _atomic_write(filename, encoding):
+    """
+    Open a temporary file for writing and replace the given file once
+    completed. Reader never see a partially written file.
+    """
+    dirname, basename = os.path.split(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(prefix='.' + basename + '.', suffix='.tmp', dir=dirname)
+    try:
+        with open(fd, 'w', encoding=encoding) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        # On Windows, replace fail while the file is opened by a reader.
+        for retry in range(_REPLACE_RETRY, -1, -1):
+            try:
+                os.replace(tmp, filename)
+                break
+            except PermissionError:
+                if not retry:
+                    raise
+                time.sleep(0.05)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
 class Status(dict):
     """
     Used to persists backup status.
@@ -82,11 +145,106 @@ class Status(dict):
 
     def save(self):
         values = {
-            k: str(int(v)) if k in ['lastdate', 'lastsuccess'] else str(v) for k, v in self.items() if v is not None
+            k: str(int(v)) if k in ['lastdate', 'lastsuccess'] or k.endswith('.lastsuccess') else str(v)
+            for k, v in self.items()
+            if v is not None
         }
-        with open(self.filename, 'w', encoding='latin-1') as f:
+        with _atomic_write(self.filename, encoding='latin-1') as f:
             return javaproperties.dump(values, f)
 
+    def sessions(self):
+        """
+        Return a list of (name, lastresult, details) for each rdiff-backup
+        session (e.g.: each root) of the last execution.
+        """
+        return [
+            (key[len('lastresult.') :], value, self.get('details.' + key[len('lastresult.') :]) or '')
+            for key, value in sorted(self.items())
+            if key.startswith('lastresult.')
+        ]
+
+    def progress(self, name):
+        """
+        Return the progress of the given running session as a dict with
+        `files`, `bytes`, `path`, `rate` and `eta` or None if not available.
+        """
+        prefix = 'progress.%s.' % name
+        if prefix + 'files' not in self:
+            return None
+        progress = {}
+        for key in ['files', 'bytes', 'rate', 'eta']:
+            try:
+                progress[key] = int(self[prefix + key])
+            except (ValueError, TypeError, KeyError):
+                progress[key] = None
+        progress['path'] = self.get(prefix + 'path')
+        return progress
+
+    def previous_elapsed(self, name):
+        """
+        Return the duration in seconds of the last successful session or None.
+        """
+        try:
+            return float(self['stats.%s.elapsed' % name])
+        except (ValueError, TypeError, KeyError):
+            return None
+
+    def tier_lastsuccess(self, tier):
+        """
+        Return the time of the last successful backup of the given tier or
+        None. The default tier is identified by None.
+        """
+        if not tier:
+            return self['lastsuccess']
+        try:
+            return Datetime(self['tier.%s.lastsuccess' % tier])
+        except (ValueError, TypeError, KeyError):
+            return None
+
+    def session_lastsuccess(self, name, tier=None):
+        """
+        Return the time of the last successful backup session (e.g.: of a
+        root to a destination). When not recorded, fall back to the last
+        success of the tier, every sessions being successful at that time.
+        """
+        try:
+            return Datetime(self['stats.%s.lastsuccess' % name])
+        except (ValueError, TypeError, KeyError):
+            return self.tier_lastsuccess(tier)
+
+    def tier_result(self, tier):
+        """
+        Return `(lastresult, details)` of the last execution of the given
+        tier. The default tier is identified by None.
+        """
+        prefix = 'tier.%s.' % tier if tier else 'tier.'
+        return self.get(prefix + 'lastresult') or 'UNKNOWN', self.get(prefix + 'details') or ''
+
+    def tier_sessions(self, tier):
+        """
+        Return the name of the sessions of the last execution of the given tier.
+        """
+        value = self.get('tier.%s.sessions' % tier if tier else 'tier.sessions') or ''
+        return [name for name in value.split(',') if name]
+
+    def previous_size(self, name):
+        """
+        Return the size in bytes of the files selected by the last successful session or None.
+        """
+        try:
+            return int(self['stats.%s.size' % name])
+        except (ValueError, TypeError, KeyError):
+            return None
+
+    def previous_rate(self, name):
+        """
+        Return the transfer rate in bytes per seconds of the last successful session or None.
+        """
+        try:
+            return int(self['stats.%s.rate' % name])
+        except (ValueError, TypeError, KeyError):
+            return None
+
     def _load(self):
         self.clear()
         self.update(self._DEFAULT)
@@ -103,6 +261,105 @@ class Status(dict):
                         self[field] = None
 
 
+class StatusStore:
+    """
+    Keep the backup status in memory. The status file is parsed again only when
+    its modification time, size or inode changed. Provide the interpretation of
+    the status: a RUNNING backup is reported as INTERRUPT if the process is not
+    running or STALE if the status didn't get updated recently.
+    """
+
+    def __init__(self, filename):
+        assert filename
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._signature = None
+        self._status = None
+        self._pid = None
+        self._pid_running = False
+        self._pid_expire = 0
+        self._last = None
+        self._subscribers = []
+
+    def _load(self):
+        """
+        Return the raw status. Parse the status file only if it changed.
+        """
+        signature = _file_signature(self.filename)
+        if self._status is None or signature is None or signature != self._signature:
+            self._status = Status(self.filename)
+            self._signature = signature
+        return self._status
+
+    def _is_pid_running(self, pid):
+        """
+        Check if the given process is running. Result is kept for a short period.
+        """
+        now = time.monotonic()
+        if pid == self._pid and now < self._pid_expire:
+            return self._pid_running
+        try:
+            running = bool(pid) and psutil.Process(int(pid)).is_running()
+        except (ValueError, psutil.NoSuchProcess, psutil.AccessDenied):
+            running = False
+        self._pid, self._pid_running, self._pid_expire = pid, running, now + _PID_TTL
+        return running
+
+    def get(self):
+        """
+        Return a copy of the current status.
+        """
+        with self._lock:
+            status = copy.copy(self._load())
+            # After reading the status file, let determine the real status.
+            if status['lastresult'] == 'RUNNING':
+                if not self._is_pid_running(status['pid']):
+                    status['lastresult'] = 'INTERRUPT'
+                elif status['lastdate'] and Datetime() - status['lastdate'] > datetime.timedelta(
+                    seconds=_RUNNING_DELAY * 2
+                ):
+                    status['lastresult'] = 'STALE'
+            changed = self._last is not None and self._last != status
+            self._last = status
+            subscribers = list(self._subscribers) if changed else []
+        for callback in subscribers:
+            try:
+                callback(copy.copy(status))
+            except Exception:
+                logger.exception('status subscriber raised an exception')
+        return status
+
+    def poll(self):
+        """
+        Check the status file and notify subscribers if the status changed.
+        """
+        self.get()
+
+    def subscribe(self, callback):
+        """
+        Register a callback to be called with the new status whenever the
+        status changed. Return a function to unregister the callback.
+        """
+        with self._lock:
+            self._subscribers.append(callback)
+            if self._last is None:
+                self.get()
+
+        def unsubscribe():
+            with self._lock:
+                if callback in self._subscribers:
+                    self._subscribers.remove(callback)
+
+        return unsubscribe
+
+
+# A group of patterns backup on its own schedule into its own repository.
+Tier = namedtuple('Tier', ['name', 'schedule'])
+
+# A minarca server receiving the backup. The primary destination has no name.
+Destination = namedtuple('Destination', ['name', 'remotehost', 'remoteurl', 'username', 'repositoryname'])
+
+
 class Settings(dict):
     """
     Used to store minarca settings in `minarca.properties`
@@ -121,6 +378,31 @@ class Settings(dict):
         'schedule': DAILY,
         'configured': False,
         'pause_until': None,
+        # Maximum number of rdiff-backup sessions to run concurrently.
+        'max_parallel': 1,
+        # Maximum number of rdiff-backup sessions to run concurrently during a restore.
+        'max_parallel_restore': 4,
+        # Share a single SSH connection between rdiff-backup sessions. Not supported by ssh.exe on Windows.
+        'ssh_multiplexing': not IS_WINDOWS,
+        # Run backups from the resident agent instead of the OS scheduler.
+        'agent': False,
+        # Split each root into this number of repositories backup concurrently.
+        'shards': 1,
+        # Comma separated list of tiers, highest priority first. Each tier has its
+        # own patterns, its own schedule `tier.<name>.schedule` and its own repository.
+        'tiers': '',
+        # Comma separated list of additional destinations linked with this computer. Each
+        # destination is defined by `destination.<name>.remotehost`, `remoteurl`,
+        # `username` and `repositoryname`.
+        'destinations': '',
+        # Engine used to execute rdiff-backup: `subprocess` or `fork` (POSIX only).
+        'engine': 'subprocess',
+        # Skip rdiff-backup session when local files didn't changed since last backup.
+        'skip_unchanged': False,
+        # Watch local files from the agent to only scan modified directories. Require `skip_unchanged`.
+        'watch_changes': False,
+        # Exclude caches and build artifacts detected before each backup.
+        'auto_exclude': False,
         # Load default value from environment variable to ease unittest
         'check_latest_version': os.environ.get('MINARCA_CHECK_LATEST_VERSION', 'True') in [True, 'true', 'True', '1'],
     }
@@ -130,9 +412,42 @@ class Settings(dict):
         self.filename = filename
         self._load()
 
+    def tiers(self):
+        """
+        Return the list of `Tier` defined in settings, highest priority first.
+        """
+        result = []
+        for name in self['tiers'].split(','):
+            name = name.strip()
+            if not name:
+                continue
+            try:
+                schedule = int(self['tier.%s.schedule' % name])
+            except (ValueError, KeyError):
+                schedule = self['schedule']
+            result.append(Tier(name, schedule))
+        return result
+
+    def destinations(self):
+        """
+        Return the list of `Destination`, the primary destination first.
+        """
+        result = [Destination(None, self['remotehost'], self['remoteurl'], self['username'], self['repositoryname'])]
+        for name in self['destinations'].split(','):
+            name = name.strip()
+            if not name:
+                continue
+            result.append(
+                Destination(
+                    name,
+                    *[self.get('destination.%s.%s' % (name, k)) for k in Destination._fields[1:]],
+                )
+            )
+        return result
+
     def save(self):
         values = {k: str(int(v)) if k in ['pause_until'] else str(v) for k, v in self.items() if v is not None}
-        with open(self.filename, 'w', encoding='latin-1') as f:
+        with _atomic_write(self.filename, encoding='latin-1') as f:
             return javaproperties.dump(values, f)
 
     def _load(self):
@@ -142,13 +457,22 @@ class Settings(dict):
             return
         with open(self.filename, 'r', encoding='latin-1') as f:
             self.update(javaproperties.load(f))
-            # schedule is an integer
-            try:
-                self['schedule'] = int(self['schedule'])
-            except (ValueError, KeyError):
-                self['schedule'] = self._DEFAULT.get('schedule')
+            # integer fields
+            for key in ['schedule', 'max_parallel', 'max_parallel_restore', 'shards']:
+                try:
+                    self[key] = int(self[key])
+                except (ValueError, KeyError):
+                    self[key] = self._DEFAULT.get(key)
             # boolean fields
-            for key in ['configured', 'check_latest_version']:
+            for key in [
+                'configured',
+                'check_latest_version',
+                'ssh_multiplexing',
+                'agent',
+                'skip_unchanged',
+                'watch_changes',
+                'auto_exclude',
+            ]:
                 try:
                     self[key] = self[key] in [True, 'true', 'True', '1']
                 except KeyError:
@@ -160,6 +484,43 @@ class Settings(dict):
                 self['pause_until'] = None
 
 
+class SettingsStore:
+    """
+    Keep the settings in memory. The settings file is parsed again only when
+    it get modified. Multiple values could be updated with a single write.
+    """
+
+    def __init__(self, filename):
+        assert filename
+        self.filename = filename
+        self._lock = threading.RLock()
+        self._signature = None
+        self._settings = None
+
+    def get(self):
+        """
+        Return a copy of the current settings.
+        """
+        with self._lock:
+            signature = _file_signature(self.filename)
+            if self._settings is None or signature is None or signature != self._signature:
+                self._settings = Settings(self.filename)
+                self._signature = signature
+            return copy.copy(self._settings)
+
+    def update(self, values):
+        """
+        Update multiple settings with a single write.
+        """
+        with self._lock:
+            # Always read the file to avoid overwriting values written by another process.
+            settings = Settings(self.filename)
+            settings.update(values)
+            settings.save()
+            self._settings = settings
+            self._signature = None
+
+
 class InvalidPatternError(Exception):
     """
     Raised when a pattern file contains an invalid line.
@@ -169,46 +530,125 @@ class InvalidPatternError(Exception):
 
 
 Pattern = namedtuple('Pattern', ['include', 'pattern', 'comment'])
+
+_DRIVE_PATTERN = re.compile('^[A-Z]:(\\\\|/)')
 Pattern.is_wildcard = lambda self: '*' in self.pattern or '?' in self.pattern or '[' in self.pattern
 
 
-class Patterns(list):
+class Shards(dict):
+    """
+    Used to persist the shard assigned to each directory of a sharded root
+    with its size from the last backup. Required to restore the data.
+    """
+
     def __init__(self, filename):
         assert filename
         self.filename = filename
         self._load()
 
+    def save(self):
+        values = {path: '%d %d' % (shard, size) for path, (shard, size) in self.items()}
+        with _atomic_write(self.filename, encoding='latin-1') as f:
+            return javaproperties.dump(values, f)
+
     def _load(self):
         self.clear()
         if not os.path.exists(self.filename):
             return
-        with open(self.filename, 'r', encoding='utf-8', errors='replace') as f:
-            comment = None
-            for line in f.readlines():
-                line = line.rstrip()
-                # Skip comment
-                if line.startswith("#") or not line.strip():
-                    comment = line[1:].strip()
-                    continue
-                if line[0] not in ['+', '-']:
-                    raise InvalidPatternError(line)
-                include = line[0] == '+'
+        with open(self.filename, 'r', encoding='latin-1') as f:
+            for path, value in javaproperties.load(f).items():
                 try:
-                    self.append(Pattern(include, line[1:], comment))
+                    shard, size = value.split()
+                    self[path] = (int(shard), int(size))
                 except ValueError:
-                    # Ignore duplicate pattern
                     pass
-                comment = None
+
+
+class Patterns(list):
+    """
+    List of include/exclude patterns stored in `patterns` file. Patterns are
+    stored in an insertion-ordered index by value to replace duplicates in
+    constant time. The list is a view of the index, rebuilt on first access
+    after a duplicate got replaced. Result of `group_by_roots()` is kept
+    until the list get modified.
+    """
+
+    def __init__(self, filename):
+        assert filename
+        self.filename = filename
+        self._index = {}
+        self._stale = False
+        self._roots = None
+        self._selections = None
+        self._load()
+
+    def _load(self):
+        self.clear()
+        if not os.path.exists(self.filename):
+            return
+        with open(self.filename, 'r', encoding='utf-8', errors='replace') as f:
+            patterns = self.parse(f.readlines())
+        super().extend(patterns)
+        self._index = {p.pattern: p for p in patterns}
+
+    @staticmethod
+    def parse(lines):
+        """
+        Return the list of `Pattern` defined by the given lines. Keep the
+        last occurrence of each pattern.
+        """
+        index = {}
+        comment = None
+        for line in lines:
+            line = line.rstrip()
+            # Skip comment
+            if line.startswith("#") or not line.strip():
+                comment = line[1:].strip()
+                continue
+            if line[0] not in ['+', '-']:
+                raise InvalidPatternError(line)
+            include = line[0] == '+'
+            index.pop(line[1:], None)
+            index[line[1:]] = Pattern(include, line[1:], comment)
+            comment = None
+        return list(index.values())
+
+    def _sync(self):
+        """
+        Rebuild the list from the index when a duplicate got replaced.
+        """
+        if self._stale:
+            self._stale = False
+            super().clear()
+            super().extend(self._index.values())
+
+    def _changed(self, reindex=True):
+        """
+        Called when the list get modified.
+        """
+        self._roots = None
+        self._selections = None
+        if reindex:
+            self._index = None
+
+    def _get_index(self):
+        if self._index is None:
+            self._index = {p.pattern: p for p in self}
+        return self._index
 
     def append(self, p):
         """
         Check for duplicate pattern.
         """
-        # Make sure to remove opposite pattern
-        for item in self:
-            if item.pattern == p.pattern:
-                self.remove(item)
-        super().append(p)
+        # Make sure to remove opposite pattern. The list is rebuilt from the
+        # index when needed to avoid a linear search for every duplicate.
+        index = self._get_index()
+        if index.pop(p.pattern, None) is not None:
+            self._stale = True
+        if not self._stale:
+            super().append(p)
+        index[p.pattern] = p
+        self._changed(reindex=False)
 
     def extend(self, other_patterns):
         """
@@ -217,6 +657,124 @@ class Patterns(list):
         for p in other_patterns:
             self.append(p)
 
+    def __iadd__(self, other_patterns):
+        self.extend(other_patterns)
+        return self
+
+    def clear(self):
+        super().clear()
+        self._index = {}
+        self._stale = False
+        self._changed(reindex=False)
+
+    def remove(self, p):
+        self._sync()
+        super().remove(p)
+        self._changed()
+
+    def insert(self, i, p):
+        self._sync()
+        super().insert(i, p)
+        self._changed()
+
+    def pop(self, i=-1):
+        self._sync()
+        value = super().pop(i)
+        self._changed()
+        return value
+
+    def sort(self, *args, **kwargs):
+        self._sync()
+        super().sort(*args, **kwargs)
+        self._changed()
+
+    def reverse(self):
+        self._sync()
+        super().reverse()
+        self._changed()
+
+    def __setitem__(self, i, p):
+        self._sync()
+        super().__setitem__(i, p)
+        self._changed()
+
+    def __delitem__(self, i):
+        self._sync()
+        super().__delitem__(i)
+        self._changed()
+
+    def __iter__(self):
+        self._sync()
+        return super().__iter__()
+
+    def __reversed__(self):
+        self._sync()
+        return super().__reversed__()
+
+    def __len__(self):
+        self._sync()
+        return super().__len__()
+
+    def __getitem__(self, i):
+        self._sync()
+        if isinstance(i, slice):
+            return self._derive(super().__getitem__(i))
+        return super().__getitem__(i)
+
+    def __eq__(self, other):
+        self._sync()
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        self._sync()
+        return super().__ne__(other)
+
+    def __repr__(self):
+        self._sync()
+        return super().__repr__()
+
+    def __add__(self, other):
+        self._sync()
+        return super().__add__(other)
+
+    def index(self, *args):
+        self._sync()
+        return super().index(*args)
+
+    def count(self, p):
+        self._sync()
+        return super().count(p)
+
+    def copy(self):
+        self._sync()
+        return self._derive(self)
+
+    def __copy__(self):
+        return self.copy()
+
+    def _derive(self, patterns):
+        """
+        Return new `Patterns` of the same file with the given patterns and
+        its own index.
+        """
+        other = Patterns.__new__(Patterns)
+        other.filename = self.filename
+        other._stale = False
+        other._roots = None
+        other._selections = None
+        super(Patterns, other).extend(patterns)
+        other._index = {p.pattern: p for p in other}
+        return other
+
+    def __contains__(self, p):
+        """
+        Return True if the pattern is part of the list. Accept a Pattern or a
+        string.
+        """
+        if isinstance(p, str):
+            return p in self._get_index()
+        return self._get_index().get(p.pattern) == p
+
     def defaults(self):
         """
         Restore defaults patterns.
@@ -268,7 +826,7 @@ class Patterns(list):
             )
 
     def save(self):
-        with open(self.filename, 'w', encoding='utf-8') as f:
+        with _atomic_write(self.filename, encoding='utf-8') as f:
             self.write(f)
 
     def write(self, f):
@@ -286,12 +844,18 @@ class Patterns(list):
         Return the list of patterns for each root. On linux, we have a single root. On Windows,
         we might have multiple if the computer has multiple disk, like C:, D:, etc.
         """
+        if self._roots is None:
+            self._roots = self._group_by_roots()
+        # Return a copy to avoid modification of the cached value.
+        return iter([(prefix, list(sublist)) for prefix, sublist in self._roots])
+
+    def _group_by_roots(self):
         # Determine each prefix.
         if IS_WINDOWS:
             # On Windows, Find list of drives from patterns
             prefixes = list()
             for p in self:
-                m = re.match('^[A-Z]:(\\\\|/)', p.pattern)
+                m = _DRIVE_PATTERN.match(p.pattern)
                 if p.include and m:
                     drive = m.group(0).replace('\\', '/')
                     if drive not in prefixes:
@@ -301,6 +865,7 @@ class Patterns(list):
             prefixes = ['/']
 
         # Organize patterns
+        roots = []
         if len(self):
             for prefix in prefixes:
                 sublist = []
@@ -323,4 +888,18 @@ class Patterns(list):
                         p.pattern,
                     ),
                 )
-                yield (prefix, sublist)
+                roots.append((prefix, sublist))
+        return roots
+
+    def is_included(self, path):
+        """
+        Return True if the given file is selected for backup. Evaluated in a
+        time proportional to the depth of the path.
+        """
+        if self._selections is None:
+            self._selections = [(prefix, scan.Selection(sublist)) for prefix, sublist in self.group_by_roots()]
+        path = path.replace('\\', '/') if IS_WINDOWS else path
+        for prefix, selection in self._selections:
+            if (path.lower() if IS_WINDOWS else path).startswith(prefix.lower() if IS_WINDOWS else prefix):
+                return selection(path) == scan.INCLUDE
+        return False
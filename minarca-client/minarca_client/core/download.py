@@ -0,0 +1,206 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+'''
+Restore files from Rdiffweb over HTTP.
+
+Rdiffweb restore the requested path on the server and stream it as a tar
+archive, or as raw content for a single file. The archive is extracted on
+the fly while it get downloaded, without temporary file.
+
+When the connection get interrupted, the download is resumed from the last
+byte received with a `Range` request. The download is only resumed if the
+server returns the requested range of the same content. Otherwise, the
+download is restarted from the beginning.
+'''
+import datetime
+import io
+import logging
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import time
+
+logger = logging.getLogger(__name__)
+
+_CHUNK_SIZE = 64 * 1024
+
+_RETRIES = 5  # Number of attempts to resume an interrupted download.
+
+_RETRY_DELAY = 2  # Delay in seconds between attempts, multiplied by the attempt number.
+
+# Reject members outside the target directory, but keep permissions.
+_EXTRACT_ARGS = {'filter': 'tar'} if hasattr(tarfile, 'tar_filter') else {}
+
+_CONTENT_RANGE = re.compile(r'^bytes ([0-9]+)-')
+
+_INTERVAL = re.compile(r'([0-9]+)([smhDWMY])')
+
+_INTERVAL_SECONDS = {'s': 1, 'm': 60, 'h': 3600, 'D': 86400, 'W': 604800, 'M': 2592000, 'Y': 31536000}
+
+
+class RestartError(IOError):
+    """
+    Raised when an interrupted download cannot be resumed and must be
+    restarted from the beginning.
+    """
+
+
+def epoch(value=None):
+    """
+    Return the epoch in seconds of a restore time using the same formats
+    as rdiff-backup: `now`, an epoch, an ISO date or an interval like `3D`
+    for 3 days ago.
+    """
+    if not value or value == 'now':
+        return int(time.time())
+    if value.isdigit():
+        return int(value)
+    if _INTERVAL.sub('', value) == '':
+        return int(time.time()) - sum(int(n) * _INTERVAL_SECONDS[u] for n, u in _INTERVAL.findall(value))
+    return int(datetime.datetime.fromisoformat(value).timestamp())
+
+
+class ResumableStream(io.RawIOBase):
+    """
+    Read-only stream of the response returned by `request(offset)`. When
+    the connection get interrupted, `request` is called again with the
+    number of bytes already read. `RestartError` is raised if the response
+    is not the requested range of the same content.
+    """
+
+    def __init__(self, request, retries=_RETRIES):
+        self._request = request
+        self._retries = retries
+        self._response = None
+        self._chunks = None
+        self._buffer = b''
+        self._etag = None
+        self.offset = 0
+
+    def readable(self):
+        return True
+
+    @property
+    def headers(self):
+        """
+        Return the headers of the response.
+        """
+        self._with_retry(lambda: None)
+        return self._response.headers
+
+    def readinto(self, b):
+        return self._with_retry(lambda: self._readinto(b))
+
+    def close(self):
+        self._close_response()
+        super().close()
+
+    def _with_retry(self, func):
+        # Lazy import, requests is slow to import.
+        from requests.exceptions import HTTPError, RequestException
+
+        attempt = 0
+        while True:
+            try:
+                if self._response is None:
+                    self._open()
+                return func()
+            except (HTTPError, RestartError):
+                raise
+            except (RequestException, OSError) as e:
+                self._close_response()
+                attempt += 1
+                if attempt > self._retries:
+                    raise
+                logger.info('download interrupted after %s bytes, resuming: %s', self.offset, e)
+                time.sleep(_RETRY_DELAY * attempt)
+
+    def _open(self):
+        response = self._request(self.offset)
+        self._response = response
+        self._chunks = response.iter_content(_CHUNK_SIZE)
+        self._buffer = b''
+        etag = response.headers.get('ETag')
+        if not self.offset:
+            self._etag = etag
+            return
+        # Only continue with the requested range of the same content.
+        m = _CONTENT_RANGE.match(response.headers.get('Content-Range', ''))
+        if response.status_code != 206 or not m or int(m.group(1)) != self.offset:
+            raise RestartError('range not supported, download must be restarted')
+        if self._etag and etag and etag != self._etag:
+            raise RestartError('content changed since interruption')
+
+    def _readinto(self, b):
+        if not self._buffer:
+            self._buffer = next(self._chunks, b'')
+        data = self._buffer[: len(b)]
+        self._buffer = self._buffer[len(data) :]
+        b[: len(data)] = data
+        self.offset += len(data)
+        return len(data)
+
+    def _close_response(self):
+        if self._response is not None:
+            self._response.close()
+        self._response = None
+        self._chunks = None
+
+
+def restore(request, target, on_file=None, retries=_RETRIES):
+    """
+    Download the content returned by `request(offset)` into `target`. A tar
+    archive is extracted into the target directory, other content is
+    written into the target file. `on_file` is called with the name of each
+    file being restored. The download is restarted from the beginning when
+    it cannot be resumed.
+    """
+    attempt = 0
+    while True:
+        try:
+            return _restore(request, target, on_file)
+        except RestartError as e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            logger.info('restarting download: %s', e)
+
+
+def _restore(request, target, on_file=None):
+    with ResumableStream(request) as stream:
+        disposition = stream.headers.get('Content-Disposition', '')
+        fileobj = io.BufferedReader(stream, _CHUNK_SIZE)
+        if '.tar' not in disposition:
+            if on_file:
+                on_file(os.path.basename(target))
+            _write_file(fileobj, target)
+            return
+        os.makedirs(target, exist_ok=True)
+        with tarfile.open(fileobj=fileobj, mode='r|') as tar:
+            for member in tar:
+                if on_file:
+                    on_file(member.name)
+                tar.extract(member, target, **_EXTRACT_ARGS)
+
+
+def _write_file(fileobj, target):
+    """
+    Write the content into a temporary file replacing the target once
+    completed. The target is left untouched if the download failed.
+    """
+    dirname, basename = os.path.split(os.path.abspath(target))
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix='.' + basename + '.', suffix='.tmp', dir=dirname)
+    try:
+        with open(fd, 'wb') as f:
+            shutil.copyfileobj(fileobj, f, _CHUNK_SIZE)
+        os.replace(tmp, target)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
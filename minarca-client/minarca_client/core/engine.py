@@ -0,0 +1,242 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+'''
+Execution engine for rdiff-backup sessions.
+
+By default, every session is executed by spawning `minarca rdiff-backup`
+which boot a new interpreter and re-import every modules. On POSIX the
+`fork` engine import rdiff-backup once then fork a worker for each session.
+The worker share the already loaded modules with the parent process.
+
+rdiff-backup keep a lot of global state between call, so it's not safe to
+execute it multiple time within the same interpreter. A worker process is
+still required.
+
+Forking a process running multiple threads is not safe: a lock held by
+another thread (logging, import) stay locked forever in the child. So the
+workers are not forked by the backup process, which use threads, but by a
+`ForkServer` forked before any thread get started. The fork server is
+single threaded and only fork workers on request.
+'''
+import json
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+from minarca_client.core.compat import IS_WINDOWS
+
+logger = logging.getLogger(__name__)
+
+ENGINE_SUBPROCESS = 'subprocess'
+
+ENGINE_FORK = 'fork'
+
+_EXIT_FAILURE = 1
+
+# Maximum size of a request sent to the fork server.
+_MAX_REQUEST = 1024 * 1024
+
+# Interval in seconds to reap workers and check if the parent is alive.
+_POLL_INTERVAL = 0.1
+
+
+def _load_main_run():
+    """
+    Import rdiff-backup in the current process and return the entry point.
+    """
+    import rdiffbackup.run
+
+    return rdiffbackup.run.main_run
+
+
+def _worker(main_run, options, fd):
+    """
+    Entry point of the forked worker. Redirect stdout and stderr to the given
+    file descriptor, including output of the ssh process spawned by rdiff-backup.
+    """
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    sys.stdout = open(1, 'w', buffering=1, encoding='utf-8', errors='replace', closefd=False)
+    sys.stderr = open(2, 'w', buffering=1, encoding='utf-8', errors='replace', closefd=False)
+    exit_code = _EXIT_FAILURE
+    try:
+        exit_code = main_run(options)
+    except SystemExit as e:
+        exit_code = e.code if isinstance(e.code, int) else _EXIT_FAILURE
+    except BaseException as e:
+        # Capture any exception and return exitcode.
+        traceback.print_exception(e)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(exit_code or 0)
+
+
+def _serve(sock, parent_pid):
+    """
+    Main loop of the fork server. Each request is a list of options with
+    two file descriptors: one for the output of the worker and one to report
+    the pid and the exit code of the worker.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    main_run = _load_main_run()
+    workers = {}
+    while True:
+        readable, unused, unused = select.select([sock], [], [], _POLL_INTERVAL)
+        if readable:
+            msg, fds, unused, unused = socket.recv_fds(sock, _MAX_REQUEST, 2)
+            if not msg:
+                break
+            output, status = fds
+            os.set_inheritable(status, False)
+            pid = os.fork()
+            if pid == 0:
+                sock.close()
+                os.close(status)
+                for fd in workers.values():
+                    os.close(fd)
+                _worker(main_run, json.loads(msg), output)
+            os.close(output)
+            os.write(status, b'%d\n' % pid)
+            workers[pid] = status
+        # Report exit code of completed workers.
+        while workers:
+            pid, wait_status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                break
+            status = workers.pop(pid, None)
+            if status is not None:
+                os.write(status, b'%d\n' % os.waitstatus_to_exitcode(wait_status))
+                os.close(status)
+        if os.getppid() != parent_pid:
+            break
+    # Let running workers complete.
+    for pid, status in workers.items():
+        unused, wait_status = os.waitpid(pid, 0)
+        os.write(status, b'%d\n' % os.waitstatus_to_exitcode(wait_status))
+        os.close(status)
+
+
+def is_supported(engine):
+    """
+    Return True if the given engine could be used on this platform.
+    """
+    if engine == ENGINE_SUBPROCESS:
+        return True
+    if engine == ENGINE_FORK:
+        return not IS_WINDOWS and hasattr(os, 'fork') and hasattr(socket, 'send_fds')
+    return False
+
+
+class ForkServer:
+    """
+    Single threaded process forking a worker for each rdiff-backup session.
+    Must be started before any thread. Raise RuntimeError otherwise.
+    """
+
+    def __init__(self):
+        if threading.active_count() > 1:
+            raise RuntimeError('fork server must be started before any thread')
+        parent_pid = os.getpid()
+        self._sock, child = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # Flush buffers to avoid writing them twice.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            exit_code = 0
+            try:
+                self._sock.close()
+                _serve(child, parent_pid)
+            except BaseException:
+                exit_code = _EXIT_FAILURE
+            finally:
+                os._exit(exit_code)
+        child.close()
+
+    def run(self, options):
+        """
+        Fork a worker executing rdiff-backup with the given options.
+        """
+        return ForkedProcess(self, options)
+
+    def is_alive(self):
+        """
+        Return True if the fork server is still running.
+        """
+        if self._sock is None:
+            return False
+        try:
+            pid, unused = os.waitpid(self.pid, os.WNOHANG)
+        except ChildProcessError:
+            return False
+        return pid == 0
+
+    def close(self):
+        """
+        Stop the fork server once the running workers completed.
+        """
+        if self._sock is None:
+            return
+        try:
+            self._sock.send(b'')
+        except OSError:
+            pass
+        self._sock.close()
+        self._sock = None
+        try:
+            os.waitpid(self.pid, 0)
+        except ChildProcessError:
+            pass
+
+
+class ForkedProcess:
+    """
+    Execute rdiff-backup in a worker forked by the given `ForkServer`.
+    Provide a subset of `subprocess.Popen` interface: `pid`, `stdout`,
+    `wait()` and `terminate()`.
+    """
+
+    def __init__(self, server, options):
+        output_r, output_w = os.pipe()
+        status_r, status_w = os.pipe()
+        try:
+            socket.send_fds(server._sock, [json.dumps(options).encode('utf-8')], [output_w, status_w])
+        except BaseException:
+            os.close(output_r)
+            os.close(status_r)
+            raise
+        finally:
+            os.close(output_w)
+            os.close(status_w)
+        self._status = open(status_r, 'rb')
+        self.stdout = open(output_r, 'r', encoding='utf-8', errors='replace')
+        line = self._status.readline()
+        if not line:
+            self._status.close()
+            self.stdout.close()
+            raise OSError('fork server is not running')
+        self.pid = int(line)
+        self._exitcode = None
+
+    def wait(self):
+        if self._exitcode is None:
+            line = self._status.readline()
+            self._status.close()
+            self.stdout.close()
+            self._exitcode = int(line) if line else _EXIT_FAILURE
+        return self._exitcode
+
+    def terminate(self):
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
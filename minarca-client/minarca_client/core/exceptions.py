@@ -6,27 +6,54 @@ Created on Jun. 27, 2021
 
 @author: Patrik Dufresne <patrik@ikus-soft.com>
 '''
+import re
 
 from minarca_client.locale import _
 
 
 class CaptureException:
+    """
+    Parse rdiff-backup output to identify known errors. Every signature is
+    compiled into a single regular expression to scan each line only once.
+    """
+
+    _signatures = []
+    _regex = None
+
     exception = None
 
+    @classmethod
+    def register(cls, *patterns):
+        """
+        Class decorator to register regular expressions matching the output
+        of rdiff-backup for the given exception class.
+        """
+        assert patterns
+
+        def decorator(exception_cls):
+            for pattern in patterns:
+                cls._signatures.append((re.compile(pattern), exception_cls))
+            cls._regex = None
+            return exception_cls
+
+        return decorator
+
+    @classmethod
+    def _get_regex(cls):
+        regex = cls._regex
+        if regex is None:
+            # Capturing groups would prevent the regex engine to quickly skip
+            # lines not matching any signature. So we only check which
+            # signature matches when the combined regex matches.
+            regex = cls._regex = re.compile('|'.join('(?:%s)' % r.pattern for r, unused in cls._signatures))
+        return regex
+
     def parse(self, line):
-        for cls in [
-            ConnectException,
-            DiskFullError,
-            DiskQuotaExceededError,
-            UnknownHostException,
-            UnknownHostKeyError,
-            PermissionDeniedError,
-            UnsuportedVersionError,
-            RepositoryLocked,
-            RestoreFileNotFound,
-        ]:
-            if cls._matches(line):
-                self.exception = cls()
+        if self._get_regex().search(line) is None:
+            return
+        for regex, exception_cls in self._signatures:
+            if regex.search(line):
+                self.exception = exception_cls()
 
 
 class BackupError(Exception):
@@ -82,6 +109,17 @@ class RdiffBackupExitError(BackupError):
     message = _('backup process returned non-zero exit status, check logs for more details')
 
 
+class MultipleBackupError(BackupError):
+    """
+    This exception is raised when more than one rdiff-backup session failed.
+    """
+
+    def __init__(self, errors):
+        assert errors
+        self.errors = errors
+        self.message = '\n'.join('%s: %s' % (name, e) for name, e in errors.items())
+
+
 class NoPatternsError(BackupError):
     """
     This exception is raised when a backup is started without any valid patterns.
@@ -106,6 +144,16 @@ class RunningError(BackupError):
     message = _("cannot start process when it's already running")
 
 
+class AgentRunningError(BackupError):
+    """
+    Raised when trying to start the agent while it's already running.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.message = _("agent is already running with pid %s") % pid
+
+
 class NotConfiguredError(BackupError):
     """
     Raised when the backup is not configured
@@ -163,6 +211,7 @@ class HttpServerError(BackupError):
     message = _('remote server return an error, check remote server log with your administrator')
 
 
+@CaptureException.register(r'ssh: connect to host .*Connection refused')
 class ConnectException(BackupError):
     """
     Raised when rdiff-backup fail to establish SSH connection with remove host.
@@ -172,12 +221,8 @@ class ConnectException(BackupError):
         'Unable to connect to the remote server. The problem may be with the remote server. If the problem persists, contact your system administrator to check the SSH server configuration and a possible firewall blocking the connection.'
     )
 
-    @staticmethod
-    def _matches(line):
-        # ssh: connect to host test.minarca.net port 8976: Connection refused
-        return 'ssh: connect to host' in line and 'Connection refused' in line
-
 
+@CaptureException.register(r'Permission denied \(publickey\)')
 class PermissionDeniedError(BackupError):
     """
     Raised by SSH when remote server refused our identity.
@@ -187,11 +232,8 @@ class PermissionDeniedError(BackupError):
         'Backup failed due to our identity being refused by remote server. The problem may be with the remote server. If the problem persists, contact your system administrator to review your SSH identity.'
     )
 
-    @staticmethod
-    def _matches(line):
-        return 'Permission denied (publickey)' in line
-
 
+@CaptureException.register(r'Host key verification failed\.')
 class UnknownHostKeyError(BackupError):
     """
     Raised by SSH when remote server is unknown.
@@ -201,11 +243,8 @@ class UnknownHostKeyError(BackupError):
         'Backup failed due to unknown remote server identity. If the problem persists, contact your system administrator to review the server identity.'
     )
 
-    @staticmethod
-    def _matches(line):
-        return 'Host key verification failed.' in line
-
 
+@CaptureException.register(r'OSError: \[Errno 122\] Disk quota exceeded')
 class DiskQuotaExceededError(BackupError):
     """
     Raised by rdiff-backup remote server when the disk quota is reached.
@@ -213,11 +252,8 @@ class DiskQuotaExceededError(BackupError):
 
     message = _('Backup failed due to disk quota exceeded. Please free up disk space to ensure successful backup.')
 
-    @staticmethod
-    def _matches(line):
-        return 'OSError: [Errno 122] Disk quota exceeded' in line
-
 
+@CaptureException.register(r'OSError: \[Errno 28\] No space left on device')
 class DiskFullError(BackupError):
     """
     Raised by rdiff-backup remote server when the disk is full"
@@ -225,11 +261,8 @@ class DiskFullError(BackupError):
 
     message = _('Backup failed due disk is full. Please clear space on the disk to proceed with the backup.')
 
-    @staticmethod
-    def _matches(line):
-        return 'OSError: [Errno 28] No space left on device' in line
-
 
+@CaptureException.register(r'ssh: Could not resolve hostname')
 class UnknownHostException(BackupError):
     """
     Raised by rdiff-backup when remote host name could not be resolved.
@@ -239,11 +272,8 @@ class UnknownHostException(BackupError):
         'Backup failed due unresolvable hostname. Please check your network connection and ensure the hostname is valid.'
     )
 
-    @staticmethod
-    def _matches(line):
-        return 'ssh: Could not resolve hostname' in line
-
 
+@CaptureException.register(r'ERROR:? unsupported version:')
 class UnsuportedVersionError(BackupError):
     """
     Raised by rdiff-backup when remote server is not compatible with our client version.
@@ -253,22 +283,12 @@ class UnsuportedVersionError(BackupError):
         'Backup failed due to unsupported Minarca agent version on remote server. Consider upgrading your agent or your server.'
     )
 
-    @staticmethod
-    def _matches(line):
-        return 'ERROR unsupported version:' in line or 'ERROR: unsupported version:' in line
-
 
+@CaptureException.register(r"couldn't be identified as being within an existing backup repository")
 class RestoreFileNotFound(BackupError):
     message = _('The path you are trying to restore from backup does not exists.')
 
-    @staticmethod
-    def _matches(line):
-        return "couldn't be identified as being within an existing backup repository" in line
-
 
+@CaptureException.register(r'Fatal Error: It appears that a previous rdiff-backup session')
 class RepositoryLocked(BackupError):
     message = _('Another backup session is currently in progress on the remote server.')
-
-    @staticmethod
-    def _matches(line):
-        return "Fatal Error: It appears that a previous rdiff-backup session" in line
@@ -0,0 +1,220 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+'''
+Local index of the files available in the backup history.
+
+Browsing the history with the web interface require a round trip for each
+directory and each date. Instead, the increments of each repository and
+the files available in some of them are listed with `rdiff-backup list`
+and kept in the data home. Each file is stored once with the ranges of
+epochs during which it was available.
+
+Listing the files of every increment would open one session per increment.
+So, only the oldest and the latest increments get listed on the first
+update, then only the latest increment on each following update. A file
+available in two consecutive listed increments is considered available in
+the increments between them. A repository is not contacted at all when no
+backup session completed since the last update.
+'''
+import datetime
+import gzip
+import json
+import os
+import re
+import time
+
+from minarca_client.core import scan
+from minarca_client.core.compat import IS_WINDOWS
+
+_VERSION = 2
+
+# Name of the increment, e.g.: increments.2023-04-24T10:51:09-04:00.dir
+# Compatible timestamps use dashes instead of colons.
+_INCREMENT = re.compile(
+    r'increments\.([0-9]{4}-[0-9]{2}-[0-9]{2})T([0-9]{2})[:-]([0-9]{2})[:-]([0-9]{2})(Z|[+-][0-9]{2}[:-][0-9]{2})\.'
+)
+
+_MIRROR = re.compile(r'^Current mirror: (.+)$')
+
+# Messages printed by rdiff-backup between the files.
+_LOG = re.compile(r'^(ERROR|WARNING|NOTE): ')
+
+
+def parse_increments(lines):
+    """
+    Return the sorted list of epochs parsed from the output of
+    `rdiff-backup list increments`, including the current mirror.
+    """
+    result = set()
+    for line in lines:
+        m = _INCREMENT.search(line)
+        if m:
+            date, hour, minute, second, tz = m.groups()
+            tz = '+00:00' if tz == 'Z' else tz[0:3] + ':' + tz[4:6]
+            value = datetime.datetime.fromisoformat('%sT%s:%s:%s%s' % (date, hour, minute, second, tz))
+            result.add(int(value.timestamp()))
+            continue
+        m = _MIRROR.match(line.strip())
+        if m:
+            # Printed with asctime() in local time.
+            result.add(int(time.mktime(time.strptime(m.group(1).strip()))))
+    return sorted(result)
+
+
+def parse_files(lines):
+    """
+    Return the paths parsed from the output of `rdiff-backup list files`.
+    """
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line and line != '.' and not _LOG.match(line):
+            yield line
+
+
+def _available(ranges, epoch):
+    return any(first <= epoch <= last for first, last in ranges)
+
+
+class History:
+    """
+    Files available in the repositories with the ranges of epochs during
+    which they are available. Repositories are identified by a key, usually the
+    session name, and are restored into their own root. Each destination
+    has its own increments, so only the repositories of one destination
+    are browsed at a time. The primary destination is identified by None.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._repositories = {}
+        if filename:
+            try:
+                with gzip.open(filename, 'rt', encoding='utf-8', errors='surrogateescape') as f:
+                    data = json.load(f)
+                if data.get('version') == _VERSION:
+                    self._repositories = data['repositories']
+            except (OSError, EOFError, ValueError, KeyError):
+                pass
+
+    def is_current(self, key, lastsuccess):
+        """
+        Return True if the repository was indexed after the given backup session.
+        """
+        repo = self._repositories.get(key)
+        return repo is not None and repo['lastsuccess'] == lastsuccess
+
+    def update(self, key, root, lastsuccess, increments, list_files, destination=None):
+        """
+        Update the index of a repository with the given increments.
+        `list_files(epoch)` is called to list the files of the latest
+        increment, and of the oldest one if the repository was never
+        indexed. Increments no longer available are removed.
+        """
+        increments = sorted(set(increments))
+        repo = self._repositories.get(key) or {'increments': [], 'listed': [], 'files': {}}
+        files = repo['files']
+        if set(repo['increments']) - set(increments):
+            oldest = increments[0] if increments else None
+            repo['listed'] = [e for e in repo['listed'] if e in increments]
+            for path in list(files):
+                files[path] = [
+                    [max(first, oldest), last] for first, last in files[path] if oldest is not None and last >= oldest
+                ]
+                if not files[path]:
+                    del files[path]
+        if increments and increments[-1] not in repo['listed']:
+            for epoch in sorted({increments[0] if not repo['listed'] else increments[-1], increments[-1]}):
+                previous = repo['listed'][-1] if repo['listed'] else None
+                for path in list_files(epoch):
+                    ranges = files.setdefault(path, [])
+                    if ranges and ranges[-1][1] == previous:
+                        # Still available since the previous listing.
+                        ranges[-1][1] = epoch
+                    else:
+                        ranges.append([epoch, epoch])
+                repo['listed'].append(epoch)
+        repo.update({'root': scan.normpath(root).rstrip('/'), 'lastsuccess': lastsuccess, 'destination': destination})
+        repo['increments'] = increments
+        self._repositories[key] = repo
+
+    def count(self, key, path):
+        """
+        Return the number of files inside the given path in the latest
+        increment of the given repository.
+        """
+        repo = self._repositories.get(key)
+        if not repo or not repo['increments']:
+            return 0
+        latest = repo['increments'][-1]
+        key = scan.normpath(path).rstrip('/')
+        inside = lambda p: p == key or p.startswith(key + '/')  # noqa: E731
+        return sum(1 for fullpath, ranges in self._entries(repo) if inside(fullpath) and _available(ranges, latest))
+
+    def remove(self, keys):
+        """
+        Remove the repositories not in the given keys.
+        """
+        for key in list(self._repositories):
+            if key not in keys:
+                del self._repositories[key]
+
+    def save(self):
+        """
+        Save the index.
+        """
+        if not self.filename:
+            return
+        tmp = self.filename + '.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf-8', errors='surrogateescape', compresslevel=1) as f:
+            json.dump({'version': _VERSION, 'repositories': self._repositories}, f)
+        os.replace(tmp, self.filename)
+
+    def ls(self, path, at=None, destination=None):
+        """
+        Return a sorted list of `(name, epoch)` for each file directly inside
+        the given directory in the latest increment before `at`. By default,
+        use the latest increment.
+        """
+        key = scan.normpath(path).rstrip('/')
+        result = {}
+        for repo in self._destination(destination):
+            increments = [e for e in repo['increments'] if at is None or e <= at]
+            if not increments:
+                continue
+            for fullpath, ranges in self._entries(repo):
+                parent, unused, name = fullpath.rpartition('/')
+                if parent == key and _available(ranges, increments[-1]):
+                    result[name] = max(result.get(name, 0), increments[-1])
+        return sorted(result.items())
+
+    def find(self, pattern, destination=None):
+        """
+        Return a sorted list of `(path, epochs)` for each file matching the
+        given pattern in any increment. A pattern with wildcards is matched
+        against the filename or the full path if it contains a slash.
+        Otherwise, any path containing the pattern is returned.
+        """
+        flags = re.IGNORECASE if IS_WINDOWS else 0
+        if any(c in pattern for c in '*?['):
+            regex = re.compile('^' + scan.glob_to_regex(pattern) + '$', flags)
+            full = '/' in pattern
+            match = lambda p: regex.match(p if full else p.rpartition('/')[2])  # noqa: E731
+        else:
+            regex = re.compile(re.escape(pattern), flags)
+            match = regex.search
+        result = {}
+        for repo in self._destination(destination):
+            for fullpath, ranges in self._entries(repo):
+                if match(fullpath):
+                    epochs = [e for e in repo['increments'] if _available(ranges, e)]
+                    result[fullpath] = sorted(set(result.get(fullpath, [])) | set(epochs))
+        return sorted(result.items())
+
+    def _destination(self, destination):
+        return [r for r in self._repositories.values() if r.get('destination') == destination]
+
+    def _entries(self, repo):
+        root = repo['root']
+        for path, ranges in repo['files'].items():
+            yield root + '/' + path, ranges
@@ -0,0 +1,363 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+'''
+Journal of directories modified between backups.
+
+A watcher running in the agent record every directory with modified
+content into an append-only journal. The backup use the journal to scan only
+the dirty directories instead of walking every selected files.
+
+The journal is identified by a random token. A new token is generated
+every time the watcher start or when events may have been lost (queue
+overflow, directory moved). The journal also record a digest of the roots
+and patterns being watched. A backup only trust the journal if the token
+match the one recorded with the manifest, if the watcher is still running
+and if it watches the patterns of the backup. Otherwise, a full scan is
+executed.
+'''
+import ctypes
+import ctypes.util
+import logging
+import os
+import posixpath
+import select
+import struct
+import threading
+import time
+import uuid
+
+import psutil
+
+from minarca_client.core import scan
+from minarca_client.core.compat import IS_LINUX
+
+logger = logging.getLogger(__name__)
+
+_JOURNAL_VERSION = b'minarca-journal-2'
+
+# Time to wait between scan when inotify is not available.
+_POLL_INTERVAL = 5 * 60
+
+# Time to wait before writing events to the journal.
+_FLUSH_DELAY = 1
+
+# inotify constants from <sys/inotify.h>
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_DONT_FOLLOW = 0x02000000
+_IN_EXCL_UNLINK = 0x04000000
+_IN_ISDIR = 0x40000000
+_IN_MASK = (
+    _IN_MODIFY
+    | _IN_ATTRIB
+    | _IN_CLOSE_WRITE
+    | _IN_MOVED_FROM
+    | _IN_MOVED_TO
+    | _IN_CREATE
+    | _IN_DELETE
+    | _IN_DELETE_SELF
+    | _IN_MOVE_SELF
+    | _IN_ONLYDIR
+    | _IN_DONT_FOLLOW
+    | _IN_EXCL_UNLINK
+)
+_EVENT = struct.Struct('iIII')
+
+
+def roots_digest(roots):
+    """
+    Return a digest of the list of `(root, patterns)` being watched.
+    """
+    return scan.digest(*[(root, list(patterns)) for root, patterns in roots])
+
+
+class Journal:
+    """
+    Append-only file of dirty directories. The position in the journal is
+    represented by `<token>:<offset>`.
+    """
+
+    def __init__(self, filename):
+        assert filename
+        self.filename = filename
+        self._token = None
+
+    def _read(self):
+        """
+        Return the token, the pid, the digest of the watched roots and the
+        content of the journal.
+        """
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+        except OSError:
+            return None, None, None, b''
+        header, sep, records = data.partition(b'\n')
+        fields = header.split(b' ')
+        if not sep or len(fields) != 4 or fields[0] != _JOURNAL_VERSION:
+            return None, None, None, b''
+        try:
+            token, pid, digest = fields[1].decode('ascii'), int(fields[2]), fields[3].decode('ascii')
+        except ValueError:
+            return None, None, None, b''
+        return token, pid, digest, data[: len(header) + 1 + records.rfind(b'\0') + 1]
+
+    def position(self, digest=None):
+        """
+        Return the current position in the journal or None if the journal
+        could not be trusted. When defined, the journal must watch the
+        roots matching the given digest.
+        """
+        token, pid, watched, data = self._read()
+        if not token or not psutil.pid_exists(pid):
+            return None
+        if digest is not None and digest != watched:
+            return None
+        return '%s:%s' % (token, len(data))
+
+    def read(self, position):
+        """
+        Return the set of dirty directories since the given position or None
+        if events were lost since then.
+        """
+        if not position:
+            return None
+        token, pid, unused, data = self._read()
+        expected_token, sep, offset = position.partition(':')
+        if not token or token != expected_token or not psutil.pid_exists(pid):
+            return None
+        try:
+            offset = int(offset)
+        except ValueError:
+            return None
+        if offset > len(data):
+            return None
+        return {p.decode('utf-8', errors='surrogateescape') for p in data[offset:].split(b'\0') if p}
+
+    def reset(self, digest=''):
+        """
+        Start a new journal for the roots matching the given digest.
+        Previous positions are no longer valid.
+        """
+        self._token = uuid.uuid4().hex
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            fields = [self._token, str(os.getpid()), digest or '-']
+            f.write(b' '.join([_JOURNAL_VERSION] + [v.encode('ascii') for v in fields]))
+            f.write(b'\n')
+        os.replace(tmp, self.filename)
+
+    def append(self, paths):
+        assert self._token, 'journal must be reset before use'
+        data = b''.join(p.encode('utf-8', errors='surrogateescape') + b'\0' for p in paths)
+        with open(self.filename, 'ab') as f:
+            f.write(data)
+
+    def invalidate(self):
+        self._token = None
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+
+class _Watcher(threading.Thread):
+    """
+    Record dirty directories of the given roots into the journal until stopped.
+    `roots` is a list of (root, patterns) as returned by `Patterns.group_by_roots()`.
+    The same root may be listed multiple times with different patterns.
+    """
+
+    def __init__(self, journal, roots):
+        super().__init__(name='watcher', daemon=True)
+        self.journal = journal
+        self.roots = roots
+        self.digest = roots_digest(roots)
+        self._stop_event = threading.Event()
+
+    def run(self):
+        try:
+            self._watch()
+        except Exception:
+            logger.warning('fail to watch for changes, fallback to full scan', exc_info=1)
+        finally:
+            self.journal.invalidate()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def stopped(self):
+        return self._stop_event.is_set()
+
+
+class PollingWatcher(_Watcher):
+    """
+    Detect changes by scanning the roots periodically. Used when the
+    operating system doesn't provide file system notifications.
+    """
+
+    def _watch(self):
+        snapshots = [scan.scan(root, patterns) for root, patterns in self.roots]
+        self.journal.reset(self.digest)
+        while not self._stop_event.wait(_POLL_INTERVAL):
+            for i, (root, patterns) in enumerate(self.roots):
+                entries = scan.scan(root, patterns)
+                dirty = {posixpath.dirname(p) for p in scan.changes(snapshots[i], entries)}
+                if dirty:
+                    self.journal.append(sorted(dirty))
+                snapshots[i] = entries
+
+
+class InotifyWatcher(_Watcher):
+    """
+    Detect changes using Linux inotify. Every selected directory is watched.
+    """
+
+    def _watch(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        try:
+            self._libc = libc
+            self._fd = fd
+            self._watches = {}
+            self._add_roots()
+            # Watches are ready, start a new journal.
+            self.journal.reset(self.digest)
+            self._loop()
+        finally:
+            os.close(fd)
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), _IN_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            # ENOSPC: limit of fs.inotify.max_user_watches reached.
+            raise OSError(errno, os.strerror(errno), path)
+        self._watches[wd] = path
+
+    def _add_tree(self, path, selection):
+        """
+        Watch the given directory and every selected sub directories. Return
+        the list of directories being watched.
+        """
+        added = []
+        pending = [path]
+        while pending:
+            path = pending.pop()
+            try:
+                self._add_watch(path)
+            except (FileNotFoundError, PermissionError):
+                continue
+            added.append(path)
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False) and selection(entry.path, True) != scan.EXCLUDE:
+                            pending.append(entry.path)
+            except OSError:
+                pass
+        return added
+
+    def _add_roots(self):
+        for root in dict.fromkeys(root for root, unused in self.roots):
+            self._add_tree(root, self._selection(root))
+
+    def _selection(self, path):
+        """
+        Return the union of the selections of the roots containing the path.
+        """
+        selections = [scan.Selection(patterns) for root, patterns in self.roots if path.startswith(root)]
+        if len(selections) <= 1:
+            return selections[0] if selections else None
+        return lambda path, is_dir: max(s(path, is_dir) for s in selections)
+
+    def _restart(self):
+        """
+        Events may have been lost, watch everything again with a new journal.
+        """
+        logger.info('changes may have been lost, starting a new journal')
+        for wd in list(self._watches):
+            self._libc.inotify_rm_watch(self._fd, wd)
+        self._watches.clear()
+        # Drain pending events of removed watches.
+        try:
+            while os.read(self._fd, 65536):
+                pass
+        except BlockingIOError:
+            pass
+        self._add_roots()
+        self.journal.reset(self.digest)
+
+    def _loop(self):
+        dirty = set()
+        # Changes are written to the journal at most `_FLUSH_DELAY` after
+        # being received, even if events keep coming.
+        deadline = None
+        while not self.stopped():
+            timeout = _FLUSH_DELAY if deadline is None else max(0, deadline - time.monotonic())
+            ready, _unused, _unused = select.select([self._fd], [], [], timeout)
+            if dirty and time.monotonic() >= deadline:
+                self.journal.append(sorted(dirty))
+                dirty.clear()
+            if not dirty:
+                deadline = None
+            if not ready:
+                continue
+            try:
+                data = os.read(self._fd, 65536)
+            except BlockingIOError:
+                continue
+            restart = False
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+                name = data[offset + _EVENT.size : offset + _EVENT.size + length].rstrip(b'\0')
+                offset += _EVENT.size + length
+                if mask & _IN_Q_OVERFLOW or (mask & _IN_ISDIR and mask & _IN_MOVED_FROM) or mask & _IN_MOVE_SELF:
+                    # Watched paths are no longer valid.
+                    restart = True
+                    break
+                path = self._watches.get(wd)
+                if path is None:
+                    continue
+                if mask & _IN_IGNORED:
+                    del self._watches[wd]
+                    continue
+                if not name:
+                    # Directory itself was modified.
+                    dirty.add(posixpath.dirname(path))
+                    continue
+                dirty.add(path)
+                if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                    child = os.path.join(path, os.fsdecode(name))
+                    selection = self._selection(child)
+                    if selection and selection(child, True) != scan.EXCLUDE:
+                        # Content created before the watch was added must be scanned.
+                        dirty.update(self._add_tree(child, selection))
+            if restart:
+                dirty.clear()
+                self._restart()
+            if dirty and deadline is None:
+                deadline = time.monotonic() + _FLUSH_DELAY
+
+
+def create_watcher(journal, roots):
+    """
+    Return the best watcher available for the current operating system.
+    """
+    if IS_LINUX and ctypes.util.find_library('c'):
+        return InotifyWatcher(journal, roots)
+    return PollingWatcher(journal, roots)
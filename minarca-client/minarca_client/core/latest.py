@@ -6,14 +6,25 @@ Created on Oct. 22, 2021
 
 @author: Patrik Dufresne <patrik@ikus-soft.com>
 '''
-import requests
+import os
+import threading
+import time
+
+import javaproperties
 from packaging import version
 
 from minarca_client.core import compat
+from minarca_client.core.config import _atomic_write
 from minarca_client.locale import _
 
 LATEST_VERSION_URL = 'https://latest.ikus-soft.com/minarca/latest_version'
 
+# Time to keep the latest version in cache before querying the web server again.
+_CACHE_TTL = 24 * 3600
+
+# Time to wait before querying the web server again after a failure.
+_FAILURE_TTL = 3600
+
 
 class LatestCheckFailed(Exception):
     pass
@@ -22,8 +33,39 @@ class LatestCheckFailed(Exception):
 class LatestCheck:
     """
     Responsible to check if current version is up-to-date.
+
+    The latest version is kept in a cache file shared by every process (CLI,
+    agent and graphical interface) to avoid querying the web server on every
+    backup. Once expired, the cache is revalidated using the ETag.
     """
 
+    _lock = threading.Lock()
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file or os.path.join(compat.get_data_home(), 'latest.properties')
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_file, 'r', encoding='latin-1') as f:
+                cache = javaproperties.load(f)
+            cache['checked'] = float(cache.get('checked') or 0)
+            return cache
+        except (OSError, ValueError):
+            return {'checked': 0}
+
+    def _save_cache(self, cache):
+        values = {k: str(v) for k, v in cache.items() if v is not None}
+        try:
+            with _atomic_write(self.cache_file, encoding='latin-1') as f:
+                javaproperties.dump(values, f)
+        except OSError:
+            # Cache is only an optimization.
+            pass
+
+    def _is_fresh(self, cache):
+        ttl = _FAILURE_TTL if cache.get('error') else _CACHE_TTL
+        return 0 <= time.time() - cache['checked'] < ttl
+
     def get_download_url(self):
         """
         Return Minarca download page.
@@ -32,30 +74,81 @@ class LatestCheck:
 
     def get_latest_version(self, timeout=0.5):
         """
-        Query the latest version of minarca.
+        Return the latest version of minarca. Query the web server only when
+        the cached value is expired.
         """
+        with self._lock:
+            cache = self._load_cache()
+            if not self._is_fresh(cache):
+                cache = self._fetch(cache, timeout)
+            # On failure, fallback to previous version if available.
+            if not cache.get('version'):
+                raise LatestCheckFailed(cache.get('error'))
+            return cache['version']
+
+    def get_cached_version(self):
+        """
+        Return the latest version from cache without querying the web server.
+        Return None if the cache is empty.
+        """
+        return self._load_cache().get('version')
+
+    def refresh_async(self, timeout=5):
+        """
+        Refresh the cache in a background thread if expired. Return the
+        thread or None if the cache is still fresh.
+        """
+        if self._is_fresh(self._load_cache()):
+            return None
+
+        def _refresh():
+            try:
+                self.get_latest_version(timeout=timeout)
+            except LatestCheckFailed:
+                pass
+
+        thread = threading.Thread(target=_refresh, name='latest-check', daemon=True)
+        thread.start()
+        return thread
+
+    def _fetch(self, cache, timeout):
+        """
+        Query the latest version of minarca and update the cache.
+        """
+        # Lazy import, requests is slow to import.
+        import requests
+
         try:
             # Replace User agent by something meaningful.
             headers = {
                 'User-Agent': compat.get_user_agent(),
             }
+            # Revalidate the cached value.
+            if cache.get('version') and cache.get('etag'):
+                headers['If-None-Match'] = cache['etag']
             # Query data
             response = requests.get(LATEST_VERSION_URL, headers=headers, timeout=timeout)
             # Check status
             response.raise_for_status()
-            # Parse data as json
-            return response.text
+            if response.status_code != 304:
+                cache = {'version': response.text.strip(), 'etag': response.headers.get('ETag')}
+            cache['error'] = None
         except requests.exceptions.RequestException as e:
-            raise LatestCheckFailed(e)
+            # Keep the previous version, but avoid retrying on every call.
+            cache['error'] = str(e)
+        cache['checked'] = time.time()
+        self._save_cache(cache)
+        return cache
 
     def get_current_version(self):
         import minarca_client
 
         return minarca_client.__version__
 
-    def is_latest(self):
+    def is_latest(self, cached=False):
         """
-        Check if the current minarca client is up to date.
+        Check if the current minarca client is up to date. When `cached` is
+        True, only use the cached version without querying the web server.
         """
         # Get current version.
         current_version = self.get_current_version()
@@ -67,7 +160,12 @@ class LatestCheck:
             raise LatestCheckFailed('invalid current_version: ' + current_version)
 
         # Get latest version
-        latest_version = self.get_latest_version()
+        if cached:
+            latest_version = self.get_cached_version()
+            if latest_version is None:
+                raise LatestCheckFailed('latest version not available')
+        else:
+            latest_version = self.get_latest_version()
         try:
             latest_version = version.Version(latest_version)
         except version.InvalidVersion:
@@ -0,0 +1,152 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+'''
+Parse rdiff-backup output to report progress of a running backup.
+'''
+import os
+import re
+import stat
+import time
+
+from minarca_client.locale import _
+
+# rdiff-backup print a line for each file being processed when running with -v 5.
+_PROCESSING = re.compile(r'^\*?\s*Processing (?:changed )?file(?: (.*))?$')
+
+# rdiff-backup wrap long messages, continuation lines are indented with 9 spaces.
+_CONTINUATION = ' ' * 9
+
+# Statistics printed at the end of the session with --print-statistics.
+_STATISTICS = re.compile(
+    r'^(ElapsedTime|SourceFiles|SourceFileSize|NewFiles|NewFileSize|ChangedFiles|ChangedSourceSize|TotalDestinationSizeChange) (-?[0-9.]+)'
+)
+
+_UNITS = ['B', 'KiB', 'MiB', 'GiB', 'TiB']
+
+
+def format_size(value):
+    """
+    Return a human readable size. e.g.: 1.5 MiB
+    """
+    value = float(value)
+    for unit in _UNITS[:-1]:
+        if abs(value) < 1024:
+            break
+        value /= 1024
+    else:
+        unit = _UNITS[-1]
+    return '%d %s' % (value, unit) if unit == 'B' else '%.1f %s' % (value, unit)
+
+
+def format_progress(progress):
+    """
+    Return a human description of the given progress values.
+    """
+    if not progress:
+        return ''
+    text = _('%s files, %s, %s/s') % (
+        progress.get('files', 0),
+        format_size(progress.get('bytes', 0)),
+        format_size(progress.get('rate', 0)),
+    )
+    if progress.get('eta') is not None:
+        text += ', ' + _('about %s remaining') % time.strftime('%H:%M:%S', time.gmtime(progress['eta']))
+    return text
+
+
+class Progress:
+    """
+    Collect progress of a single rdiff-backup session by parsing its output.
+    `root` is the local path being backup and is used to compute the amount
+    of bytes sent. `previous_elapsed` is the duration in seconds of the
+    previous session and is used to estimate the remaining time.
+    """
+
+    def __init__(self, root=None, previous_elapsed=None):
+        self.root = root
+        self.previous_elapsed = previous_elapsed
+        self.files = 0
+        self.bytes = 0
+        self.path = None
+        self.stats = {}
+        self._start = None
+        self._wrapped = False
+
+    def parse(self, line):
+        # Session may get queued, so start counting on first line of output.
+        if self._start is None:
+            self._start = time.monotonic()
+        line = line.rstrip('\r\n')
+        # Long path get wrapped on multiple lines.
+        if self._wrapped and line.startswith(_CONTINUATION):
+            self.path = (self.path + ' ' if self.path else '') + line.strip()
+            return
+        self._account()
+        m = _PROCESSING.match(line)
+        if m:
+            self.path = m.group(1)
+            self._wrapped = True
+            return
+        m = _STATISTICS.match(line)
+        if m:
+            self.stats[m.group(1)] = float(m.group(2))
+
+    def file(self, path):
+        """
+        Called when a file get restored without rdiff-backup. `path` is
+        relative to the root.
+        """
+        if self._start is None:
+            self._start = time.monotonic()
+        self._account()
+        self.path = path
+        self._wrapped = True
+
+    def _account(self):
+        """
+        Called when the path of the file being processed is complete.
+        """
+        if not self._wrapped:
+            return
+        self._wrapped = False
+        self.files += 1
+        if self.root and self.path:
+            try:
+                s = os.lstat(os.path.join(self.root, self.path))
+                if stat.S_ISREG(s.st_mode):
+                    self.bytes += s.st_size
+            except OSError:
+                pass
+
+    @property
+    def elapsed(self):
+        if self._start is None:
+            return 0
+        return time.monotonic() - self._start
+
+    @property
+    def rate(self):
+        """
+        Return the transfer rate in bytes per seconds.
+        """
+        elapsed = self.elapsed
+        return int(self.bytes / elapsed) if elapsed > 0 else 0
+
+    @property
+    def eta(self):
+        """
+        Return the estimated remaining time in seconds based on the duration of previous session.
+        """
+        if not self.previous_elapsed:
+            return None
+        return max(0, int(self.previous_elapsed - self.elapsed))
+
+    def to_dict(self):
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'path': self.path,
+            'rate': self.rate,
+            'eta': self.eta,
+        }
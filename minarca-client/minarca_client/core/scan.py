@@ -0,0 +1,589 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+'''
+Local scan of the files selected for backup.
+
+The scan is used to detect if anything changed since the last successful
+backup of a root without starting a rdiff-backup session. Files are
+selected using the same rules as rdiff-backup: patterns are evaluated in
+order and the first matching pattern decides if a file is included or
+excluded. Everything else is excluded.
+'''
+import gzip
+import hashlib
+import json
+import logging
+import os
+import posixpath
+import re
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from minarca_client.core.compat import IS_WINDOWS
+
+logger = logging.getLogger(__name__)
+
+EXCLUDE = 0
+
+INCLUDE = 1
+
+# Directory is not included, but must be scanned because it contains included files.
+SCAN = 2
+
+# Number of directories scanned concurrently.
+SCAN_WORKERS = 8
+
+_MANIFEST_VERSION = b'minarca-manifest-2'
+
+
+def glob_to_regex(pattern):
+    """
+    Convert a rdiff-backup glob pattern into a regular expression.
+    """
+    i, n = 0, len(pattern)
+    res = ''
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**', i):
+            res += '.*'
+            i += 2
+            continue
+        if c == '*':
+            res += '[^/]*'
+        elif c == '?':
+            res += '[^/]'
+        elif c == '[':
+            j = pattern.find(']', i + 1)
+            if j == -1:
+                res += re.escape(c)
+            else:
+                res += '[' + pattern[i + 1 : j].replace('\\', '\\\\') + ']'
+                i = j
+        else:
+            res += re.escape(c)
+        i += 1
+    return res
+
+
+def _parents_regex(pattern):
+    """
+    Return a regular expression matching the parent directories of the files
+    matched by the given pattern.
+    """
+    parts = pattern.split('/')
+    regexes = []
+    for i in range(1, len(parts)):
+        parent = '/'.join(parts[:i])
+        if '**' in parts[i - 1]:
+            # Any directory below could contain a matching file.
+            regexes.append(glob_to_regex(parent) + '(?:/.*)?')
+            break
+        regexes.append(glob_to_regex(parent))
+    return '^(?:' + '|'.join(regexes) + ')$' if regexes else None
+
+
+def _is_wildcard(pattern):
+    return '*' in pattern or '?' in pattern or '[' in pattern
+
+
+def escape(path):
+    """
+    Escape glob characters to create a literal pattern.
+    """
+    return ''.join('[%s]' % c if c in '*?[' else c for c in path)
+
+
+def normpath(path):
+    """
+    Return the path with forward slashes as used by the patterns.
+    """
+    return path.replace('\\', '/') if IS_WINDOWS else path
+
+
+def _min(a, b):
+    return b if a is None or (b is not None and b < a) else a
+
+
+class _Node:
+    __slots__ = ['children', 'literal', 'wildcards', 'scan_rank']
+
+    def __init__(self):
+        self.children = {}
+        # (rank, include) of the literal pattern matching this path.
+        self.literal = None
+        # (rank, include, match, parents) of wildcard patterns starting with this path.
+        self.wildcards = []
+        # Lowest rank of include patterns requiring this directory to be scanned.
+        self.scan_rank = None
+
+
+class Selection:
+    """
+    Compiled list of patterns as returned by `Patterns.group_by_roots()`.
+
+    Same as rdiff-backup, the first matching pattern decide if a path is
+    included. Instead of evaluating every pattern, patterns are stored in a
+    tree of path components, so only the patterns located on the path are
+    evaluated. Patterns starting with `**` could match anywhere and are
+    combined into a single regular expression.
+    """
+
+    def __init__(self, patterns):
+        self._flags = re.IGNORECASE if IS_WINDOWS else 0
+        self._root = _Node()
+        # Patterns starting with `**`.
+        self._anywhere = []
+        self._anywhere_include = None
+        for rank, p in enumerate(patterns):
+            self._add(rank, p)
+        self._anywhere_re = None
+        if self._anywhere:
+            self._anywhere_re = re.compile('|'.join('(?:%s)' % m.pattern for _r, _i, m in self._anywhere), self._flags)
+        self._compute_scan_rank(self._root)
+
+    def _key(self, component):
+        return component.lower() if IS_WINDOWS else component
+
+    def _add(self, rank, p):
+        pattern = normpath(p.pattern).rstrip('/')
+        if pattern.startswith('**'):
+            match = re.compile('^' + glob_to_regex(pattern) + '(?:/.*)?$', self._flags)
+            self._anywhere.append((rank, p.include, match))
+            if p.include:
+                # Any directory could contains matching files.
+                self._anywhere_include = _min(self._anywhere_include, rank)
+            return
+        node = self._root
+        if not _is_wildcard(pattern):
+            for part in pattern.split('/'):
+                node = node.children.setdefault(self._key(part), _Node())
+            if node.literal is None:
+                node.literal = (rank, p.include)
+            return
+        for part in pattern.split('/'):
+            if _is_wildcard(part):
+                break
+            node = node.children.setdefault(self._key(part), _Node())
+        match = re.compile('^' + glob_to_regex(pattern) + '(?:/.*)?$', self._flags).match
+        parents = _parents_regex(pattern) if p.include else None
+        node.wildcards.append((rank, p.include, match, re.compile(parents, self._flags).match if parents else None))
+        if p.include:
+            node.scan_rank = _min(node.scan_rank, rank)
+
+    def _compute_scan_rank(self, node):
+        """
+        Compute the lowest rank of include patterns below each node.
+        Return the lowest rank of include patterns within the node.
+        """
+        for child in node.children.values():
+            node.scan_rank = _min(node.scan_rank, self._compute_scan_rank(child))
+        if node.literal and node.literal[1]:
+            return _min(node.scan_rank, node.literal[0])
+        return node.scan_rank
+
+    def __call__(self, path, is_dir=False):
+        """
+        Return INCLUDE, EXCLUDE or SCAN for the given path.
+        """
+        return self.match(path, is_dir)[0]
+
+    def match(self, path, is_dir=False):
+        """
+        Return INCLUDE, EXCLUDE or SCAN for the given path and the rank of the
+        pattern taking the decision. The rank is None if no pattern matches.
+        """
+        path = normpath(path).rstrip('/')
+        # Find the pattern with the lowest rank matching the path.
+        best, result = None, EXCLUDE
+        if self._anywhere_re and self._anywhere_re.match(path):
+            for rank, include, match in self._anywhere:
+                if match.match(path):
+                    best, result = rank, INCLUDE if include else EXCLUDE
+                    break
+        if is_dir and self._anywhere_include is not None and _min(best, self._anywhere_include) != best:
+            best, result = self._anywhere_include, SCAN
+        parts = path.split('/')
+        node = self._root
+        depth = 0
+        while True:
+            if depth < len(parts):
+                # Wildcard patterns only match path below the node.
+                for rank, include, match, parents in node.wildcards:
+                    if best is not None and rank > best:
+                        continue
+                    if match(path):
+                        best, result = rank, INCLUDE if include else EXCLUDE
+                    elif is_dir and parents and parents(path):
+                        best, result = rank, SCAN
+            elif is_dir and node.scan_rank is not None and _min(best, node.scan_rank) != best:
+                # Parent directories of included files must be traversed.
+                best, result = node.scan_rank, SCAN
+            if depth == len(parts):
+                break
+            node = node.children.get(self._key(parts[depth]))
+            if node is None:
+                break
+            depth += 1
+            if node.literal and _min(best, node.literal[0]) != best:
+                best, result = node.literal[0], INCLUDE if node.literal[1] else EXCLUDE
+        return result, best
+
+
+def optimize(patterns):
+    """
+    Return the patterns ordered for fastest evaluation by rdiff-backup
+    without changing the selection.
+
+    rdiff-backup evaluate patterns in order until one match. Exclude
+    patterns never match parent directories, so consecutive exclude
+    patterns could be evaluated in any order. Literal paths are compared
+    without regular expression and are moved first.
+    """
+    result = []
+    excludes = []
+    for p in list(patterns) + [None]:
+        if p is not None and not p.include:
+            excludes.append(p)
+            continue
+        result.extend(sorted(excludes, key=lambda p: p.is_wildcard()))
+        excludes.clear()
+        if p is not None:
+            result.append(p)
+    return result
+
+
+def write_filelist(f, patterns):
+    """
+    Write the patterns in the format expected by rdiff-backup `--include-globbing-filelist`.
+    """
+    for p in optimize(patterns):
+        f.write(('+ %s\n' if p.include else '- %s\n') % p.pattern)
+
+
+def _scandir(path, selection):
+    entries = {}
+    subdirs = []
+    try:
+        it = os.scandir(path)
+    except OSError as e:
+        # Same as rdiff-backup, unreadable directories are skipped.
+        logger.debug('cannot scan %s: %s', path, e)
+        return entries, subdirs
+    with it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                fullpath = normpath(entry.path)
+                decision = selection(fullpath, is_dir)
+                if decision == EXCLUDE:
+                    continue
+                if decision == INCLUDE:
+                    s = entry.stat(follow_symlinks=False)
+                    entries[fullpath] = (s.st_size, s.st_mtime_ns, s.st_ino, s.st_ctime_ns)
+                elif is_dir:
+                    # Keep track of scanned directories without their attributes.
+                    entries[fullpath] = ()
+                if is_dir:
+                    subdirs.append(fullpath)
+            except OSError as e:
+                logger.debug('cannot stat %s: %s', entry.path, e)
+    return entries, subdirs
+
+
+def _walk(dirs, selection, entries, max_workers, recurse=lambda path: True):
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='scan') as executor:
+        pending = {executor.submit(_scandir, d, selection) for d in dirs}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                found, subdirs = future.result()
+                entries.update(found)
+                pending.update(executor.submit(_scandir, d, selection) for d in subdirs if recurse(d))
+
+
+def scan(root, patterns, max_workers=SCAN_WORKERS):
+    """
+    Walk the given root concurrently and return a dictionary with the
+    `(size, mtime, inode, ctime)` of every file selected by the patterns.
+    Directories traversed to reach selected files have an empty value.
+    """
+    entries = {}
+    _walk([root], Selection(patterns), entries, max_workers)
+    return entries
+
+
+def rescan(root, patterns, previous, dirty, max_workers=SCAN_WORKERS):
+    """
+    Return a copy of the previous scan updated by scanning only the content
+    of the dirty directories. Only new sub directories are scanned
+    recursively, other sub directories are expected to be reported dirty
+    when modified.
+    """
+    root = normpath(root).rstrip('/') + '/'
+    dirty = {normpath(d).rstrip('/') for d in dirty}
+    dirty = {d or '/' for d in dirty if (d + '/').startswith(root)}
+    if not dirty:
+        return previous
+    # Remove previous entries of dirty directories.
+    entries = dict(previous)
+    removed = set()
+    for path in previous:
+        if posixpath.dirname(path) in dirty:
+            removed.add(path)
+            del entries[path]
+    # Scan dirty directories, but only walk into new directories.
+    dirs = [d + '/' if d.endswith(':') else d for d in sorted(dirty)]
+    _walk(dirs, Selection(patterns), entries, max_workers, recurse=lambda path: path not in previous)
+    # Modification of content also update attributes of the dirty directories.
+    for path in dirty:
+        if entries.get(path):
+            try:
+                s = os.lstat(path)
+                entries[path] = (s.st_size, s.st_mtime_ns, s.st_ino, s.st_ctime_ns)
+            except OSError:
+                pass
+    # Remove content of deleted directories.
+    deleted = tuple(path + '/' for path in removed if path not in entries)
+    if deleted:
+        for path in [p for p in entries if p.startswith(deleted)]:
+            del entries[path]
+    return entries
+
+
+def digest(*values):
+    """
+    Return a digest of the settings and patterns used to create a manifest.
+    A manifest is only valid for the same configuration.
+    """
+    h = hashlib.sha256()
+    for value in values:
+        h.update(str(value).encode('utf-8', errors='replace'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class Manifest:
+    """
+    Files scanned during the last successful backup of a root. Stored as a
+    gzip of null separated records.
+    """
+
+    def __init__(self, filename):
+        assert filename
+        self.filename = filename
+
+    def load(self):
+        """
+        Return the digest, the journal position and the entries of the
+        manifest. Return (None, None, {}) if the manifest doesn't exists or
+        is invalid.
+        """
+        try:
+            with gzip.open(self.filename, 'rb') as f:
+                data = f.read().split(b'\0')
+        except (OSError, EOFError):
+            return None, None, {}
+        if len(data) < 3 or data[0] != _MANIFEST_VERSION or not len(data) % 2:
+            return None, None, {}
+        entries = {}
+        try:
+            for i in range(3, len(data), 2):
+                entries[data[i].decode('utf-8', errors='surrogateescape')] = tuple(map(int, data[i + 1].split()))
+        except ValueError:
+            return None, None, {}
+        return data[1].decode('ascii'), data[2].decode('ascii') or None, entries
+
+    def save(self, digest, entries, journal=None):
+        dirname, basename = os.path.split(os.path.abspath(self.filename))
+        tmp = os.path.join(dirname, '.' + basename + '.tmp')
+        with gzip.open(tmp, 'wb', compresslevel=1) as f:
+            f.write(b'\0'.join([_MANIFEST_VERSION, digest.encode('ascii'), (journal or '').encode('ascii')]))
+            for path, values in entries.items():
+                f.write(b'\0' + path.encode('utf-8', errors='surrogateescape') + b'\0')
+                f.write(' '.join(map(str, values)).encode('ascii'))
+        os.replace(tmp, self.filename)
+
+    def delete(self):
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+
+
+def changes(old, new):
+    """
+    Return the list of paths created, modified or deleted.
+    """
+    changed = [path for path, values in new.items() if old.get(path) != values]
+    changed.extend(path for path in old if path not in new)
+    return changed
+
+
+class ListingCache:
+    """
+    Content of directories with the size of each file. A directory is listed
+    again only when its modification time changed. Files rewritten in place
+    don't change the modification time of their directory, so the files of
+    an unchanged directory are still stat to get their current size.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._previous = {}
+        self._entries = {}
+        if filename:
+            try:
+                with gzip.open(filename, 'rt', encoding='utf-8', errors='surrogateescape') as f:
+                    self._previous = json.load(f)
+            except (OSError, EOFError, ValueError):
+                pass
+
+    def listdir(self, path):
+        """
+        Return a list of (name, is_dir, size).
+        """
+        mtime = os.lstat(path).st_mtime_ns
+        cached = self._previous.get(path)
+        if cached and cached[0] == mtime:
+            listing = []
+            for name, is_dir, size in cached[1]:
+                if not is_dir:
+                    try:
+                        size = os.lstat(os.path.join(path, name)).st_size
+                    except OSError:
+                        continue
+                listing.append((name, is_dir, size))
+            self._entries[path] = (mtime, listing)
+            return listing
+        listing = []
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    is_dir = entry.is_dir(follow_symlinks=False)
+                    listing.append((entry.name, is_dir, 0 if is_dir else entry.stat(follow_symlinks=False).st_size))
+                except OSError:
+                    pass
+        self._entries[path] = (mtime, listing)
+        return listing
+
+    def save(self):
+        """
+        Save the directories listed since creation.
+        """
+        if not self.filename:
+            return
+        tmp = self.filename + '.tmp'
+        with gzip.open(tmp, 'wt', encoding='utf-8', errors='surrogateescape', compresslevel=1) as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, self.filename)
+
+
+def du(path, cache=None):
+    """
+    Return the size of the given file or directory. Return 0 when it doesn't
+    exist. Directories are listed using the given `ListingCache`.
+    """
+    cache = cache or ListingCache()
+    try:
+        if not os.path.isdir(path):
+            return os.lstat(path).st_size
+    except OSError:
+        return 0
+    size = 0
+    pending = [path]
+    while pending:
+        path = pending.pop()
+        try:
+            listing = cache.listdir(path)
+        except OSError:
+            continue
+        for name, is_dir, file_size in listing:
+            if is_dir:
+                pending.append(os.path.join(path, name))
+            else:
+                size += file_size
+    return size
+
+
+def _estimate_dir(path, selection, without, removed_by, cache):
+    """
+    Estimate a single directory. When `removed_by` is defined, the directory
+    was excluded by this rank and the files that would have been included
+    otherwise are counted. Return the number of files and bytes added per
+    rank, removed per rank and the sub directories to be walked.
+    """
+    added = {}
+    removed = {}
+    subdirs = []
+    try:
+        listing = cache.listdir(path)
+    except OSError as e:
+        logger.debug('cannot scan %s: %s', path, e)
+        return added, removed, subdirs
+    for name, is_dir, size in listing:
+        fullpath = path.rstrip('/') + '/' + name
+        if removed_by is None:
+            decision, rank = selection.match(fullpath, is_dir)
+            target = added
+            if decision == EXCLUDE and rank is not None:
+                # Excluded by a pattern, look at what would have been included otherwise.
+                decision = without(rank)(fullpath, is_dir)
+                target = removed
+        else:
+            decision, rank = without(removed_by)(fullpath, is_dir), removed_by
+            target = removed
+        if decision == EXCLUDE:
+            continue
+        if is_dir:
+            subdirs.append((fullpath, rank if target is removed else None))
+        elif decision == INCLUDE:
+            stats = target.setdefault(rank, [0, 0])
+            stats[0] += 1
+            stats[1] += size
+    return added, removed, subdirs
+
+
+def estimate(root, patterns, cache=None, max_workers=SCAN_WORKERS):
+    """
+    Estimate the number of files and bytes selected by each pattern. Return
+    two dictionaries of `Pattern` to `[files, bytes]`: the first one with
+    files included by the pattern, the second with files excluded by the
+    pattern that would have been included otherwise.
+
+    `cache` is used to avoid listing directories that didn't changed.
+    """
+    patterns = list(patterns)
+    selection = Selection(patterns)
+    cache = cache or ListingCache()
+    added = {}
+    removed = {}
+    selections = {}
+    lock = threading.Lock()
+
+    def _without(rank):
+        # Selection without the given pattern.
+        with lock:
+            if rank not in selections:
+                selections[rank] = Selection(patterns[:rank] + patterns[rank + 1 :])
+            return selections[rank]
+
+    def _merge(target, values):
+        for rank, (files, size) in values.items():
+            stats = target.setdefault(patterns[rank], [0, 0])
+            stats[0] += files
+            stats[1] += size
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='estimate') as executor:
+        pending = {executor.submit(_estimate_dir, root, selection, _without, None, cache)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                a, r, subdirs = future.result()
+                _merge(added, a)
+                _merge(removed, r)
+                pending.update(
+                    executor.submit(_estimate_dir, d, selection, _without, removed_by, cache)
+                    for d, removed_by in subdirs
+                )
+    return added, removed
@@ -0,0 +1,177 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+'''
+Split very large roots into shards backed up concurrently.
+
+A single rdiff-backup session use a single CPU core and a single SSH channel.
+To backup a very large root faster, the top-level directories of each
+included folder are distributed between multiple shards, each one backup
+into its own repository by a separate rdiff-backup session.
+
+The first shard is the repository of the root. It contains everything
+except the directories assigned to the other shards. Once assigned, a
+directory always stay in the same shard to avoid sending it again. Only
+new directories get walked to compute their size. They are assigned to the
+smallest shard according to the size of the files selected by each shard
+during its last session.
+'''
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from minarca_client.core import scan
+from minarca_client.core.config import Pattern
+
+logger = logging.getLogger(__name__)
+
+
+def _listdir(path, cache):
+    try:
+        return cache.listdir(path)
+    except OSError as e:
+        logger.debug('cannot scan %s: %s', path, e)
+        return []
+
+
+def _du(path, selection, cache):
+    """
+    Return the size of the files selected in the given directory.
+    """
+    size = 0
+    pending = [path]
+    while pending:
+        path = pending.pop()
+        for name, is_dir, file_size in _listdir(path, cache):
+            fullpath = path + '/' + name
+            decision = selection(fullpath, is_dir)
+            if decision == scan.EXCLUDE:
+                continue
+            if is_dir:
+                pending.append(fullpath)
+            elif decision == scan.INCLUDE:
+                size += file_size
+    return size
+
+
+def units(root, patterns, cache=None, known={}, max_workers=scan.SCAN_WORKERS):
+    """
+    Return a dictionary with the size of the directories to be distributed
+    between shards: the sub directories of each included folder. Sizes of
+    the `known` directories are reused, only other directories get walked.
+    """
+    selection = scan.Selection(patterns)
+    cache = cache or scan.ListingCache()
+    found = []
+    pending = [scan.normpath(root)]
+    while pending:
+        path = pending.pop()
+        for name, is_dir, unused in _listdir(path, cache):
+            if not is_dir:
+                continue
+            fullpath = path.rstrip('/') + '/' + name
+            decision = selection(fullpath, True)
+            if decision == scan.SCAN:
+                # Not included, but contains included folders.
+                pending.append(fullpath)
+            elif decision == scan.INCLUDE:
+                found.extend(
+                    fullpath + '/' + n
+                    for n, d, unused in _listdir(fullpath, cache)
+                    if d and selection(fullpath + '/' + n, True) != scan.EXCLUDE
+                )
+    result = {path: known[path] for path in found if path in known}
+    new = [path for path in found if path not in known]
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='shard') as executor:
+        result.update(zip(new, executor.map(lambda path: _du(path, selection, cache), new)))
+    return {path: result[path] for path in found}
+
+
+def assign(sizes, count, previous, loads=None):
+    """
+    Return a dictionary with the shard assigned to each directory. The
+    assignment of `previous` is kept. Other directories are assigned to
+    the smallest shard, largest directories first. When known, `loads` is
+    the size of each shard, otherwise it's computed from the `previous`
+    sizes.
+    """
+    result = {}
+    computed = [0] * count
+    for path in sizes:
+        shard, size = previous.get(path, (None, 0))
+        if shard is not None and shard < count:
+            result[path] = shard
+            computed[shard] += size
+    loads = [load if load is not None else c for load, c in zip(loads or computed, computed)]
+    for path in sorted((p for p in sizes if p not in result), key=lambda p: (-sizes[p], p)):
+        shard = loads.index(min(loads))
+        result[path] = shard
+        loads[shard] += sizes[path]
+    return result
+
+
+def _wildcard_include(p, paths):
+    """
+    Return the patterns selecting the files matched by the wildcard include
+    pattern inside the given directories. Return the pattern itself when it
+    could match in many directories.
+    """
+    if p.pattern.startswith('**'):
+        # Could match anywhere, limit it to the directories of the shard.
+        rest = p.pattern[2:]
+        result = []
+        for path in paths:
+            if rest.startswith('/'):
+                result.append(Pattern(True, scan.escape(path) + rest, None))
+            result.append(Pattern(True, scan.escape(path) + '/**' + rest, None))
+        return result
+    literal = re.split(r'[*?\[]', p.pattern, maxsplit=1)[0]
+    if any((path + '/').startswith(literal) or literal.startswith(path + '/') for path in paths):
+        return [p]
+    return []
+
+
+def split(patterns, assignment, count):
+    """
+    Return a list of `(shard, patterns)` to backup each shard. Shards
+    without directories are omitted, except the first one.
+    """
+    others = sorted(path for path, shard in assignment.items() if shard)
+    result = [(0, [Pattern(False, scan.escape(path), None) for path in others] + list(patterns))]
+    for shard in range(1, count):
+        paths = sorted(path for path, s in assignment.items() if s == shard)
+        if not paths:
+            continue
+        prefixes = tuple(path + '/' for path in paths)
+        # Exclude patterns never extend the selection. Include patterns are
+        # replaced by the directories of this shard. Wildcard include
+        # patterns are kept to select files inside excluded folders.
+        sublist = []
+        for p in patterns:
+            if not p.include:
+                sublist.append(p)
+            elif p.is_wildcard():
+                sublist.extend(_wildcard_include(p, paths))
+            elif (p.pattern + '/').startswith(prefixes):
+                sublist.append(p)
+        if any(p.include and p.is_wildcard() and not p.pattern.startswith(prefixes) for p in sublist):
+            # Files of other shards may be matched by the wildcard patterns.
+            excluded = sorted(path for path, s in assignment.items() if s != shard)
+            sublist = [Pattern(False, scan.escape(path), None) for path in excluded] + sublist
+        sublist.extend(Pattern(True, scan.escape(path), None) for path in paths)
+        result.append((shard, sublist))
+    return result
+
+
+def sources(path, assignment):
+    """
+    Return the list of `(path, shard)` to be restored in order to restore
+    the given path.
+    """
+    path = scan.normpath(path)
+    key = path.rstrip('/')
+    for unit, shard in assignment.items():
+        if key == unit or key.startswith(unit + '/'):
+            return [(path, shard)]
+    prefix = key + '/'
+    return [(path, 0)] + sorted((u, s) for u, s in assignment.items() if s and u.startswith(prefix))
@@ -0,0 +1,157 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+import datetime
+import os
+import signal
+import tempfile
+import unittest
+from unittest import mock
+from unittest.case import skipIf
+
+from minarca_client.core import Backup
+from minarca_client.core.agent import _POLL_DELAY, _RETRY_DELAY, Agent
+from minarca_client.core.compat import IS_WINDOWS
+from minarca_client.core.config import Datetime, Pattern, Settings
+from minarca_client.core.exceptions import AgentRunningError
+
+
+class AgentTest(unittest.TestCase):
+    def setUp(self):
+        self.sigterm = signal.getsignal(signal.SIGTERM)
+        self.tmp = tempfile.TemporaryDirectory()
+        os.environ['MINARCA_CONFIG_HOME'] = self.tmp.name
+        os.environ['MINARCA_DATA_HOME'] = self.tmp.name
+        self.backup = Backup()
+        self.backup.update_settings({'remotehost': 'remotehost', 'repositoryname': 'test-repo', 'configured': True})
+        self.agent = Agent(self.backup)
+
+    def tearDown(self):
+        signal.signal(signal.SIGTERM, self.sigterm)
+        self.tmp.cleanup()
+        del os.environ['MINARCA_CONFIG_HOME']
+        del os.environ['MINARCA_DATA_HOME']
+
+    def _set_status(self, **kwargs):
+        status = self.backup.get_status()
+        status.update(kwargs)
+        status.save()
+
+    def test_next_run_delay_never_ran(self):
+        self.assertEqual(0, self.agent.next_run_delay())
+
+    def test_next_run_delay(self):
+        # Given a daily backup that ran an hour ago
+        self._set_status(lastresult='SUCCESS', lastsuccess=Datetime() - datetime.timedelta(hours=1))
+        # Then next backup is in ~22 hours.
+        self.assertAlmostEqual(Settings.DAILY * 0.98 * 3600 - 3600, self.agent.next_run_delay(), delta=5)
+
+    def test_next_run_delay_paused(self):
+        # Given a backup paused for 2 hours
+        self.backup.pause(2)
+        # Then next backup is in 2 hours.
+        self.assertAlmostEqual(2 * 3600, self.agent.next_run_delay(), delta=5)
+
+    def test_next_run_delay_after_failure(self):
+        # Given a backup that failed now
+        self._set_status(lastresult='FAILURE', lastdate=Datetime())
+        # Then backup is retried later
+        self.assertAlmostEqual(_RETRY_DELAY, self.agent.next_run_delay(), delta=5)
+
+    def test_run(self):
+        # Given a backup never executed
+        def _backup():
+            self.assertTrue(self.agent.is_running())
+            self._set_status(lastresult='SUCCESS', lastsuccess=Datetime(), lastdate=Datetime())
+
+        self.backup.backup = mock.MagicMock(side_effect=_backup)
+        # When the agent is running
+        with mock.patch.object(self.agent._stop_event, 'wait', side_effect=lambda timeout: self.agent.stop()) as wait:
+            self.agent.run()
+        # Then backup is executed
+        self.backup.backup.assert_called_once_with()
+        # Then agent sleep until next backup
+        wait.assert_called_once_with(_POLL_DELAY)
+        # Then pid file is removed
+        self.assertFalse(self.agent.is_running())
+        self.assertFalse(os.path.exists(self.agent.pid_file))
+
+    def test_run_already_running(self):
+        # Given an agent already running
+        with open(self.agent.pid_file, 'w') as f:
+            f.write(str(os.getppid()))
+        # When starting another agent
+        # Then an error is raised
+        with self.assertRaises(AgentRunningError):
+            self.agent.run()
+
+    def test_run_stale_pid_file(self):
+        # Given a pid file left by a dead agent
+        with open(self.agent.pid_file, 'w') as f:
+            f.write('999999999')
+        # When starting the agent
+        pids = []
+        with mock.patch.object(self.agent._stop_event, 'wait', side_effect=lambda timeout: self.agent.stop()):
+            with mock.patch.object(
+                self.agent, 'next_run_delay', side_effect=lambda: pids.append(self.agent.get_pid()) or 1
+            ):
+                self.agent.run()
+        # Then the pid file is replaced then removed
+        self.assertEqual([os.getpid()], pids)
+        self.assertFalse(os.path.exists(self.agent.pid_file))
+
+    def test_create_pid_file_concurrently(self):
+        # Given a pid file created by another agent in the meantime
+        with mock.patch.object(self.agent, 'get_pid', return_value=os.getppid()):
+            self.agent._create_pid_file()
+            # When creating the pid file again
+            # Then an error is raised
+            with self.assertRaises(AgentRunningError):
+                self.agent._create_pid_file()
+
+    @skipIf(IS_WINDOWS, reason='SIGTERM cannot be handled on Windows')
+    def test_terminate_during_backup(self):
+        # Given a running backup
+        def _backup():
+            # When process is terminated
+            os.kill(os.getpid(), signal.SIGTERM)
+            self.fail('backup should get interrupted')
+
+        self.backup.backup = mock.MagicMock(side_effect=_backup)
+        with mock.patch.object(self.agent._stop_event, 'wait', side_effect=lambda timeout: self.agent.stop()):
+            self.agent.run()
+        # Then only the backup is interrupted, agent continue to run.
+        self.backup.backup.assert_called_once_with()
+
+    @mock.patch('minarca_client.core.agent.journal.create_watcher')
+    def test_update_watcher(self, mock_create_watcher):
+        # Given patterns to backup
+        patterns = self.backup.get_patterns()
+        patterns.append(Pattern(True, self.tmp.name, None))
+        patterns.save()
+        mock_create_watcher.side_effect = lambda journal, roots: mock.MagicMock(roots=roots)
+        # Given watcher is disabled
+        self.agent._update_watcher()
+        mock_create_watcher.assert_not_called()
+        # When enabling watcher
+        self.backup.update_settings({'skip_unchanged': True, 'watch_changes': True})
+        self.agent._update_watcher()
+        # Then watcher is started
+        mock_create_watcher.assert_called_once()
+        watcher = self.agent._watcher
+        watcher.start.assert_called_once_with()
+        # When patterns doesn't change, then watcher continue to run.
+        self.agent._update_watcher()
+        mock_create_watcher.assert_called_once()
+        # When patterns get updated
+        patterns.append(Pattern(False, '**/*.tmp', None))
+        patterns.save()
+        self.agent._update_watcher()
+        # Then watcher get restarted.
+        watcher.stop.assert_called_once_with()
+        self.assertEqual(2, mock_create_watcher.call_count)
+        # When disabling the watcher
+        self.backup.set_settings('watch_changes', False)
+        self.agent._update_watcher()
+        # Then watcher is stopped.
+        self.assertIsNone(self.agent._watcher)
@@ -0,0 +1,81 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+import os
+import tempfile
+import unittest
+
+from minarca_client.core.autoexclude import detect, exclude, exclude_entries
+from minarca_client.core.config import Pattern
+from minarca_client.core.scan import scan
+
+
+class AutoExcludeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name.replace('\\', '/')
+        files = {
+            'proj/package.json': '{}',
+            'proj/index.js': 'foo',
+            'proj/node_modules/lib/index.js': 'library',
+            'proj/src/__pycache__/mod.pyc': 'compiled',
+            'proj/.venv/pyvenv.cfg': 'home = /usr',
+            'proj/cache/CACHEDIR.TAG': 'Signature: 8a477f597d28d172789f06886806bc55\n',
+            'proj/fake/CACHEDIR.TAG': 'not a cache',
+            'proj/target/file.txt': 'not a build output',
+            'rust/Cargo.toml': '',
+            'rust/target/debug/app': 'binary',
+        }
+        for path, data in files.items():
+            path = os.path.join(self.tmp.name, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(data)
+        self.patterns = [Pattern(True, self.root, None)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_detect(self):
+        # When detecting caches and build artifacts
+        detected = detect(self.root, self.patterns, scan(self.root, self.patterns))
+        # Then directories are detected by name and marker files.
+        self.assertEqual(
+            [
+                (self.root + '/proj/.venv', 'python-venv', 11),
+                (self.root + '/proj/cache', 'cachedir-tag', 44),
+                (self.root + '/proj/node_modules', 'node-modules', 7),
+                (self.root + '/proj/src/__pycache__', 'python-cache', 8),
+                (self.root + '/rust/target', 'cargo-target', 6),
+            ],
+            [(d.path, d.rule.id, d.size) for d in detected],
+        )
+
+    def test_detect_overridden_by_pattern(self):
+        # Given include patterns selecting detected directories
+        patterns = self.patterns + [
+            Pattern(True, self.root + '/proj/node_modules/lib', None),
+            Pattern(True, '**/__pycache__', None),
+        ]
+        # When detecting caches and build artifacts
+        detected = detect(self.root, patterns, scan(self.root, patterns))
+        # Then explicitly selected directories are not excluded.
+        paths = [d.path for d in detected]
+        self.assertNotIn(self.root + '/proj/node_modules', paths)
+        self.assertNotIn(self.root + '/proj/src/__pycache__', paths)
+        self.assertIn(self.root + '/rust/target', paths)
+
+    def test_exclude(self):
+        # Given detected directories
+        entries = scan(self.root, self.patterns)
+        detected = detect(self.root, self.patterns, entries)
+        patterns = exclude(self.patterns, detected)
+        # When scanning with the resulting patterns
+        excluded = scan(self.root, patterns)
+        # Then detected directories are excluded.
+        self.assertIn(self.root + '/proj/index.js', excluded)
+        self.assertIn(self.root + '/proj/target/file.txt', excluded)
+        self.assertNotIn(self.root + '/proj/node_modules/lib/index.js', excluded)
+        self.assertNotIn(self.root + '/rust/target/debug/app', excluded)
+        # Then same entries are excluded without scanning again.
+        self.assertEqual(excluded, exclude_entries(entries, detected))
@@ -7,6 +7,7 @@ Created on Jun. 7, 2021
 @author: Patrik Dufresne <patrik@ikus-soft.com>
 '''
 import os
+import signal
 import subprocess
 import tempfile
 import threading
@@ -18,9 +19,9 @@ from unittest.mock import MagicMock
 
 import responses
 
-from minarca_client.core import Backup
+from minarca_client.core import Backup, history, scan
 from minarca_client.core.compat import IS_WINDOWS
-from minarca_client.core.config import Datetime, Pattern, Patterns, Settings
+from minarca_client.core.config import Datetime, Pattern, Patterns, Settings, Status
 from minarca_client.core.exceptions import (
     BackupError,
     HttpAuthenticationError,
@@ -30,9 +31,12 @@ from minarca_client.core.exceptions import (
     NoPatternsError,
     NotConfiguredError,
     NotScheduleError,
+    RdiffBackupExitError,
     RepositoryNameExistsError,
     UnknownHostException,
 )
+from minarca_client.core.journal import Journal, roots_digest
+from minarca_client.core.tests.test_download import FakeResponse, make_tar
 from minarca_client.locale import gettext as _
 from minarca_client.tests.test import MATCH
 
@@ -61,6 +65,11 @@ def mock_subprocess_link(*args, **kwargs):
     return _original_subprocess_popen(*args, **kwargs)
 
 
+def _main_run_unknown_host(options):
+    print('ssh: Could not resolve hostname remotehost')
+    return 1
+
+
 def mock_subprocess_popen(replace_cmd):
     def mock_call(*args, **kwargs):
         return _original_subprocess_popen(replace_cmd, **kwargs)
@@ -456,6 +465,60 @@ class TestBackup(unittest.TestCase):
             errors='replace',
         )
 
+    @skipIf(IS_WINDOWS, reason='fork engine not supported')
+    @mock.patch('minarca_client.core.compat.get_user_agent', return_value='minarca/DEV rdiff-backup/2.0.0 (os info)')
+    @mock.patch('subprocess.Popen')
+    @mock.patch('minarca_client.core.engine._load_main_run')
+    def test_rdiff_backup_with_fork_engine(self, mock_load_main_run, mock_popen, *unused):
+        mock_load_main_run.return_value = _main_run_unknown_host
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['engine'] = 'fork'
+        config.save()
+        # When executing rdiff-backup with fork engine
+        # Then output of the worker get captured
+        with self.assertRaises(UnknownHostException):
+            self.backup._rdiff_backup(extra_args=['--include', _home], path=_root)
+        # Then rdiff-backup is not spawned
+        mock_popen.assert_not_called()
+
+    @skipIf(IS_WINDOWS, reason='fork engine not supported')
+    def test_start_fork_server_killed(self):
+        # Given a fork server
+        self.backup.set_settings('engine', 'fork')
+        server = self.backup.start_fork_server()
+        self.assertTrue(server)
+        # When the fork server get killed
+        os.kill(server.pid, signal.SIGTERM)
+        os.waitpid(server.pid, 0)
+        # Then a new fork server replace it or the subprocess engine is used.
+        new_server = self.backup.start_fork_server()
+        self.assertIsNot(server, new_server)
+        if new_server:
+            self.assertTrue(new_server.is_alive())
+            new_server.close()
+
+    @mock.patch('minarca_client.core.psutil.Process')
+    def test_stop_keep_fork_server(self, mock_process):
+        # Given a backup running with a fork server
+        status = Status(self.backup.status_file)
+        status['lastresult'] = 'RUNNING'
+        status['lastdate'] = Datetime()
+        status['pid'] = os.getpid()
+        status['fork_pid'] = 1234
+        status.save()
+        fork_server = MagicMock(pid=1234)
+        worker = MagicMock(pid=1235)
+        worker.name.return_value = 'minarca'
+        mock_process.return_value.children.return_value = [fork_server, worker]
+        mock_process.return_value.is_running.return_value = True
+        # When stopping the backup
+        self.backup.stop()
+        # Then workers are terminated, but not the fork server.
+        worker.terminate.assert_called()
+        fork_server.terminate.assert_not_called()
+
     @mock.patch('minarca_client.core.compat.get_user_agent', return_value='minarca/DEV rdiff-backup/2.0.0 (os info)')
     @mock.patch('subprocess.Popen', side_effect=mock_subprocess_popen(_exit_1_cmd))
     def test_rdiff_backup_return_error(self, mock_popen, *unused):
@@ -507,6 +570,100 @@ class TestBackup(unittest.TestCase):
             errors='replace',
         )
 
+    @mock.patch('minarca_client.core.compat.get_ssh', return_value=_ssh)
+    @mock.patch('subprocess.Popen', side_effect=mock_subprocess_popen(_echo_foo_cmd))
+    def test_rdiff_backup_shard(self, mock_rdiff_backup, *unused):
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config.save()
+        # When executing rdiff-backup for a shard
+        self.backup._rdiff_backup(extra_args=['--include', _home], path=_root, shard=2)
+        # Then the repository of the shard is used
+        self.assertEqual(
+            'minarca@remotehost::test-repo.shard2/C/' if IS_WINDOWS else 'minarca@remotehost::test-repo.shard2/',
+            mock_rdiff_backup.call_args[0][0][-1],
+        )
+
+    @mock.patch('minarca_client.core.compat.get_ssh', return_value=_ssh)
+    @mock.patch('subprocess.Popen', side_effect=mock_subprocess_popen(_echo_foo_cmd))
+    def test_rdiff_backup_tier(self, mock_rdiff_backup, *unused):
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config.save()
+        # When executing rdiff-backup for a shard of a tier
+        self.backup._rdiff_backup(extra_args=['--include', _home], path=_root, shard=2, tier='critical')
+        # Then the repository of the shard of the tier is used
+        self.assertEqual(
+            (
+                'minarca@remotehost::test-repo.critical.shard2/C/'
+                if IS_WINDOWS
+                else 'minarca@remotehost::test-repo.critical.shard2/'
+            ),
+            mock_rdiff_backup.call_args[0][0][-1],
+        )
+
+    @mock.patch('minarca_client.core.compat.get_user_agent', return_value='minarca/DEV rdiff-backup/2.0.0 (os info)')
+    @mock.patch('subprocess.call', return_value=0)
+    @mock.patch('subprocess.Popen', side_effect=mock_subprocess_popen(_echo_foo_cmd))
+    def test_rdiff_backup_ssh_multiplexing(self, mock_rdiff_backup, mock_call, *unused):
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['ssh_multiplexing'] = True
+        config.save()
+        # When executing rdiff-backup with multiplexing
+        with self.backup._ssh_multiplexing():
+            self.backup._rdiff_backup(extra_args=['--include', _home], path=_root)
+        # Then master connection get started and stopped
+        self.assertEqual(2, mock_call.call_count)
+        self.assertEqual(
+            [_ssh, '-M', '-N', '-f', MATCH('-oControlPath=*ssh-*'), '-oControlPersist=60', 'minarca@remotehost'],
+            [mock_call.call_args_list[0][0][0][0]] + mock_call.call_args_list[0][0][0][-6:],
+        )
+        self.assertEqual(
+            [MATCH('-oControlPath=*ssh-*'), '-O', 'exit', 'minarca@remotehost'],
+            mock_call.call_args_list[1][0][0][-4:],
+        )
+        # Then rdiff-backup use the master connection
+        mock_rdiff_backup.assert_called_once_with(
+            [
+                mock.ANY,
+                'rdiff-backup',
+                '-v',
+                '5',
+                '--remote-schema',
+                MATCH(
+                    _ssh
+                    + " -oBatchMode=yes -oPreferredAuthentications=publickey -oUserKnownHostsFile=*known_hosts -oIdentitiesOnly=yes -i *id_rsa -oControlMaster=no -oControlPath=*ssh-* %s 'minarca/DEV rdiff-backup/2.0.0 (os info)'"
+                ),
+                'backup',
+                '--include',
+                _home,
+                _root,
+                'minarca@remotehost::test-repo/C/' if IS_WINDOWS else 'minarca@remotehost::test-repo/',
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            encoding='utf-8',
+            errors='replace',
+        )
+
+    @mock.patch('subprocess.call', return_value=255)
+    def test_ssh_multiplexing_with_error(self, mock_call):
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['ssh_multiplexing'] = True
+        config.save()
+        # When master connection cannot be established
+        with self.backup._ssh_multiplexing():
+            # Then rdiff-backup doesn't use multiplexing
+            self.assertEqual({}, self.backup._control_paths)
+        mock_call.assert_called_once()
+
     def test_rdiff_backup_threading(self):
         self.error = None
 
@@ -596,16 +753,28 @@ class TestBackup(unittest.TestCase):
                     '--exclude-symbolic-links',
                     '--create-full-path',
                     '--no-compression',
+                    '--print-statistics',
                     '--include',
                     _home,
                     '--exclude',
                     'C:/**',
                 ],
                 path='C:/',
+                on_line=mock.ANY,
             )
         else:
             self.backup._rdiff_backup.assert_called_once_with(
-                extra_args=['--exclude-sockets', '--no-compression', '--include', _home, '--exclude', '/**'], path='/'
+                extra_args=[
+                    '--exclude-sockets',
+                    '--no-compression',
+                    '--print-statistics',
+                    '--include',
+                    _home,
+                    '--exclude',
+                    '/**',
+                ],
+                path='/',
+                on_line=mock.ANY,
             )
         # Check status
         status = self.backup.get_status()
@@ -614,6 +783,902 @@ class TestBackup(unittest.TestCase):
         self.assertEqual('SUCCESS', status['lastresult'])
         self.assertEqual('', status['details'])
 
+    def test_backup_auto_exclude(self):
+        # Given a backup configured to exclude caches and build artifacts
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config['auto_exclude'] = True
+        config.save()
+        project = os.path.join(self.tmp.name, 'project')
+        os.makedirs(os.path.join(project, 'node_modules'))
+        for name in ['package.json', 'node_modules/index.js']:
+            with open(os.path.join(project, name), 'w') as f:
+                f.write('foo')
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, project, None))
+        patterns.save()
+        self.backup._rdiff_backup = MagicMock()
+        # When running the backup
+        with self.assertLogs('minarca_client.core', level='INFO') as logs:
+            self.backup.backup(force=True)
+        # Then detected directories are excluded from rdiff-backup selection.
+        extra_args = self.backup._rdiff_backup.call_args.kwargs['extra_args']
+        node_modules = os.path.join(project, 'node_modules').replace('\\', '/')
+        idx = extra_args.index('--exclude')
+        self.assertEqual(['--exclude', node_modules, '--include'], extra_args[idx : idx + 3])
+        # Then bytes avoided are reported.
+        self.assertTrue(any('avoided 3 B' in line for line in logs.output))
+
+    @mock.patch.object(Backup, 'is_backup_time', return_value=True)
+    def test_backup_auto_exclude_skip_unchanged(self, *unused):
+        # Given a backup configured to exclude caches and skip unchanged files
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config['auto_exclude'] = True
+        config['skip_unchanged'] = True
+        config.save()
+        project = os.path.join(self.tmp.name, 'project')
+        os.makedirs(os.path.join(project, 'node_modules'))
+        for name in ['package.json', 'node_modules/index.js']:
+            with open(os.path.join(project, name), 'w') as f:
+                f.write('foo')
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, project, None))
+        patterns.save()
+        self.backup._rdiff_backup = MagicMock()
+        # Given a first backup
+        with mock.patch('minarca_client.core.scan.scan', wraps=scan.scan) as mock_scan:
+            self.backup.backup()
+        # Then files are scanned once.
+        mock_scan.assert_called_once()
+        self.assertEqual(1, self.backup._rdiff_backup.call_count)
+        # When a file get modified in an excluded directory
+        with open(os.path.join(project, 'node_modules', 'index.js'), 'w') as f:
+            f.write('modified')
+        self.backup.backup()
+        # Then backup is skipped
+        self.assertEqual(1, self.backup._rdiff_backup.call_count)
+        # When the directory is no longer detected
+        os.remove(os.path.join(project, 'package.json'))
+        self.backup.backup()
+        # Then backup is executed without exclusion.
+        self.assertEqual(2, self.backup._rdiff_backup.call_count)
+        self.assertNotIn('--exclude', self.backup._rdiff_backup.call_args.kwargs['extra_args'][:-2])
+
+    def test_dry_run(self):
+        # Given a backup configured with a few files
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config.save()
+        data = os.path.join(self.tmp.name, 'data').replace('\\', '/')
+        os.mkdir(data)
+        for name in ['new.txt', 'changed.txt', 'same.txt']:
+            with open(os.path.join(data, name), 'w') as f:
+                f.write('foo')
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, data, None))
+        patterns.save()
+
+        # Given a server reporting differences with the mirror
+        def _rdiff_backup(action, extra_args, path, on_line, shard, tier, destination):
+            self.assertEqual(('compare', 0, None), (action, shard, tier))
+            self.assertEqual(['--method', 'meta'], extra_args[1:3])
+            relpath = data[len(_root) :]
+            for line in ['new: %s/new.txt' % relpath, 'changed: %s/changed.txt' % relpath, 'deleted: %s/old' % relpath]:
+                on_line(line + '\n')
+
+        self.backup._rdiff_backup = MagicMock(side_effect=_rdiff_backup)
+        # When running a dry-run
+        result = self.backup.dry_run()
+        # Then differences are reported
+        self.assertEqual(1, len(result))
+        self.assertEqual((1, 1, 1, 6), tuple(result[0][k] for k in ['new', 'changed', 'deleted', 'bytes']))
+        self.assertIsNone(result[0]['eta'])
+        self.assertIsNone(result[0]['snapshot'])
+        # When running again with a known transfer rate
+        lastsuccess = Datetime() - timedelta(hours=2)
+        status = Status(self.backup.status_file)
+        status['stats.%s.rate' % _root] = '2'
+        status['lastsuccess'] = lastsuccess
+        status.save()
+        result = self.backup.dry_run()
+        # Then the cached snapshot is used
+        self.assertEqual(1, self.backup._rdiff_backup.call_count)
+        self.assertEqual((1, 1, 1, 6), tuple(result[0][k] for k in ['new', 'changed', 'deleted', 'bytes']))
+        self.assertEqual(3, result[0]['eta'])
+        # Then the snapshot is dated from the last successful backup.
+        self.assertEqual(int(lastsuccess), int(result[0]['snapshot']))
+
+    def test_backup_with_shards(self):
+        # Given a backup configured with shards
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config['shards'] = 2
+        config.save()
+        share = os.path.join(self.tmp.name, 'share').replace('\\', '/')
+        for name, size in [('big', 100), ('small', 10)]:
+            os.makedirs(os.path.join(share, name))
+            with open(os.path.join(share, name, 'file.bin'), 'w') as f:
+                f.write('x' * size)
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, share, None))
+        patterns.save()
+        # When estimating the backup
+        with mock.patch.object(self.backup, '_get_snapshot', return_value=({}, None)):
+            self.backup.dry_run()
+        # Then the assignment of the shards is not persisted.
+        self.assertFalse(os.path.exists(self.backup.shards_file))
+        self.backup._rdiff_backup = MagicMock()
+        # When running the backup
+        self.backup.backup(force=True)
+        # Then a session is executed for each shard.
+        self.assertEqual(2, self.backup._rdiff_backup.call_count)
+        calls = sorted(self.backup._rdiff_backup.call_args_list, key=lambda c: c.kwargs.get('shard', 0))
+        self.assertNotIn('shard', calls[0].kwargs)
+        self.assertIn(share + '/small', calls[0].kwargs['extra_args'])
+        self.assertEqual(1, calls[1].kwargs['shard'])
+        self.assertEqual(['--include', share + '/small', '--exclude', _root + '**'], calls[1].kwargs['extra_args'][-4:])
+        self.assertEqual([(_root, 'SUCCESS', ''), (_root + '#1', 'SUCCESS', '')], self.backup.get_status().sessions())
+        # Then the repository of each shard get listed.
+        self.backup.set_settings('remoteurl', 'http://remotehost')
+        self.backup.set_settings('username', 'username')
+        repos = ['test-repo/C', 'test-repo.shard1/C'] if IS_WINDOWS else ['test-repo', 'test-repo.shard1']
+        self.assertEqual(['http://remotehost/browse/username/' + r for r in repos], self.backup.get_repo_urls())
+        # When restoring the data
+        self.backup._rdiff_backup.reset_mock()
+        self.backup.restore()
+        # Then each shard is restored from its own repository.
+        self.assertEqual(
+            [
+                mock.call(
+                    'restore', ['--at', 'now'], path=share, on_line=mock.ANY, shard=0, tier=None, destination=None
+                ),
+                mock.call(
+                    'restore',
+                    ['--at', 'now'],
+                    path=share + '/small',
+                    on_line=mock.ANY,
+                    shard=1,
+                    tier=None,
+                    destination=None,
+                ),
+            ],
+            self.backup._rdiff_backup.call_args_list,
+        )
+
+    def test_backup_with_tiers(self):
+        # Given a backup configured with two tiers
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config.save()
+        self.backup.add_tier('critical', Settings.HOURLY)
+        self.backup.set_patterns([Pattern(True, _home + '/docs', None)], 'critical')
+        self.backup.set_patterns([Pattern(True, _home + '/videos', None)])
+        self.backup._rdiff_backup = MagicMock()
+        # When running the backup
+        self.backup.backup()
+        # Then each tier is backup in priority order into its own repository.
+        self.assertEqual(2, self.backup._rdiff_backup.call_count)
+        first, second = self.backup._rdiff_backup.call_args_list
+        self.assertEqual('critical', first.kwargs['tier'])
+        self.assertIn(_home + '/docs', first.kwargs['extra_args'])
+        self.assertNotIn('tier', second.kwargs)
+        self.assertIn(_home + '/videos', second.kwargs['extra_args'])
+        # Then the last success of each tier is recorded.
+        status = self.backup.get_status()
+        self.assertIsNotNone(status.tier_lastsuccess('critical'))
+        self.assertIsNotNone(status['lastsuccess'])
+        # When the tier of higher priority is due
+        status = Status(self.backup.status_file)
+        status['tier.critical.lastsuccess'] = Datetime() - timedelta(hours=2)
+        status.save()
+        self.assertLessEqual(self.backup.next_backup_time(), Datetime())
+        self.backup._rdiff_backup.reset_mock()
+        self.backup.backup()
+        # Then only this tier is executed.
+        self.assertEqual(1, self.backup._rdiff_backup.call_count)
+        self.assertEqual('critical', self.backup._rdiff_backup.call_args.kwargs['tier'])
+        # When restoring a path of the tier
+        self.backup._rdiff_backup.reset_mock()
+        self.backup.restore(patterns=[Pattern(True, _home + '/docs/report.odt', None)])
+        # Then it get restored from the repository of the tier.
+        self.backup._rdiff_backup.assert_called_once_with(
+            'restore',
+            ['--at', 'now'],
+            path=_home + '/docs/report.odt',
+            on_line=mock.ANY,
+            shard=0,
+            tier='critical',
+            destination=None,
+        )
+
+    def test_backup_with_tiers_failure(self):
+        # Given a backup configured with two tiers
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config.save()
+        self.backup.add_tier('critical', Settings.HOURLY)
+        self.backup.set_patterns([Pattern(True, _home + '/docs', None)], 'critical')
+        self.backup.set_patterns([Pattern(True, _home + '/videos', None)])
+        # Given the tier of higher priority failing
+        error = RdiffBackupExitError(1)
+
+        def _rdiff_backup(extra_args, path, on_line, tier=None):
+            if tier:
+                raise error
+
+        self.backup._rdiff_backup = MagicMock(side_effect=_rdiff_backup)
+        # When running the backup
+        with self.assertRaises(RdiffBackupExitError):
+            self.backup.backup()
+        # Then the result of each tier is recorded.
+        status = self.backup.get_status()
+        self.assertEqual(('FAILURE', str(error)), status.tier_result('critical'))
+        self.assertEqual(('SUCCESS', ''), status.tier_result(None))
+        # Then the overall result is the worst result.
+        self.assertEqual('FAILURE', status['lastresult'])
+        self.assertEqual('critical: %s' % error, status['details'])
+        self.assertEqual(2, len(status.sessions()))
+        # When only the default tier is executed again
+        self.backup.backup(force_patterns=self.backup.get_patterns())
+        # Then the failure of the other tier is not hidden.
+        status = self.backup.get_status()
+        self.assertEqual('FAILURE', status['lastresult'])
+        self.assertEqual(('FAILURE', str(error)), status.tier_result('critical'))
+        self.assertEqual(2, len(status.sessions()))
+
+    def test_get_tiers(self):
+        # Given a tier without patterns
+        self.backup.add_tier('critical', Settings.HOURLY)
+        self.backup.set_patterns([Pattern(True, _home + '/videos', None)])
+        # Then the tier is ignored.
+        self.assertEqual([None], [t.name for t in self.backup.get_tiers()])
+        # When patterns are defined for the tier
+        self.backup.set_patterns([Pattern(True, _home + '/docs', None)], 'critical')
+        # Then the tier is returned.
+        self.assertEqual(['critical', None], [t.name for t in self.backup.get_tiers()])
+        # When the patterns file didn't changed
+        with mock.patch('minarca_client.core.Patterns') as mock_patterns:
+            with mock.patch('minarca_client.core._file_signature', side_effect=lambda f: f):
+                self.backup.get_tiers()
+                self.backup.get_tiers()
+        # Then it's parsed once.
+        self.assertEqual(2, mock_patterns.call_count)
+
+    @mock.patch('minarca_client.core._PREEMPT_DELAY', 0.01)
+    def test_backup_tier_preempted(self, *unused):
+        # Given a backup configured with two tiers
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config.save()
+        self.backup.add_tier('critical', Settings.HOURLY)
+        self.backup.set_patterns([Pattern(True, _home + '/docs', None)], 'critical')
+        self.backup.set_patterns([Pattern(True, _home + '/videos', None)])
+        status = Status(self.backup.status_file)
+        status['tier.critical.lastsuccess'] = Datetime() - timedelta(hours=0.98) + timedelta(seconds=1)
+        status.save()
+        # Given a low priority backup running when the high priority tier become due
+        executed = []
+
+        def _rdiff_backup(extra_args, path, on_line, tier=None):
+            executed.append(tier)
+            if tier is None and len(executed) == 1:
+                self.assertTrue(self.backup._cancel_event.wait(5))
+                raise RdiffBackupExitError(-15)
+
+        self.backup._rdiff_backup = MagicMock(side_effect=_rdiff_backup)
+        # When running the backup
+        self.backup.backup()
+        # Then low priority tier is interrupted and executed again after the high priority tier.
+        self.assertEqual([None, 'critical', None], executed)
+        self.assertEqual('SUCCESS', self.backup.get_status('lastresult'))
+
+    @mock.patch.object(Backup, 'is_backup_time', return_value=True)
+    def test_backup_with_destinations(self, *unused):
+        # Given a backup configured with an additional destination
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config['skip_unchanged'] = True
+        config['destinations'] = 'offsite'
+        config['destination.offsite.remotehost'] = 'offsite:2222'
+        config['destination.offsite.repositoryname'] = 'test-repo'
+        config.save()
+        data = os.path.join(self.tmp.name, 'data')
+        os.mkdir(data)
+        with open(os.path.join(data, 'file.txt'), 'w') as f:
+            f.write('foo')
+        self.backup.set_patterns([Pattern(True, data, None)])
+        self.backup._rdiff_backup = MagicMock()
+        # When running the backup
+        with mock.patch('minarca_client.core.scan.scan', wraps=scan.scan) as mock_scan:
+            self.backup.backup()
+        # Then files are scanned once
+        self.assertEqual(1, mock_scan.call_count)
+        # Then a session is executed for each destination.
+        self.assertEqual(2, self.backup._rdiff_backup.call_count)
+        destinations = sorted(c.kwargs.get('destination', '') for c in self.backup._rdiff_backup.call_args_list)
+        self.assertEqual(['', 'offsite'], destinations)
+        self.assertEqual(
+            [(_root, 'SUCCESS', ''), (_root + '@offsite', 'SUCCESS', '')], self.backup.get_status().sessions()
+        )
+        # When a session failed for a single destination
+        with open(os.path.join(data, 'file.txt'), 'w') as f:
+            f.write('modified')
+
+        def _rdiff_backup(destination=None, **kwargs):
+            if destination:
+                raise RdiffBackupExitError(1)
+
+        self.backup._rdiff_backup = MagicMock(side_effect=_rdiff_backup)
+        with self.assertRaises(RdiffBackupExitError):
+            self.backup.backup()
+        # Then status is reported per destination.
+        status = self.backup.get_status()
+        sessions = status.sessions()
+        self.assertEqual(['SUCCESS', 'FAILURE'], [result for unused, result, details in sessions])
+        # Then the last success is recorded per destination.
+        self.assertLess(status.session_lastsuccess(_root + '@offsite'), status.session_lastsuccess(_root))
+        # When running again
+        self.backup._rdiff_backup = MagicMock()
+        self.backup.backup()
+        # Then only the failing destination get executed.
+        self.backup._rdiff_backup.assert_called_once()
+        self.assertEqual('offsite', self.backup._rdiff_backup.call_args.kwargs['destination'])
+
+    @mock.patch('subprocess.Popen', side_effect=mock_subprocess_link)
+    @mock.patch("minarca_client.core.Rdiffweb")
+    def test_link_destination(self, mock_rdiffweb, *unused):
+        # Given a linked backup
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config.save()
+        mock_rdiffweb.return_value.get_current_user_info = mock.MagicMock(
+            return_value={'email': 'admin@example.com', 'username': 'admin', 'repos': []}
+        )
+        mock_rdiffweb.return_value.get_minarca_info = mock.MagicMock(
+            return_value={'remotehost': 'offsite', 'version': '3.9.0', 'identity': IDENTITY}
+        )
+        # When linking an additional destination
+        self.backup.link("http://offsite", "admin", "admin", "coucou", destination='offsite')
+        # Then the destination is added with its own identity.
+        destinations = self.backup.get_settings().destinations()
+        self.assertEqual(['remotehost', 'offsite'], [d.remotehost for d in destinations])
+        self.assertEqual('coucou', destinations[1].repositoryname)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, 'known_hosts-offsite')))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp.name, 'id_rsa-offsite')))
+        self.assertFalse(os.path.exists(self.backup.known_hosts))
+        # Then primary destination is not changed.
+        self.assertEqual('test-repo', self.backup.get_settings('repositoryname'))
+        # When unlinking the destination
+        self.backup.unlink('offsite')
+        # Then only the primary destination remains.
+        self.assertEqual(1, len(self.backup.get_settings().destinations()))
+        self.assertTrue(self.backup.is_linked())
+
+    def test_restore_differential(self):
+        # Given a local folder partially damaged
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config.save()
+        root = self.tmp.name.replace('\\', '/') + '/share'
+        for name, size in [('a.txt', 10), ('b.bin', 1000), ('local.txt', 5), ('sub/d.txt', 20)]:
+            os.makedirs(os.path.dirname(os.path.join(root, name)), exist_ok=True)
+            with open(os.path.join(root, name), 'w') as f:
+                f.write('x' * size)
+        # Given rdiff-backup reporting differences by content
+        report = [
+            'metadata the same, data changed: a.txt',
+            'deleted: gone',
+            'deleted: gone/c.txt',
+            'new: local.txt',
+            'metadata changed, data the same: sub',
+            'metadata changed, data changed: sub/d.txt',
+        ]
+        commands = []
+        restored = []
+
+        def _popen(args, **kwargs):
+            commands.append(args)
+            if 'restore' in args:
+                # Filelist only exists while rdiff-backup is running.
+                with open(args[args.index('--include-filelist') + 1], encoding='utf-8') as f:
+                    restored.extend(f.read().splitlines())
+            process = MagicMock()
+            process.stdout = [line + '\n' for line in report] if 'compare' in args else []
+            process.wait.return_value = 0
+            return process
+
+        # When restoring only the differences
+        with mock.patch('subprocess.Popen', side_effect=_popen):
+            self.backup.restore(
+                restore_time='1682367069', patterns=[Pattern(True, root, None)], differential=True, verify=True
+            )
+        # Then the folder is compared with the backup.
+        self.assertEqual(2, len(commands))
+        compare, restore = commands
+        self.assertEqual(
+            ['compare', '--exclude-symbolic-links' if IS_WINDOWS else '--exclude-sockets', '--method', 'hash'],
+            compare[compare.index('compare') : compare.index('compare') + 4],
+        )
+        self.assertEqual([root, MATCH('minarca@remotehost::test-repo*share')], compare[-2:])
+        # Then files with differences are restored by a single session from the repository root.
+        self.assertEqual(
+            ['restore', '--at', '1682367069', '--include-filelist', mock.ANY, '--exclude', '**'],
+            restore[restore.index('restore') : restore.index('restore') + 7],
+        )
+        self.assertEqual(
+            ['minarca@remotehost::test-repo/C/' if IS_WINDOWS else 'minarca@remotehost::test-repo/', _root],
+            restore[-2:],
+        )
+        # Then the filelist contains the absolute path of each file.
+        self.assertEqual([root + '/' + name for name in ['a.txt', 'gone', 'gone/c.txt', 'sub/d.txt']], restored)
+        # Then identical files are reported as skipped.
+        self.assertEqual(
+            [(root, 'SUCCESS', '4 files restored, 1005 B identical skipped')],
+            list(self.backup.get_status().sessions()),
+        )
+
+    def test_restore_largest_first(self):
+        # Given a backup with multiple folders of different sizes
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config.save()
+        root = self.tmp.name.replace('\\', '/')
+        self.backup.set_patterns([Pattern(True, root, None)])
+        scan.Manifest(self.backup._manifest_file(_root)).save(
+            'digest', {root + '/' + name + '/file.bin': (size, 0) for name, size in [('small', 10), ('big', 100)]}
+        )
+        # Given a local copy with different sizes
+        for name, size in [('small', 1000), ('big', 1), ('big/sub', 1)]:
+            os.makedirs(os.path.join(root, name), exist_ok=True)
+            with open(os.path.join(root, name, 'file.bin'), 'w') as f:
+                f.write('x' * size)
+        patterns = [Pattern(True, root + '/' + name, None) for name in ['small', 'big/sub', 'big']]
+        # Given a restore of the parent folder running concurrently
+        started = []
+        barrier = threading.Barrier(2, timeout=5)
+
+        def _rdiff_backup(action, extra_args, path, on_line, shard, tier, destination):
+            started.append(path[len(root) + 1 :])
+            if path.endswith('small') or path.endswith('big'):
+                barrier.wait()
+            if path.endswith('sub'):
+                raise RdiffBackupExitError(1)
+
+        self.backup._rdiff_backup = MagicMock(side_effect=_rdiff_backup)
+        # When restoring the folders
+        with self.assertRaises(RdiffBackupExitError):
+            self.backup.restore(patterns=patterns)
+        # Then largest folders are restored first, concurrently.
+        self.assertEqual(['big', 'small'], sorted(started[0:2]))
+        # Then sub folders are restored after their parent.
+        self.assertEqual('big/sub', started[2])
+        # Then the result of each folder is reported.
+        self.assertEqual(
+            [(root + '/big', 'SUCCESS'), (root + '/big/sub', 'FAILURE'), (root + '/small', 'SUCCESS')],
+            [(name, result) for name, result, details in self.backup.get_status().sessions()],
+        )
+        self.assertEqual('FAILURE', self.backup.get_status('lastresult'))
+        # When restoring the folders one at a time
+        self.backup.set_settings('max_parallel_restore', 1)
+        started.clear()
+        self.backup._rdiff_backup = MagicMock(
+            side_effect=lambda *args, **kwargs: started.append(kwargs['path'][len(root) + 1 :])
+        )
+        self.backup.restore(patterns=patterns)
+        # Then largest folder in the backup is restored first.
+        self.assertEqual(['big', 'small', 'big/sub'], started)
+
+    def test_restore_sizes_from_history(self):
+        # Given a backup without manifest
+        root = self.tmp.name.replace('\\', '/')
+        self.backup.set_patterns([Pattern(True, root, None)])
+        # Given the size of the last session and the files in the history index
+        status = Status(self.backup.status_file)
+        status['stats.%s.size' % _root] = '1000'
+        status.save()
+        files = [root.lstrip('/') + '/big/%d' % i for i in range(3)] + [root.lstrip('/') + '/small/0']
+        index = history.History(self.backup.history_file)
+        index.update(_root, _root, 1, [100], lambda epoch: files)
+        index.save()
+        # When estimating the size of the restored paths
+        sizes = self.backup._restore_sizes(
+            [(None, (root + '/big', 0)), (None, (root + '/small', 0)), (None, (_root, 0)), (None, ('/other', 0))]
+        )
+        # Then the size of the session is prorated by the number of files.
+        self.assertEqual([750, 250, 1000, 0], sizes)
+
+    def test_restore_http(self):
+        # Given a backup with a folder to be restored
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config.save()
+        target = self.tmp.name.replace('\\', '/') + '/docs'
+        # Given a server streaming the folder as a tar archive
+        rdiffweb = MagicMock()
+        rdiffweb.restore.side_effect = lambda repo_path, date, offset: FakeResponse(make_tar({'report.odt': b'data'}))
+        # When restoring the folder over HTTP
+        self.backup._rdiff_backup = MagicMock()
+        self.backup.restore(restore_time='1682367069', patterns=[Pattern(True, target, None)], rdiffweb=rdiffweb)
+        # Then the folder is downloaded from the repository.
+        self.backup._rdiff_backup.assert_not_called()
+        repo_path = 'test-repo/%s/%s' % (target[0], target[3:]) if IS_WINDOWS else 'test-repo' + target
+        rdiffweb.restore.assert_called_once_with(repo_path, 1682367069, 0)
+        with open(os.path.join(target, 'report.odt'), 'rb') as f:
+            self.assertEqual(b'data', f.read())
+        self.assertEqual('SUCCESS', self.backup.get_status('lastresult'))
+
+    def test_fetch_patterns(self):
+        # Given a backup with patterns
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['remoteurl'] = 'http://localhost'
+        config['configured'] = True
+        config.save()
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, _home, None))
+        patterns.save()
+        status = self.backup.get_status()
+        # Given a server returning previous patterns
+        rdiffweb = MagicMock()
+        rdiffweb.restore.return_value.content = b'# Documents\n+%s/docs\n-**/*.tmp\n' % _home.encode()
+        # When fetching the patterns from the server
+        fetched = self.backup.fetch_patterns(rdiffweb)
+        # Then previous patterns are returned.
+        self.assertEqual([Pattern(True, _home + '/docs', 'Documents'), Pattern(False, '**/*.tmp', None)], fetched)
+        path = scan.normpath(self.backup.patterns_file)
+        repo_path = 'test-repo/%s/%s' % (path[0], path[3:]) if IS_WINDOWS else 'test-repo' + path
+        rdiffweb.restore.assert_called_once_with(repo_path, mock.ANY)
+        # Then local patterns and status are unchanged.
+        self.assertEqual([Pattern(True, _home, None)], self.backup.get_patterns())
+        self.assertEqual(status, self.backup.get_status())
+
+    def test_fetch_patterns_with_identity(self):
+        # Given a backup with patterns
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config.save()
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, _home, None))
+        patterns.save()
+        status = self.backup.get_status()
+
+        # Given a repository with previous patterns
+        def _rdiff_backup(action, extra_args, path, shard, tier, destination, target):
+            with open(target, 'w') as f:
+                f.write('+%s/docs\n' % _home)
+
+        self.backup._rdiff_backup = MagicMock(side_effect=_rdiff_backup)
+        # When fetching the patterns without Rdiffweb session
+        fetched = self.backup.fetch_patterns()
+        # Then the patterns file is restored with the SSH identity in another location.
+        self.assertEqual([Pattern(True, _home + '/docs', None)], fetched)
+        self.assertEqual(self.backup.patterns_file, self.backup._rdiff_backup.call_args.kwargs['path'])
+        self.assertNotEqual(self.backup.patterns_file, self.backup._rdiff_backup.call_args.kwargs['target'])
+        # Then local patterns and status are unchanged.
+        self.assertEqual([Pattern(True, _home, None)], self.backup.get_patterns())
+        self.assertEqual(status, self.backup.get_status())
+
+    def test_update_history(self):
+        # Given a backup with a successful session
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config.save()
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, _home + '/docs', None))
+        patterns.save()
+        status = Status(self.backup.status_file)
+        status['lastsuccess'] = Datetime()
+        status.save()
+        # Given a repository with many increments
+        output = {
+            'increments': [
+                'Found 2 increments:\n',
+                '    increments.2023-04-22T10:51:09-04:00.dir   Sat Apr 22 10:51:09 2023\n',
+                '    increments.2023-04-23T10:51:09-04:00.dir   Sun Apr 23 10:51:09 2023\n',
+                'Current mirror: Mon Apr 24 10:51:09 2023\n',
+            ],
+            'files': ['.\n', 'home\n', 'home/docs\n', 'home/docs/report.odt\n'],
+        }
+
+        def _rdiff_backup(action, extra_args, path, on_line, shard, tier, destination):
+            for line in output[extra_args[0]]:
+                on_line(line)
+
+        self.backup._rdiff_backup = MagicMock(side_effect=_rdiff_backup)
+        # When updating the history
+        history = self.backup.update_history()
+        # Then increments and files of the oldest and latest increments get listed.
+        self.assertEqual(3, self.backup._rdiff_backup.call_count)
+        self.assertEqual(['report.odt'], [name for name, epoch in history.ls(_root + 'home/docs')])
+        # When updating again without new backup
+        self.backup._rdiff_backup.reset_mock()
+        history = self.backup.update_history()
+        # Then the server is not contacted.
+        self.backup._rdiff_backup.assert_not_called()
+        self.assertEqual(1, len(history.find('report')))
+        # Given an additional destination with a successful session
+        config = Settings(self.backup.config_file)
+        config['destinations'] = 'offsite'
+        config['destination.offsite.remotehost'] = 'offsite:2222'
+        config['destination.offsite.repositoryname'] = 'test-repo'
+        config.save()
+        status = Status(self.backup.status_file)
+        status['stats.%s@offsite.lastsuccess' % _root] = Datetime()
+        status.save()
+        # When updating the history
+        history = self.backup.update_history()
+        # Then only the repository of the additional destination get listed.
+        self.assertEqual(3, self.backup._rdiff_backup.call_count)
+        self.assertEqual({'offsite'}, {c.kwargs['destination'] for c in self.backup._rdiff_backup.call_args_list})
+        self.assertEqual(['report.odt'], [name for name, epoch in history.ls(_root + 'home/docs', None, 'offsite')])
+        # When the additional destination complete a new session
+        self.backup._rdiff_backup.reset_mock()
+        status = Status(self.backup.status_file)
+        status['stats.%s@offsite.lastsuccess' % _root] = Datetime() + timedelta(seconds=1)
+        status.save()
+        self.backup.update_history()
+        # Then only this destination is indexed again.
+        self.assertEqual({'offsite'}, {c.kwargs['destination'] for c in self.backup._rdiff_backup.call_args_list})
+
+    def test_backup_with_filelist(self):
+        # Given a backup configured with a lot of patterns
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config.save()
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, _home, None))
+        patterns.extend(Pattern(False, '%s/user/project%d' % (_home, i), None) for i in range(200))
+        patterns.save()
+
+        # Given rdiff-backup reading the filelist
+        filelists = []
+
+        def _rdiff_backup(extra_args, path, on_line):
+            filename = extra_args[extra_args.index('--include-globbing-filelist') + 1]
+            with open(filename, encoding='utf-8') as f:
+                filelists.append((filename, f.read().splitlines()))
+
+        self.backup._rdiff_backup = MagicMock(side_effect=_rdiff_backup)
+        # When running the backup
+        self.backup.backup()
+        # Then patterns are written into a filelist instead of command line.
+        extra_args = self.backup._rdiff_backup.call_args.kwargs['extra_args']
+        self.assertNotIn('--include', extra_args)
+        self.assertEqual(['--exclude', _root + '**'], extra_args[-2:])
+        filename, lines = filelists[0]
+        self.assertEqual(201, len(lines))
+        self.assertIn('- %s/user/project0' % _home, lines)
+        self.assertEqual('+ %s' % _home, lines[-1])
+        # Then filelist is deleted.
+        self.assertFalse(os.path.exists(filename))
+
+    @mock.patch.object(
+        Patterns,
+        'group_by_roots',
+        return_value=[(_root, [Pattern(True, _home, None)]), ('/data/', [Pattern(True, '/data/', None)])],
+    )
+    def test_backup_parallel(self, *unused):
+        # Given a backup configured to run 2 sessions concurrently
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config['max_parallel'] = 2
+        config['ssh_multiplexing'] = False
+        config.save()
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, _home, None))
+        patterns.save()
+        # Given rdiff-backup sessions waiting for each other
+        barrier = threading.Barrier(2, timeout=5)
+        self.backup._rdiff_backup = MagicMock(side_effect=lambda **kwargs: barrier.wait())
+        # When running the backup
+        self.backup.backup()
+        # Then both sessions were executed concurrently
+        self.assertEqual(2, self.backup._rdiff_backup.call_count)
+        status = self.backup.get_status()
+        self.assertEqual('SUCCESS', status['lastresult'])
+        self.assertEqual([(_root, 'SUCCESS', ''), ('/data/', 'SUCCESS', '')], sorted(status.sessions()))
+
+    @mock.patch.object(
+        Patterns,
+        'group_by_roots',
+        return_value=[(_root, [Pattern(True, _home, None)]), ('/data/', [Pattern(True, '/data/', None)])],
+    )
+    def test_backup_parallel_with_failure(self, *unused):
+        # Given a backup configured to run 2 sessions concurrently
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config['max_parallel'] = 2
+        config['ssh_multiplexing'] = False
+        config.save()
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, _home, None))
+        patterns.save()
+
+        # Given a session failing for a single root
+        def _rdiff_backup(extra_args, path, on_line):
+            if path == '/data/':
+                raise UnknownHostException()
+
+        self.backup._rdiff_backup = MagicMock(side_effect=_rdiff_backup)
+        # When running the backup
+        # Then the error is raised
+        with self.assertRaises(UnknownHostException):
+            self.backup.backup()
+        # Then other session completed
+        self.assertEqual(2, self.backup._rdiff_backup.call_count)
+        status = self.backup.get_status()
+        self.assertEqual('FAILURE', status['lastresult'])
+        self.assertEqual(
+            [(_root, 'SUCCESS', ''), ('/data/', 'FAILURE', str(UnknownHostException()))], sorted(status.sessions())
+        )
+
+    def test_backup_progress(self):
+        # Given a backup configured
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config.save()
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, _home, None))
+        patterns.save()
+
+        # Given rdiff-backup reporting progress and statistics
+        def _rdiff_backup(extra_args, path, on_line):
+            on_line('*        Processing changed file %s\n' % _home.lstrip('/'))
+            on_line('ElapsedTime 125.50 (2 minutes 5.50 seconds)\n')
+
+        self.backup._rdiff_backup = MagicMock(side_effect=_rdiff_backup)
+        # When running the backup
+        self.backup.backup()
+        # Then progress is recorded in status
+        status = self.backup.get_status()
+        self.assertEqual(1, status.progress(_root)['files'])
+        self.assertEqual(_home.lstrip('/'), status.progress(_root)['path'])
+        # Then session duration is recorded to estimate next session.
+        self.assertEqual(125.5, status.previous_elapsed(_root))
+
+    def test_estimate_patterns(self):
+        # Given patterns including a folder and excluding wildcard files
+        data = os.path.join(self.tmp.name, 'data')
+        os.mkdir(data)
+        for name in ['file.txt', 'file.bak']:
+            with open(os.path.join(data, name), 'w') as f:
+                f.write('foo')
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, data, None))
+        patterns.append(Pattern(False, '*.bak', None))
+        patterns.append(Pattern(True, os.path.join(self.tmp.name, 'missing'), None))
+        # When estimating the patterns
+        result = self.backup.estimate_patterns(patterns)
+        # Then files and bytes are reported for each original pattern
+        self.assertEqual({patterns[0]: (1, 3), patterns[1]: (1, 3), patterns[2]: (0, 0)}, result)
+
+    @mock.patch.object(Backup, 'is_backup_time', return_value=True)
+    def test_backup_skip_unchanged(self, *unused):
+        # Given a backup configured to skip unchanged roots
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config['skip_unchanged'] = True
+        config.save()
+        data = os.path.join(self.tmp.name, 'data')
+        os.mkdir(data)
+        with open(os.path.join(data, 'file.txt'), 'w') as f:
+            f.write('foo')
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, data, None))
+        patterns.save()
+        self.backup._rdiff_backup = MagicMock()
+        # Given a first successful backup
+        self.backup.backup()
+        self.assertEqual(1, self.backup._rdiff_backup.call_count)
+        # When running the backup again without changes
+        self.backup.backup()
+        # Then rdiff-backup is not executed
+        self.assertEqual(1, self.backup._rdiff_backup.call_count)
+        status = self.backup.get_status()
+        self.assertEqual('SUCCESS', status['lastresult'])
+        self.assertEqual([(_root, 'SUCCESS', _('skipped, no changes since last backup'))], status.sessions())
+        # When a file get modified
+        with open(os.path.join(data, 'file.txt'), 'w') as f:
+            f.write('modified')
+        self.backup.backup()
+        # Then rdiff-backup is executed
+        self.assertEqual(2, self.backup._rdiff_backup.call_count)
+        # When the backup is forced
+        self.backup.backup(force=True)
+        # Then rdiff-backup is executed
+        self.assertEqual(3, self.backup._rdiff_backup.call_count)
+
+    @mock.patch.object(Backup, 'is_backup_time', return_value=True)
+    def test_backup_skip_unchanged_with_journal(self, *unused):
+        # Given a backup configured to use the journal of changes
+        config = Settings(self.backup.config_file)
+        config['remotehost'] = 'remotehost'
+        config['repositoryname'] = 'test-repo'
+        config['configured'] = True
+        config['skip_unchanged'] = True
+        config['watch_changes'] = True
+        config.save()
+        data = os.path.join(self.tmp.name, 'data')
+        os.mkdir(data)
+        patterns = Patterns(self.backup.patterns_file)
+        patterns.append(Pattern(True, data, None))
+        patterns.save()
+        changes = Journal(self.backup.journal_file)
+        changes.reset(roots_digest(self.backup.get_watched_roots()))
+        self.backup._rdiff_backup = MagicMock()
+        # Given a first successful backup
+        self.backup.backup()
+        self.assertEqual(1, self.backup._rdiff_backup.call_count)
+        # When a file is created without being recorded in the journal
+        with open(os.path.join(data, 'file.txt'), 'w') as f:
+            f.write('foo')
+        self.backup.backup()
+        # Then only dirty directories are scanned.
+        self.assertEqual(1, self.backup._rdiff_backup.call_count)
+        # When the directory is recorded in the journal
+        changes.append([data])
+        self.backup.backup()
+        # Then rdiff-backup is executed
+        self.assertEqual(2, self.backup._rdiff_backup.call_count)
+        # When the journal get reset
+        changes.reset(roots_digest(self.backup.get_watched_roots()))
+        self.backup.backup()
+        # Then a full scan is executed
+        self.assertEqual(2, self.backup._rdiff_backup.call_count)
+        # When a tier get added without restarting the watcher
+        self.backup.add_tier('docs')
+        patterns = self.backup.get_patterns('docs')
+        patterns.append(Pattern(True, os.path.join(data, 'docs'), None))
+        patterns.save()
+        status = self.backup.get_status()
+        status['lastsuccess'] = None
+        status.save()
+        with open(os.path.join(data, 'file.txt'), 'w') as f:
+            f.write('bar')
+        self.backup.backup()
+        # Then a full scan is executed for every tier.
+        self.assertEqual(4, self.backup._rdiff_backup.call_count)
+
     def test_backup_not_scheduled(self):
         status = self.backup.get_status()
         status['lastsuccess'] = Datetime()
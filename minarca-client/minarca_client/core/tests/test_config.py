@@ -6,15 +6,19 @@ Created on Jun. 7, 2021
 
 @author: Patrik Dufresne <patrik@ikus-soft.com>
 '''
+import copy
 import datetime
 import os
 import tempfile
+import time
 import unittest
 from unittest import mock
-from unittest.case import skipIf
+from unittest.case import skipIf, skipUnless
+
+import javaproperties
 
 from minarca_client.core.compat import IS_WINDOWS
-from minarca_client.core.config import Datetime, Pattern, Patterns, Settings, Status
+from minarca_client.core.config import Datetime, Pattern, Patterns, Settings, SettingsStore, Status, StatusStore
 
 _home = 'C:/Users' if IS_WINDOWS else '/home'
 
@@ -95,6 +99,116 @@ class PatternsTest(unittest.TestCase):
             data = f.read()
         self.assertEqual("# AutoCAD Backup file\n+*.bak\n# Office Temporary files\n+$~*\n", data)
 
+    def test_load_with_duplicates(self):
+        # Given a file with duplicate patterns
+        with open('patterns', 'w') as f:
+            f.write("+/home\n")
+            f.write("-*.bak\n")
+            f.write("-/home\n")
+        # When reading the pattern file
+        patterns = Patterns('patterns')
+        # Then last occurrence is kept.
+        self.assertEqual([Pattern(False, '*.bak', None), Pattern(False, '/home', None)], patterns)
+
+    def test_append_duplicate(self):
+        patterns = Patterns('patterns')
+        patterns.append(Pattern(True, _home, None))
+        patterns.append(Pattern(False, '*.bak', None))
+        # When adding the opposite pattern
+        patterns.append(Pattern(False, _home, None))
+        # Then previous pattern is replaced
+        self.assertEqual([Pattern(False, '*.bak', None), Pattern(False, _home, None)], patterns)
+        self.assertIn(_home, patterns)
+        self.assertIn(Pattern(False, _home, None), patterns)
+        self.assertNotIn(Pattern(True, _home, None), patterns)
+        # When replacing a pattern by index
+        patterns[1] = Pattern(True, _home, None)
+        patterns.append(Pattern(False, _home, None))
+        # Then index is updated
+        self.assertEqual([Pattern(False, '*.bak', None), Pattern(False, _home, None)], patterns)
+
+    def test_append_duplicate_many(self):
+        # Given many patterns replaced by their opposite
+        patterns = Patterns('patterns')
+        patterns.extend(Pattern(True, '/data/%d' % i, None) for i in range(1000))
+        patterns.extend(Pattern(False, '/data/%d' % i, None) for i in range(0, 1000, 2))
+        # Then each pattern is listed once, replaced patterns last.
+        self.assertEqual(1000, len(patterns))
+        self.assertEqual(Pattern(True, '/data/1', None), patterns[0])
+        self.assertEqual(Pattern(False, '/data/998', None), patterns[-1])
+        self.assertEqual(Pattern(False, '/data/0', None), list(patterns)[500])
+        # When modifying the list afterward
+        patterns.insert(0, Pattern(True, '/srv', None))
+        # Then the list is kept in order.
+        self.assertEqual(['/srv', '/data/1'], [p.pattern for p in patterns[:2]])
+        self.assertIn('/srv', patterns)
+
+    def test_copy(self):
+        patterns = Patterns('patterns')
+        patterns.append(Pattern(True, _home, None))
+        patterns.append(Pattern(False, '*.bak', None))
+        for other in [copy.copy(patterns), patterns.copy(), patterns[:]]:
+            # When modifying a copy
+            self.assertIsInstance(other, Patterns)
+            other.append(Pattern(False, _home, None))
+            # Then the original patterns are unchanged.
+            self.assertEqual([Pattern(True, _home, None), Pattern(False, '*.bak', None)], patterns)
+            self.assertIn(Pattern(True, _home, None), patterns)
+            self.assertEqual([Pattern(False, '*.bak', None), Pattern(False, _home, None)], other)
+        # When slicing the patterns
+        # Then a Patterns with its own index is returned.
+        self.assertEqual([Pattern(False, '*.bak', None)], patterns[1:])
+        self.assertNotIn(_home, patterns[1:])
+
+    def test_group_by_roots_cached(self):
+        patterns = Patterns('patterns')
+        patterns.append(Pattern(True, _home, None))
+        with mock.patch.object(patterns, '_group_by_roots', wraps=patterns._group_by_roots) as group_by_roots:
+            # When calling group_by_roots multiple time
+            first = list(patterns.group_by_roots())
+            self.assertEqual(first, list(patterns.group_by_roots()))
+            # Then result is computed once
+            self.assertEqual(1, group_by_roots.call_count)
+            # When the patterns get modified
+            patterns.append(Pattern(False, _home + '/tmp', None))
+            # Then result is computed again
+            self.assertNotEqual(first, list(patterns.group_by_roots()))
+            self.assertEqual(2, group_by_roots.call_count)
+            patterns.remove(Pattern(False, _home + '/tmp', None))
+            self.assertEqual(first, list(patterns.group_by_roots()))
+
+    def test_is_included(self):
+        patterns = Patterns('patterns')
+        patterns.append(Pattern(True, _home, None))
+        patterns.append(Pattern(False, '*.bak', None))
+        patterns.append(Pattern(False, _home + '/user/tmp', None))
+        patterns.append(Pattern(True, _home + '/user/tmp/keep', None))
+        self.assertTrue(patterns.is_included(_home + '/user/file.txt'))
+        self.assertFalse(patterns.is_included(_home + '/user/file.bak'))
+        self.assertFalse(patterns.is_included(_home + '/user/tmp/file.txt'))
+        self.assertTrue(patterns.is_included(_home + '/user/tmp/keep/file.txt'))
+        self.assertFalse(patterns.is_included(_home + 'other/file.txt'))
+        # Then modification are considered
+        patterns.remove(Pattern(False, '*.bak', None))
+        self.assertTrue(patterns.is_included(_home + '/user/file.bak'))
+
+    @skipUnless(os.environ.get('MINARCA_BENCHMARK'), reason='benchmark disabled, define MINARCA_BENCHMARK=1')
+    def test_benchmark_load(self):
+        # Given a large managed pattern file
+        with open('patterns', 'w') as f:
+            for i in range(20000):
+                f.write('-%s/user%d/project%d/build\n' % (_home, i % 100, i))
+            f.write('+%s\n' % _home)
+        # When loading the patterns and grouping them
+        start = time.perf_counter()
+        patterns = Patterns('patterns')
+        roots = list(patterns.group_by_roots())
+        patterns.is_included(_home + '/user1/project1/build/file.txt')
+        elapsed = time.perf_counter() - start
+        # Then print elapsed time
+        self.assertEqual(20001, len(roots[0][1]))
+        print('loaded %d patterns in %.3fs' % (len(patterns), elapsed))
+
     @skipIf(IS_WINDOWS, 'only or unix')
     def test_group_by_roots_unix_wildcard(self, *unused):
         with open('patterns', 'w') as f:
@@ -305,6 +419,158 @@ class StatusTest(unittest.TestCase):
         self.assertTrue("details=" not in data)
 
 
+class SettingsStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        with open('minarca.properties', 'w') as f:
+            f.write("username=foo\n")
+        # Make the file old enough to be cached.
+        os.utime('minarca.properties', (1622832320, 1622832320))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_get_cached(self):
+        # Given settings loaded once
+        store = SettingsStore('minarca.properties')
+        self.assertEqual('foo', store.get()['username'])
+        # When getting the settings again without modification
+        with mock.patch('minarca_client.core.config.Settings') as mock_settings:
+            store.get()
+        # Then the file is not parsed again.
+        mock_settings.assert_not_called()
+
+    def test_get_modified(self):
+        # Given settings loaded once
+        store = SettingsStore('minarca.properties')
+        store.get()
+        # When the file get modified by another process
+        settings = Settings('minarca.properties')
+        settings['username'] = 'bar'
+        settings.save()
+        # Then the new value is returned
+        self.assertEqual('bar', store.get()['username'])
+
+    def test_update(self):
+        # Given settings loaded
+        store = SettingsStore('minarca.properties')
+        store.get()
+        # When updating multiple values
+        with mock.patch('minarca_client.core.config.javaproperties.dump', wraps=javaproperties.dump) as mock_dump:
+            store.update({'username': 'bar', 'schedule': Settings.HOURLY})
+        # Then the file is written once
+        mock_dump.assert_called_once()
+        settings = Settings('minarca.properties')
+        self.assertEqual('bar', settings['username'])
+        self.assertEqual(Settings.HOURLY, settings['schedule'])
+        self.assertEqual('bar', store.get()['username'])
+
+    def test_save_atomic(self):
+        # Given a settings file
+        settings = Settings('minarca.properties')
+        settings['username'] = 'bar'
+        # When an error occur while writing the file
+        with mock.patch('minarca_client.core.config.javaproperties.dump', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                settings.save()
+        # Then the original file is left untouched.
+        self.assertEqual('foo', Settings('minarca.properties')['username'])
+        self.assertEqual(['minarca.properties'], os.listdir('.'))
+
+
+class StatusStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        os.chdir(self.tmp.name)
+        with open('status.properties', 'w') as f:
+            f.write("lastresult=SUCCESS\n")
+        # Make the file old enough to be cached.
+        os.utime('status.properties', (1622832320, 1622832320))
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def test_get(self):
+        store = StatusStore('status.properties')
+        self.assertEqual('SUCCESS', store.get()['lastresult'])
+
+    def test_get_with_missing_file(self):
+        store = StatusStore('invalid.properties')
+        self.assertEqual(Status._DEFAULT, store.get())
+
+    def test_get_cached(self):
+        # Given a status loaded once
+        store = StatusStore('status.properties')
+        store.get()
+        # When getting the status again without modification
+        with mock.patch('minarca_client.core.config.Status') as mock_status:
+            store.get()
+        # Then the file is not parsed again.
+        mock_status.assert_not_called()
+
+    def test_get_return_copy(self):
+        store = StatusStore('status.properties')
+        status = store.get()
+        status['lastresult'] = 'FAILURE'
+        self.assertEqual('SUCCESS', store.get()['lastresult'])
+
+    def test_get_modified(self):
+        # Given a status loaded once
+        store = StatusStore('status.properties')
+        store.get()
+        # When the file get modified
+        status = Status('status.properties')
+        status['lastresult'] = 'FAILURE'
+        status.save()
+        # Then the new status is returned
+        self.assertEqual('FAILURE', store.get()['lastresult'])
+
+    def test_get_with_running_pid_cached(self):
+        # Given a running backup
+        status = Status('status.properties')
+        status['lastresult'] = 'RUNNING'
+        status['lastdate'] = Datetime()
+        status['pid'] = os.getpid()
+        status.save()
+        store = StatusStore('status.properties')
+        self.assertEqual('RUNNING', store.get()['lastresult'])
+        # When getting the status again
+        with mock.patch('psutil.Process') as mock_process:
+            self.assertEqual('RUNNING', store.get()['lastresult'])
+        # Then process liveness is not verified again
+        mock_process.assert_not_called()
+
+    def test_subscribe(self):
+        # Given a subscriber
+        store = StatusStore('status.properties')
+        callback = mock.MagicMock()
+        unsubscribe = store.subscribe(callback)
+        # When polling without modification
+        store.poll()
+        # Then subscriber is not called
+        callback.assert_not_called()
+        # When the status get modified
+        status = Status('status.properties')
+        status['lastresult'] = 'FAILURE'
+        status.save()
+        store.poll()
+        # Then subscriber is called with new status
+        callback.assert_called_once()
+        self.assertEqual('FAILURE', callback.call_args[0][0]['lastresult'])
+        # When unsubscribing
+        unsubscribe()
+        status['lastresult'] = 'SUCCESS'
+        status.save()
+        store.poll()
+        # Then subscriber is not called
+        callback.assert_called_once()
+
+
 class DatetimeTest(unittest.TestCase):
     def test_add(self):
         self.assertEqual(Datetime(1688580806000) + datetime.timedelta(hours=24), Datetime(1688667206000))
@@ -0,0 +1,163 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+import io
+import os
+import tarfile
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from requests.exceptions import ChunkedEncodingError
+
+from minarca_client.core import download
+
+
+def make_tar(files):
+    """
+    Return the content of a tar archive with the given files.
+    """
+    data = io.BytesIO()
+    with tarfile.open(fileobj=data, mode='w') as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return data.getvalue()
+
+
+class FakeResponse:
+    """
+    Streamed response interrupted after `fail_after` bytes. A partial
+    content starting at `offset` is returned when `offset` is defined.
+    """
+
+    def __init__(self, content, status_code=200, filename='docs.tar', fail_after=None, offset=None, etag=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = {'Content-Disposition': 'attachment; filename="%s"' % filename}
+        if offset is not None:
+            self.content = content[offset:]
+            self.status_code = 206
+            self.headers['Content-Range'] = 'bytes %d-%d/%d' % (offset, len(content) - 1, len(content))
+        if etag:
+            self.headers['ETag'] = etag
+        self.fail_after = fail_after
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.content), 1024):
+            if self.fail_after is not None and i >= self.fail_after:
+                raise ChunkedEncodingError('connection broken')
+            yield self.content[i : i + 1024]
+
+    def close(self):
+        pass
+
+
+@mock.patch('minarca_client.core.download._RETRY_DELAY', 0)
+class DownloadTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.target = os.path.join(self.tmp.name, 'docs')
+        self.content = make_tar({'a.txt': b'a' * 5000, 'sub/b.txt': b'b' * 20000})
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def assertRestored(self):
+        with open(os.path.join(self.target, 'a.txt'), 'rb') as f:
+            self.assertEqual(b'a' * 5000, f.read())
+        with open(os.path.join(self.target, 'sub', 'b.txt'), 'rb') as f:
+            self.assertEqual(b'b' * 20000, f.read())
+
+    def test_restore(self):
+        # When downloading an archive
+        files = []
+        download.restore(lambda offset: FakeResponse(self.content), self.target, on_file=files.append)
+        # Then files get extracted into the target.
+        self.assertRestored()
+        self.assertEqual(['a.txt', 'sub/b.txt'], files)
+
+    def test_restore_file(self):
+        # When downloading a single file
+        target = os.path.join(self.tmp.name, 'report.odt')
+        download.restore(lambda offset: FakeResponse(b'data', filename='report.odt'), target)
+        # Then the content is written into the target.
+        with open(target, 'rb') as f:
+            self.assertEqual(b'data', f.read())
+        # When the download of the file failed
+        request = lambda offset: FakeResponse(b'x' * 5000, filename='report.odt', fail_after=0)  # noqa: E731
+        with self.assertRaises(ChunkedEncodingError):
+            download.restore(request, target)
+        # Then the target is left untouched.
+        with open(target, 'rb') as f:
+            self.assertEqual(b'data', f.read())
+        self.assertEqual(['report.odt'], os.listdir(self.tmp.name))
+
+    def test_restore_resume_with_range(self):
+        # Given a connection interrupted during the download
+        offsets = []
+
+        def request(offset):
+            offsets.append(offset)
+            if offset:
+                return FakeResponse(self.content, offset=offset, etag='v1')
+            return FakeResponse(self.content, fail_after=8192, etag='v1')
+
+        # When downloading an archive
+        download.restore(request, self.target)
+        # Then download is resumed from the last byte received.
+        self.assertEqual([0, 8192], offsets)
+        self.assertRestored()
+
+    def test_restore_resume_without_range(self):
+        # Given a server not supporting ranges
+        offsets = []
+
+        def request(offset):
+            offsets.append(offset)
+            return FakeResponse(self.content, fail_after=8192 if len(offsets) == 1 else None)
+
+        # When downloading an archive
+        download.restore(request, self.target)
+        # Then the download is restarted from the beginning.
+        self.assertEqual([0, 8192, 0], offsets)
+        self.assertRestored()
+
+    def test_restore_resume_with_invalid_range(self):
+        # Given a server returning another range or another content
+        for response in [
+            lambda offset: FakeResponse(self.content, offset=0),
+            lambda offset: FakeResponse(self.content, offset=offset, etag='v2'),
+        ]:
+            offsets = []
+
+            def request(offset):
+                offsets.append(offset)
+                if len(offsets) == 1:
+                    return FakeResponse(self.content, fail_after=8192, etag='v1')
+                return response(offset) if offset else FakeResponse(self.content)
+
+            # When downloading an archive
+            download.restore(request, self.target)
+            # Then the download is restarted from the beginning.
+            self.assertEqual([0, 8192, 0], offsets)
+            self.assertRestored()
+
+    def test_restore_too_many_errors(self):
+        # Given a connection always failing
+        request = mock.MagicMock(side_effect=lambda offset: FakeResponse(self.content, fail_after=0))
+        # When downloading an archive
+        with self.assertRaises(ChunkedEncodingError):
+            download.restore(request, self.target)
+        # Then download is retried a couple of times.
+        self.assertEqual(download._RETRIES + 1, request.call_count)
+
+    def test_epoch(self):
+        self.assertEqual(1682367069, download.epoch('1682367069'))
+        self.assertEqual(1677226269, download.epoch('2023-02-24T04:11:09-04:00'))
+        self.assertAlmostEqual(time.time(), download.epoch('now'), delta=2)
+        self.assertAlmostEqual(time.time() - 3 * 86400 - 7200, download.epoch('3D2h'), delta=2)
+        with self.assertRaises(ValueError):
+            download.epoch('invalid')
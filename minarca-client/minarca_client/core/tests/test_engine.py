@@ -0,0 +1,122 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+import os
+import signal
+import threading
+import time
+import unittest
+from unittest import mock
+from unittest.case import skipUnless
+
+from minarca_client.core import engine
+
+
+def _main_run_echo(options):
+    print(' '.join(options))
+    # Output of ssh process get captured too.
+    os.write(2, b'ssh: Could not resolve hostname\n')
+    return 2
+
+
+def _main_run_error(options):
+    raise ValueError('invalid options')
+
+
+def _main_run_sleep(options):
+    time.sleep(30)
+    return 0
+
+
+@skipUnless(engine.is_supported(engine.ENGINE_FORK), reason='fork engine not supported')
+class TestForkedProcess(unittest.TestCase):
+    def setUp(self):
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.close()
+
+    def start_server(self):
+        self.server = engine.ForkServer()
+        return self.server
+
+    def test_is_supported(self):
+        self.assertTrue(engine.is_supported(engine.ENGINE_SUBPROCESS))
+        self.assertFalse(engine.is_supported('invalid'))
+
+    @mock.patch('minarca_client.core.engine._load_main_run', return_value=_main_run_echo)
+    def test_run(self, *unused):
+        # Given a forked rdiff-backup process
+        p = self.start_server().run(['-v', '5', 'backup'])
+        # When reading the output
+        lines = list(p.stdout)
+        # Then stdout and stderr get captured
+        self.assertEqual(['-v 5 backup\n', 'ssh: Could not resolve hostname\n'], sorted(lines))
+        # Then exit code is returned
+        self.assertEqual(2, p.wait())
+
+    @mock.patch('minarca_client.core.engine._load_main_run', return_value=_main_run_error)
+    def test_run_with_exception(self, *unused):
+        # Given a forked rdiff-backup process raising an exception
+        p = self.start_server().run(['backup'])
+        # When reading the output
+        output = p.stdout.read()
+        # Then the traceback is printed
+        self.assertIn('ValueError: invalid options', output)
+        self.assertEqual(1, p.wait())
+
+    @mock.patch('minarca_client.core.engine._load_main_run', return_value=_main_run_sleep)
+    def test_terminate(self, *unused):
+        # Given a running forked process
+        p = self.start_server().run(['backup'])
+        self.assertTrue(p.pid)
+        # When terminating the process
+        p.terminate()
+        # Then the process exit
+        self.assertNotEqual(0, p.wait())
+
+    @mock.patch('minarca_client.core.engine._load_main_run', return_value=_main_run_echo)
+    def test_run_concurrently(self, *unused):
+        # Given a fork server
+        server = self.start_server()
+        # When running multiple workers from threads
+        processes = [server.run(['backup', str(i)]) for i in range(3)]
+        results = [None] * 3
+
+        def _read(i):
+            results[i] = (processes[i].stdout.readline(), processes[i].wait())
+
+        threads = [threading.Thread(target=_read, args=(i,)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Then each worker report its own output and exit code.
+        self.assertEqual([('backup %d\n' % i, 2) for i in range(3)], results)
+
+    def test_is_alive(self):
+        # Given a fork server
+        server = self.start_server()
+        self.assertTrue(server.is_alive())
+        # When the fork server get killed
+        os.kill(server.pid, signal.SIGTERM)
+        # Then it's reported as not running.
+        deadline = time.time() + 5
+        while server.is_alive() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(server.is_alive())
+
+    def test_start_with_threads(self):
+        # Given a thread running
+        event = threading.Event()
+        thread = threading.Thread(target=event.wait)
+        thread.start()
+        try:
+            # When starting the fork server
+            # Then an error is raised.
+            with self.assertRaises(RuntimeError):
+                engine.ForkServer()
+        finally:
+            event.set()
+            thread.join()
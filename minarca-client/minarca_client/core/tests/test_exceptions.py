@@ -8,11 +8,17 @@ Created on Nov. 12, 2021
 '''
 
 
+import io
+import os
+import time
 import unittest
+from unittest import mock
+from unittest.case import skipUnless
 
 from parameterized import parameterized
 
 from minarca_client.core.exceptions import (
+    BackupError,
     CaptureException,
     ConnectException,
     DiskFullError,
@@ -30,6 +36,7 @@ class TestExceptions(unittest.TestCase):
             ('ssh: Could not resolve hostname', UnknownHostException),
             ('Host key verification failed.', UnknownHostKeyError),
             ('Permission denied (publickey)', PermissionDeniedError),
+            ('Permission denied (publickey,password).', None),
             ('OSError: [Errno 122] Disk quota exceeded', DiskQuotaExceededError),
             ('OSError: [Errno 28] No space left on device', DiskFullError),
             ('Other', None),
@@ -42,3 +49,52 @@ class TestExceptions(unittest.TestCase):
             self.assertIsInstance(capture.exception, expected_error)
         else:
             self.assertIsNone(capture.exception)
+
+    def test_capture_exception_last_line(self):
+        capture = CaptureException()
+        capture.parse('ssh: Could not resolve hostname')
+        capture.parse('Processing changed file foo')
+        capture.parse('Host key verification failed.')
+        self.assertIsInstance(capture.exception, UnknownHostKeyError)
+
+    def test_register(self):
+        class CustomError(BackupError):
+            message = 'custom error'
+
+        with mock.patch.object(CaptureException, '_signatures', list(CaptureException._signatures)), mock.patch.object(
+            CaptureException, '_regex', None
+        ):
+            # Given a new signature registered
+            CaptureException.register(r'custom error [0-9]+')(CustomError)
+            # When parsing a line matching the signature
+            capture = CaptureException()
+            capture.parse('ERROR: custom error 123')
+            # Then custom exception is created
+            self.assertIsInstance(capture.exception, CustomError)
+        # Then signature is unregistered
+        capture = CaptureException()
+        capture.parse('ERROR: custom error 123')
+        self.assertIsNone(capture.exception)
+
+    @skipUnless(os.environ.get('MINARCA_BENCHMARK'), reason='benchmark disabled, define MINARCA_BENCHMARK=1')
+    def test_benchmark_parse(self):
+        # Given a synthetic rdiff-backup log, by default 2GiB
+        size = int(os.environ.get('MINARCA_BENCHMARK_SIZE', 2 * 1024**3))
+        chunk = ''.join(
+            'Processing changed file home/user/Documents/project/src/module_%d/file_%d.py\n' % (i % 100, i)
+            for i in range(100000)
+        )
+        count = max(1, size // len(chunk))
+        # When parsing every lines
+        capture = CaptureException()
+        start = time.perf_counter()
+        for unused in range(count):
+            for line in io.StringIO(chunk):
+                capture.parse(line)
+        elapsed = time.perf_counter() - start
+        # Then no exception is found
+        self.assertIsNone(capture.exception)
+        print(
+            'parsed %d MiB in %.2fs: %.1f MiB/s'
+            % (count * len(chunk) / 1024**2, elapsed, count * len(chunk) / 1024**2 / elapsed)
+        )
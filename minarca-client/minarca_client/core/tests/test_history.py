@@ -0,0 +1,106 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+from unittest.mock import MagicMock
+
+from minarca_client.core.history import History, parse_files, parse_increments
+
+LIST_INCREMENTS = '''Found 2 increments:
+    increments.2023-04-24T10:51:09-04:00.dir   Mon Apr 24 10:51:09 2023
+    increments.2023-04-25T10-51-09Z.dir   Tue Apr 25 06:51:09 2023
+Current mirror: Wed Apr 26 10:51:09 2023
+'''
+
+
+class HistoryTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.tmp.name, 'history.json.gz')
+        self.files = {
+            100: ['docs', 'docs/report.odt', 'docs/old.txt'],
+            200: ['docs', 'docs/report.odt', 'docs/new.txt'],
+        }
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_parse_increments(self):
+        mirror = int(time.mktime(time.strptime('Wed Apr 26 10:51:09 2023')))
+        self.assertEqual([1682347869, 1682419869, mirror], parse_increments(LIST_INCREMENTS.splitlines()))
+
+    def test_parse_files(self):
+        self.assertEqual(['docs', 'docs/a.txt'], list(parse_files(['.\n', 'docs\n', 'WARNING: foo\n', 'docs/a.txt\n'])))
+
+    def test_update(self):
+        # Given an index of a repository
+        history = History(self.filename)
+        list_files = MagicMock(side_effect=self.files.get)
+        history.update('/home', '/home', 1, [100, 200], list_files)
+        history.save()
+        # When listing a folder
+        history = History(self.filename)
+        # Then files of the latest increment are returned.
+        self.assertEqual([('new.txt', 200), ('report.odt', 200)], history.ls('/home/docs'))
+        self.assertEqual([('old.txt', 100), ('report.odt', 100)], history.ls('/home/docs', at=150))
+        self.assertEqual([], history.ls('/home/docs', at=50))
+        # When searching files
+        self.assertEqual([('/home/docs/report.odt', [100, 200])], history.find('report'))
+        self.assertEqual([('/home/docs/new.txt', [200]), ('/home/docs/old.txt', [100])], history.find('*.txt'))
+        self.assertEqual([('/home/docs/old.txt', [100])], history.find('/home/*/old.txt'))
+        # When a new increment is created and the oldest one removed.
+        self.assertTrue(history.is_current('/home', 1))
+        self.assertFalse(history.is_current('/home', 2))
+        self.files[300] = ['docs', 'docs/report.odt']
+        list_files.reset_mock()
+        history.update('/home', '/home', 2, [200, 300], list_files)
+        # Then only the new increment get listed.
+        list_files.assert_called_once_with(300)
+        self.assertEqual([('/home/docs/report.odt', [200, 300])], history.find('report'))
+        self.assertEqual([], history.find('old.txt'))
+
+    def test_update_many_increments(self):
+        # Given a repository with many increments
+        self.files[150] = ['docs', 'docs/report.odt', 'docs/draft.txt']
+        list_files = MagicMock(side_effect=self.files.get)
+        history = History(self.filename)
+        # When indexing the repository
+        history.update('/home', '/home', 1, [100, 150, 200], list_files)
+        # Then only the oldest and latest increments get listed.
+        self.assertEqual([mock.call(100), mock.call(200)], list_files.call_args_list)
+        # Then files available in both are considered available between them.
+        self.assertEqual([('/home/docs/report.odt', [100, 150, 200])], history.find('report'))
+        self.assertEqual([('report.odt', 150)], history.ls('/home/docs', at=175))
+        # Then each file is stored once with its range of epochs.
+        history.save()
+        history = History(self.filename)
+        self.assertEqual([[100, 200]], history._repositories['/home']['files']['docs/report.odt'])
+
+    def test_count(self):
+        # Given an index of a repository
+        history = History(self.filename)
+        history.update('/home', '/home', 1, [100, 200], self.files.get)
+        # When counting the files of a path
+        # Then only the files of the latest increment are counted.
+        self.assertEqual(3, history.count('/home', '/home'))
+        self.assertEqual(3, history.count('/home', '/home/docs'))
+        self.assertEqual(1, history.count('/home', '/home/docs/new.txt'))
+        self.assertEqual(0, history.count('/home', '/home/docs/old.txt'))
+        self.assertEqual(0, history.count('/other', '/home'))
+
+    def test_update_with_destination(self):
+        # Given a repository indexed for each destination
+        history = History(self.filename)
+        history.update('/home', '/home', 1, [100], self.files.get)
+        history.update('/home@offsite', '/home', 1, [200], self.files.get, destination='offsite')
+        history.save()
+        history = History(self.filename)
+        # When listing a folder
+        # Then only the increments of the given destination are returned.
+        self.assertEqual([('old.txt', 100), ('report.odt', 100)], history.ls('/home/docs'))
+        self.assertEqual([('new.txt', 200), ('report.odt', 200)], history.ls('/home/docs', destination='offsite'))
+        self.assertEqual([('/home/docs/report.odt', [200])], history.find('report', destination='offsite'))
@@ -0,0 +1,135 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from minarca_client.core.compat import IS_LINUX
+from minarca_client.core.config import Pattern
+from minarca_client.core.journal import InotifyWatcher, Journal, PollingWatcher, roots_digest
+
+
+def _wait_for(func, timeout=5):
+    start = time.time()
+    while time.time() - start < timeout:
+        value = func()
+        if value:
+            return value
+        time.sleep(0.05)
+    return func()
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.journal = Journal(os.path.join(self.tmp.name, 'journal.dat'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_position_without_journal(self):
+        self.assertIsNone(self.journal.position())
+        self.assertIsNone(self.journal.read(None))
+
+    def test_read(self):
+        # Given a journal
+        self.journal.reset()
+        self.journal.append(['/home/foo'])
+        position = self.journal.position()
+        # When directories get modified
+        self.journal.append(['/home/bar', '/home/baz'])
+        # Then only directories modified since position are returned
+        self.assertEqual({'/home/bar', '/home/baz'}, self.journal.read(position))
+
+    def test_read_after_reset(self):
+        # Given a position in journal
+        self.journal.reset()
+        position = self.journal.position()
+        # When the journal get reset
+        self.journal.reset()
+        # Then the position is no longer valid.
+        self.assertIsNone(self.journal.read(position))
+
+    def test_read_with_partial_record(self):
+        # Given a journal with partially written record
+        self.journal.reset()
+        position = self.journal.position()
+        with open(self.journal.filename, 'ab') as f:
+            f.write(b'/home/foo\0/home/ba')
+        # Then partial record is ignored
+        self.assertEqual({'/home/foo'}, self.journal.read(position))
+        self.assertEqual({'/home/foo'}, self.journal.read(position))
+
+    def test_position_with_digest(self):
+        # Given a journal watching some roots
+        roots = [('/', [Pattern(True, '/home', None)])]
+        self.journal.reset(roots_digest(roots))
+        # Then position is only returned for the same roots.
+        self.assertIsNotNone(self.journal.position(roots_digest(roots)))
+        self.assertIsNone(self.journal.position(roots_digest(roots + [('/', [Pattern(True, '/srv', None)])])))
+
+    @mock.patch('minarca_client.core.journal.psutil.pid_exists', return_value=False)
+    def test_read_with_watcher_stopped(self, *unused):
+        # Given a journal of a watcher no longer running
+        self.journal.reset()
+        # Then journal could not be trusted.
+        self.assertIsNone(self.journal.position())
+
+
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.data = os.path.join(self.tmp.name, 'data')
+        os.makedirs(os.path.join(self.data, 'sub'))
+        self.journal = Journal(os.path.join(self.tmp.name, 'journal.dat'))
+        self.roots = [(self.tmp.name, [Pattern(True, self.data, None)])]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _test_watcher(self, watcher):
+        watcher.start()
+        try:
+            position = _wait_for(self.journal.position)
+            self.assertIsNotNone(position)
+            # When a file get created
+            with open(os.path.join(self.data, 'sub', 'file.txt'), 'w') as f:
+                f.write('foo')
+            # Then the directory is dirty
+            self.assertIn(os.path.join(self.data, 'sub'), _wait_for(lambda: self.journal.read(position)))
+        finally:
+            watcher.stop()
+            watcher.join()
+        # Then journal is removed when watcher stop.
+        self.assertIsNone(self.journal.position())
+
+    @unittest.skipUnless(IS_LINUX, 'inotify only available on Linux')
+    def test_inotify_watcher(self):
+        self._test_watcher(InotifyWatcher(self.journal, self.roots))
+
+    @unittest.skipUnless(IS_LINUX, 'inotify only available on Linux')
+    @mock.patch('minarca_client.core.journal._FLUSH_DELAY', 0.5)
+    def test_inotify_watcher_constant_activity(self):
+        watcher = InotifyWatcher(self.journal, self.roots)
+        watcher.start()
+        try:
+            position = _wait_for(self.journal.position)
+            # When a file keep being written faster than the flush delay
+            started = time.time()
+            while time.time() - started < 3 and not self.journal.read(position):
+                with open(os.path.join(self.data, 'sub', 'file.txt'), 'a') as f:
+                    f.write('foo')
+                time.sleep(0.1)
+            # Then changes are written to the journal anyway.
+            self.assertIn(os.path.join(self.data, 'sub'), self.journal.read(position))
+            self.assertLess(time.time() - started, 2)
+        finally:
+            watcher.stop()
+            watcher.join()
+
+    @mock.patch('minarca_client.core.journal._POLL_INTERVAL', 0.1)
+    def test_polling_watcher(self):
+        self._test_watcher(PollingWatcher(self.journal, self.roots))
@@ -7,15 +7,31 @@ Created on Oct. 22, 2021
 @author: Patrik Dufresne <patrik@ikus-soft.com>
 '''
 
+import os
+import tempfile
+import time
 import unittest
 from unittest.mock import MagicMock
 
 import responses
 
-from minarca_client.core.latest import LATEST_VERSION_URL, LatestCheck, LatestCheckFailed
+from minarca_client.core.latest import _CACHE_TTL, LATEST_VERSION_URL, LatestCheck, LatestCheckFailed
 
 
 class LatestCheckTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        os.environ['MINARCA_DATA_HOME'] = self.tmp.name
+
+    def tearDown(self):
+        self.tmp.cleanup()
+        del os.environ['MINARCA_DATA_HOME']
+
+    def _expire_cache(self, latest):
+        cache = latest._load_cache()
+        cache['checked'] = time.time() - _CACHE_TTL - 1
+        latest._save_cache(cache)
+
     @responses.activate
     def test_get_version_info(self):
         # Given a web server with the latest information
@@ -78,3 +94,76 @@ class LatestCheckTest(unittest.TestCase):
         # When checking if latest version
         # Then it's the NOT latest version.
         self.assertTrue(latest.is_latest())
+
+    @responses.activate
+    def test_get_latest_version_cached(self):
+        # Given a web server with the latest information
+        responses.add(responses.GET, LATEST_VERSION_URL, body='1.2.3')
+        # When querying the latest version multiple time
+        self.assertEqual('1.2.3', LatestCheck().get_latest_version())
+        self.assertEqual('1.2.3', LatestCheck().get_latest_version())
+        # Then web server is queried only once.
+        self.assertEqual(1, len(responses.calls))
+        self.assertEqual('1.2.3', LatestCheck().get_cached_version())
+
+    @responses.activate
+    def test_get_latest_version_revalidate_etag(self):
+        # Given an expired cache with an etag
+        responses.add(responses.GET, LATEST_VERSION_URL, body='1.2.3', headers={'ETag': '"v1"'})
+        latest = LatestCheck()
+        latest.get_latest_version()
+        self._expire_cache(latest)
+        # Given a web server returning "not modified"
+        responses.replace(responses.GET, LATEST_VERSION_URL, status=304)
+        # When querying the latest version
+        # Then the cached version is revalidated.
+        self.assertEqual('1.2.3', latest.get_latest_version())
+        self.assertEqual('"v1"', responses.calls[1].request.headers['If-None-Match'])
+        # Then cache is refreshed.
+        self.assertEqual(2, len(responses.calls))
+        latest.get_latest_version()
+        self.assertEqual(2, len(responses.calls))
+
+    @responses.activate
+    def test_get_latest_version_failure_cached(self):
+        # Given an unreachable web server
+        responses.add(responses.GET, LATEST_VERSION_URL, status=500)
+        # When querying the latest version multiple time
+        latest = LatestCheck()
+        with self.assertRaises(LatestCheckFailed):
+            latest.get_latest_version()
+        with self.assertRaises(LatestCheckFailed):
+            latest.get_latest_version()
+        # Then the failure is cached.
+        self.assertEqual(1, len(responses.calls))
+
+    @responses.activate
+    def test_get_latest_version_failure_with_previous_version(self):
+        # Given an expired cache
+        responses.add(responses.GET, LATEST_VERSION_URL, body='1.2.3')
+        latest = LatestCheck()
+        latest.get_latest_version()
+        self._expire_cache(latest)
+        # Given an unreachable web server
+        responses.replace(responses.GET, LATEST_VERSION_URL, status=500)
+        # When querying the latest version
+        # Then previous version is returned.
+        self.assertEqual('1.2.3', latest.get_latest_version())
+
+    @responses.activate
+    def test_is_latest_cached(self):
+        # Given an empty cache
+        latest = LatestCheck()
+        latest.get_current_version = MagicMock(return_value='1.0.0')
+        # When checking the cached version
+        # Then the check fail without querying the web server.
+        with self.assertRaises(LatestCheckFailed):
+            latest.is_latest(cached=True)
+        self.assertEqual(0, len(responses.calls))
+        # When the cache get refreshed in background
+        responses.add(responses.GET, LATEST_VERSION_URL, body='1.2.3')
+        latest.refresh_async().join()
+        # Then the cached version is used.
+        self.assertFalse(latest.is_latest(cached=True))
+        # Then cache is not refreshed again.
+        self.assertIsNone(latest.refresh_async())
@@ -0,0 +1,85 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from parameterized import parameterized
+
+from minarca_client.core.progress import Progress, format_progress, format_size
+
+
+class ProgressTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        os.makedirs(os.path.join(self.tmp.name, 'Documents'))
+        with open(os.path.join(self.tmp.name, 'Documents', 'my file.txt'), 'wb') as f:
+            f.write(b'a' * 1024)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_parse(self):
+        # Given rdiff-backup output
+        progress = Progress(root=self.tmp.name)
+        progress.parse('*        Processing changed file .\n')
+        progress.parse('*        Processing changed file Documents\n')
+        progress.parse('*        Processing changed file Documents/my file.txt\n')
+        progress.parse('NOTE:    Starting increment operation\n')
+        # Then files and bytes get counted
+        self.assertEqual(3, progress.files)
+        self.assertEqual(1024, progress.bytes)
+        self.assertEqual('Documents/my file.txt', progress.path)
+
+    def test_parse_wrapped(self):
+        # Given a long path wrapped by rdiff-backup on multiple lines
+        progress = Progress(root=self.tmp.name)
+        progress.parse('*        Processing changed file\n')
+        progress.parse('         Documents/my\n')
+        progress.parse('         file.txt\n')
+        progress.parse('*        Processing changed file Documents\n')
+        # Then the path is reconstructed
+        self.assertEqual(1, progress.files)
+        self.assertEqual(1024, progress.bytes)
+
+    def test_parse_statistics(self):
+        progress = Progress()
+        progress.parse('--------------[ Session statistics ]--------------\n')
+        progress.parse('ElapsedTime 125.50 (2 minutes 5.50 seconds)\n')
+        progress.parse('SourceFiles 1234\n')
+        progress.parse('TotalDestinationSizeChange -1024 (-1 KiB)\n')
+        self.assertEqual(
+            {'ElapsedTime': 125.5, 'SourceFiles': 1234, 'TotalDestinationSizeChange': -1024}, progress.stats
+        )
+
+    def test_eta(self):
+        # Given a previous session of 10 minutes
+        progress = Progress(previous_elapsed=600)
+        with mock.patch('time.monotonic', return_value=1000):
+            progress.parse('*        Processing changed file .\n')
+        # When 4 minutes elapsed
+        with mock.patch('time.monotonic', return_value=1240):
+            # Then 6 minutes are remaining
+            self.assertEqual(360, progress.eta)
+        # Without previous session, no ETA
+        self.assertIsNone(Progress().eta)
+
+    @parameterized.expand(
+        [
+            (0, '0 B'),
+            (1023, '1023 B'),
+            (1536, '1.5 KiB'),
+            (5 * 1024**3, '5.0 GiB'),
+        ]
+    )
+    def test_format_size(self, value, expected):
+        self.assertEqual(expected, format_size(value))
+
+    def test_format_progress(self):
+        self.assertEqual(
+            '12 files, 1.5 MiB, 2.0 KiB/s, about 00:06:00 remaining',
+            format_progress({'files': 12, 'bytes': 1572864, 'rate': 2048, 'eta': 360, 'path': 'foo'}),
+        )
+        self.assertEqual('', format_progress(None))
@@ -0,0 +1,261 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+import io
+import itertools
+import os
+import re
+import tempfile
+import time
+import unittest
+import unittest.mock
+from unittest.case import skipUnless
+
+from parameterized import parameterized
+
+from minarca_client.core.config import Pattern
+from minarca_client.core.scan import (
+    EXCLUDE,
+    INCLUDE,
+    SCAN,
+    ListingCache,
+    Manifest,
+    Selection,
+    _parents_regex,
+    changes,
+    estimate,
+    glob_to_regex,
+    optimize,
+    rescan,
+    scan,
+    write_filelist,
+)
+
+
+class SelectionTest(unittest.TestCase):
+    @parameterized.expand(
+        [
+            ('/home/user/Documents', False, INCLUDE),
+            ('/home/user/Documents/file.txt', False, INCLUDE),
+            ('/home/user/Documents/file.txt~', False, EXCLUDE),
+            ('/home/user/Documents/lost+found', True, EXCLUDE),
+            ('/home/user/Documents/tmp/file.txt', False, EXCLUDE),
+            ('/home', True, SCAN),
+            ('/home/user', True, SCAN),
+            ('/home/user/Music', True, EXCLUDE),
+            ('/etc', True, EXCLUDE),
+            ('/home/other/Pictures', True, INCLUDE),
+            ('/home/other/Pictures/a.jpg', False, INCLUDE),
+            ('/home/other', True, SCAN),
+        ]
+    )
+    def test_selection(self, path, is_dir, expected):
+        selection = Selection(
+            [
+                Pattern(False, '**/lost+found', None),
+                Pattern(False, '**/*~', None),
+                Pattern(False, '/home/user/Documents/tmp', None),
+                Pattern(True, '/home/user/Documents', None),
+                Pattern(True, '/home/*/Pictures', None),
+            ]
+        )
+        self.assertEqual(expected, selection(path, is_dir))
+
+    def test_selection_same_as_linear_evaluation(self):
+        # Given a lot of patterns as evaluated by rdiff-backup, one after the other.
+        patterns = [
+            Pattern(False, '**/*.tmp', None),
+            Pattern(True, '**/keep', None),
+            Pattern(False, '/home/*/cache', None),
+            Pattern(True, '/home/user/Documents/tmp/keep', None),
+            Pattern(False, '/home/user/Documents/tmp', None),
+            Pattern(True, '/home/*/Pictures', None),
+            Pattern(False, '/home/user/Downloads', None),
+            Pattern(True, '/home/user', None),
+            Pattern(True, '/srv/**/data', None),
+            Pattern(False, '/srv', None),
+            Pattern(True, '/etc', None),
+        ]
+        rules = []
+        for p in patterns:
+            pattern = p.pattern.rstrip('/')
+            regex = re.compile('^' + glob_to_regex(pattern) + '(?:/.*)?$')
+            parents = _parents_regex(pattern) if p.include else None
+            rules.append((p.include, regex, re.compile(parents) if parents else None))
+
+        def linear(path, is_dir):
+            for include, regex, parents in rules:
+                if regex.match(path):
+                    return INCLUDE if include else EXCLUDE
+                if is_dir and parents and parents.match(path):
+                    return SCAN
+            return EXCLUDE
+
+        # When evaluating paths
+        selection = Selection(patterns)
+        names = ['', 'home', 'user', 'other', 'Documents', 'tmp', 'keep', 'cache', 'Pictures', 'a.tmp', 'srv', 'x']
+        for path in itertools.product(names, repeat=3):
+            path = '/' + '/'.join(n for n in path if n)
+            for is_dir in [True, False]:
+                # Then result is the same as evaluating each pattern.
+                self.assertEqual(linear(path.rstrip('/'), is_dir), selection(path, is_dir), (path, is_dir))
+
+    def test_optimize(self):
+        # Given patterns as returned by group_by_roots
+        patterns = [
+            Pattern(False, '**/*.tmp', None),
+            Pattern(False, '/home/user/Documents/tmp', None),
+            Pattern(True, '/home/user/Documents/tmp/keep', None),
+            Pattern(False, '/home/user/*.bak', None),
+            Pattern(False, '/home/user/Downloads', None),
+            Pattern(True, '/home/user', None),
+        ]
+        # When optimizing the patterns
+        # Then literal excludes are moved first without crossing includes.
+        self.assertEqual(
+            [
+                Pattern(False, '/home/user/Documents/tmp', None),
+                Pattern(False, '**/*.tmp', None),
+                Pattern(True, '/home/user/Documents/tmp/keep', None),
+                Pattern(False, '/home/user/Downloads', None),
+                Pattern(False, '/home/user/*.bak', None),
+                Pattern(True, '/home/user', None),
+            ],
+            optimize(patterns),
+        )
+
+    def test_write_filelist(self):
+        f = io.StringIO()
+        write_filelist(f, [Pattern(False, '**/*.tmp', None), Pattern(True, '/home', None)])
+        self.assertEqual('- **/*.tmp\n+ /home\n', f.getvalue())
+
+    @skipUnless(os.environ.get('MINARCA_BENCHMARK'), reason='benchmark disabled, define MINARCA_BENCHMARK=1')
+    def test_benchmark_selection(self):
+        # Given a growing number of generated excludes
+        paths = [
+            '/home/user%d/project%d/%s/file%d.py' % (i % 10, i % 100, 'build' if i % 3 else 'src', i)
+            for i in range(20000)
+        ]
+        for count in [10, 100, 1000, 5000]:
+            patterns = [Pattern(False, '**/*.tmp%d' % i, None) for i in range(count // 10)]
+            patterns += [Pattern(False, '/home/user%d/project%d/build' % (i % 10, i), None) for i in range(count)]
+            patterns += [Pattern(True, '/home', None)]
+            for name, value in [('original', patterns), ('optimized', optimize(patterns))]:
+                # When evaluating the selection of every files
+                selection = Selection(value)
+                start = time.perf_counter()
+                for path in paths:
+                    selection(path)
+                elapsed = time.perf_counter() - start
+                # Then print the cost per file.
+                print('%5d patterns %9s: %.2f us/file' % (len(patterns), name, elapsed / len(paths) * 1e6))
+
+
+class ScanTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name.replace('\\', '/')
+        for path in ['data/a.txt', 'data/sub/b.txt', 'data/sub/c.tmp', 'other/d.txt']:
+            path = os.path.join(self.tmp.name, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('foo')
+        self.patterns = [Pattern(False, '**/*.tmp', None), Pattern(True, self.root + '/data', None)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_scan(self):
+        # When scanning the files
+        entries = scan(self.root, self.patterns)
+        # Then only selected files are returned
+        self.assertEqual(
+            sorted(self.root + p for p in ['/data', '/data/a.txt', '/data/sub', '/data/sub/b.txt']),
+            sorted(p for p, values in entries.items() if values),
+        )
+        self.assertNotIn(self.root + '/other', entries)
+        self.assertEqual(3, entries[self.root + '/data/a.txt'][0])
+
+    def test_changes(self):
+        # Given a manifest
+        entries = scan(self.root, self.patterns)
+        manifest = Manifest(os.path.join(self.tmp.name, 'manifest.gz'))
+        manifest.save('digest', entries, 'token:10')
+        # When reading the manifest
+        # Then the same data is returned.
+        self.assertEqual(('digest', 'token:10', entries), manifest.load())
+        self.assertEqual([], changes(entries, scan(self.root, self.patterns)))
+        # When a file get deleted
+        os.remove(os.path.join(self.tmp.name, 'data', 'a.txt'))
+        # Then changes are detected.
+        self.assertIn(self.root + '/data/a.txt', changes(entries, scan(self.root, self.patterns)))
+
+    def test_estimate(self):
+        # Given a pattern excluding a directory
+        patterns = [Pattern(False, self.root + '/data/sub', None)] + self.patterns
+        # When estimating the patterns
+        added, removed = estimate(self.root, patterns)
+        # Then included files are attributed to the include pattern.
+        self.assertEqual({patterns[2]: [1, 3]}, added)
+        # Then excluded files are attributed to the pattern excluding them.
+        self.assertEqual({patterns[0]: [1, 3]}, removed)
+
+    def test_estimate_with_cache(self):
+        # Given an estimate saved in cache
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        filename = os.path.join(cache_dir.name, 'estimate.json.gz')
+        cache = ListingCache(filename)
+        self.assertEqual(
+            ({self.patterns[1]: [2, 6]}, {self.patterns[0]: [1, 3]}), estimate(self.root, self.patterns, cache)
+        )
+        cache.save()
+        # When estimating again with unchanged directories
+        cache = ListingCache(filename)
+        with unittest.mock.patch('os.scandir', side_effect=AssertionError('should not be called')):
+            result = estimate(self.root, self.patterns, cache)
+        # Then the result is the same.
+        self.assertEqual(({self.patterns[1]: [2, 6]}, {self.patterns[0]: [1, 3]}), result)
+        # When a file is rewritten in place
+        cache.save()
+        cache = ListingCache(filename)
+        with open(os.path.join(self.tmp.name, 'data', 'a.txt'), 'r+') as f:
+            f.write('foobar')
+        with unittest.mock.patch('os.scandir', side_effect=AssertionError('should not be called')):
+            result = estimate(self.root, self.patterns, cache)
+        # Then the current size of the file is returned.
+        self.assertEqual(({self.patterns[1]: [2, 9]}, {self.patterns[0]: [1, 3]}), result)
+
+    def test_load_invalid_manifest(self):
+        filename = os.path.join(self.tmp.name, 'manifest.gz')
+        self.assertEqual((None, None, {}), Manifest(filename).load())
+        with open(filename, 'wb') as f:
+            f.write(b'invalid')
+        self.assertEqual((None, None, {}), Manifest(filename).load())
+
+    def test_rescan(self):
+        # Given a previous scan
+        previous = scan(self.root, self.patterns)
+        # Given modification in multiple directories
+        with open(os.path.join(self.tmp.name, 'data', 'sub', 'b.txt'), 'w') as f:
+            f.write('modified')
+        os.remove(os.path.join(self.tmp.name, 'data', 'a.txt'))
+        os.makedirs(os.path.join(self.tmp.name, 'data', 'new', 'deep'))
+        with open(os.path.join(self.tmp.name, 'data', 'new', 'deep', 'e.txt'), 'w') as f:
+            f.write('new')
+        # When scanning only the dirty directories
+        entries = rescan(self.root, self.patterns, previous, [self.root, self.root + '/data', self.root + '/data/sub'])
+        # Then result is the same as a full scan, including new sub directories.
+        self.assertEqual(scan(self.root, self.patterns), entries)
+
+    def test_rescan_deleted_directory(self):
+        # Given a previous scan
+        previous = scan(self.root, self.patterns)
+        # Given a deleted directory
+        os.remove(os.path.join(self.tmp.name, 'data', 'sub', 'b.txt'))
+        os.remove(os.path.join(self.tmp.name, 'data', 'sub', 'c.tmp'))
+        os.rmdir(os.path.join(self.tmp.name, 'data', 'sub'))
+        # When scanning only the dirty directories
+        entries = rescan(self.root, self.patterns, previous, [self.root, self.root + '/data'])
+        # Then content of the directory is removed.
+        self.assertEqual(scan(self.root, self.patterns), entries)
@@ -0,0 +1,124 @@
+# Copyright (C) 2023 IKUS Software. All rights reserved.
+# IKUS Software inc. PROPRIETARY/CONFIDENTIAL.
+# Use is subject to license terms.
+import os
+import tempfile
+import unittest
+
+from minarca_client.core.config import Pattern
+from minarca_client.core.scan import Selection, scan
+from minarca_client.core.shard import assign, sources, split, units
+
+
+class ShardTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.root = self.tmp.name.replace('\\', '/')
+        files = {
+            'share/big/a.bin': 'x' * 100,
+            'share/big/b.bin': 'x' * 100,
+            'share/medium/c.bin': 'x' * 60,
+            'share/small/d.bin': 'x' * 30,
+            'share/small/e.tmp': 'x' * 1000,
+            'share/file.txt': 'foo',
+            'other/f.txt': 'foo',
+        }
+        for path, data in files.items():
+            path = os.path.join(self.tmp.name, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(data)
+        self.patterns = [Pattern(False, '**/*.tmp', None), Pattern(True, self.root + '/share', None)]
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_units(self):
+        # When searching directories to be sharded
+        sizes = units(self.root, self.patterns)
+        # Then sub directories of included folders are returned with their size.
+        self.assertEqual(
+            {self.root + '/share/big': 200, self.root + '/share/medium': 60, self.root + '/share/small': 30},
+            sizes,
+        )
+
+    def test_units_with_known_sizes(self):
+        # Given directories already measured
+        known = {self.root + '/share/big': 5, self.root + '/share/gone': 7}
+        # When searching directories to be sharded
+        sizes = units(self.root, self.patterns, known=known)
+        # Then known sizes are reused, only new directories are measured.
+        self.assertEqual(
+            {self.root + '/share/big': 5, self.root + '/share/medium': 60, self.root + '/share/small': 30},
+            sizes,
+        )
+
+    def test_assign(self):
+        # Given directories with different sizes
+        sizes = {'/a': 200, '/b': 60, '/c': 30, '/d': 10}
+        # When assigned to shards
+        assignment = assign(sizes, 2, {})
+        # Then shards are balanced.
+        self.assertEqual({'/a': 0, '/b': 1, '/c': 1, '/d': 1}, assignment)
+        # When a new directory get created
+        sizes['/e'] = 500
+        assignment = assign(sizes, 2, {path: (shard, sizes[path]) for path, shard in assignment.items()})
+        # Then previous assignments are kept.
+        self.assertEqual({'/a': 0, '/b': 1, '/c': 1, '/d': 1, '/e': 1}, assignment)
+
+    def test_assign_with_loads(self):
+        # Given shards with a known size from their last session
+        previous = {'/a': (0, 10), '/b': (1, 10)}
+        # When a new directory get created
+        assignment = assign({'/a': 10, '/b': 10, '/c': 5}, 2, previous, loads=[20, None])
+        # Then it's assigned to the smallest shard.
+        self.assertEqual({'/a': 0, '/b': 1, '/c': 1}, assignment)
+
+    def test_split_with_wildcard_include(self):
+        # Given files excluded, but selected again by wildcard include patterns
+        for path in ['share/big/cache/keep.bin', 'share/small/cache/keep.bin', 'share/small/sub/keep.tmp']:
+            path = os.path.join(self.tmp.name, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write('foo')
+        patterns = [
+            Pattern(True, self.root + '/share/*/cache/keep.bin', None),
+            Pattern(True, '**/keep.tmp', None),
+            Pattern(False, self.root + '/share/*/cache', None),
+            Pattern(False, '**/*.tmp', None),
+            Pattern(True, self.root + '/share', None),
+        ]
+        assignment = {self.root + '/share/big': 0, self.root + '/share/medium': 1, self.root + '/share/small': 1}
+        # When splitting the patterns
+        shards = split(patterns, assignment, 2)
+        # Then files selected by wildcard patterns are backup by the shard of their directory.
+        selected = [scan(self.root, patterns) for unused, patterns in shards]
+        files = [{p for p, values in entries.items() if values and os.path.isfile(p)} for entries in selected]
+        self.assertIn(self.root + '/share/big/cache/keep.bin', files[0])
+        self.assertIn(self.root + '/share/small/cache/keep.bin', files[1])
+        self.assertIn(self.root + '/share/small/sub/keep.tmp', files[1])
+        # Then each file is selected by a single shard.
+        self.assertEqual(set(), files[0] & files[1])
+        expected = {p for p, values in scan(self.root, patterns).items() if values and os.path.isfile(p)}
+        self.assertEqual(expected, files[0] | files[1])
+
+    def test_split(self):
+        # Given directories assigned to shards
+        assignment = assign(units(self.root, self.patterns), 2, {})
+        # When splitting the patterns
+        shards = split(self.patterns, assignment, 2)
+        # Then each file is selected by a single shard.
+        selected = [scan(self.root, patterns) for unused, patterns in shards]
+        files = [{p for p, values in entries.items() if values and os.path.isfile(p)} for entries in selected]
+        self.assertEqual(
+            {self.root + '/share/file.txt', self.root + '/share/big/a.bin', self.root + '/share/big/b.bin'}, files[0]
+        )
+        self.assertEqual({self.root + '/share/medium/c.bin', self.root + '/share/small/d.bin'}, files[1])
+        # Then excludes are applied to every shard.
+        self.assertFalse(Selection(shards[1][1])(self.root + '/share/small/e.tmp'))
+
+    def test_sources(self):
+        assignment = {'/share/big': 0, '/share/medium': 1, '/share/small': 2}
+        self.assertEqual([('/share', 0), ('/share/medium', 1), ('/share/small', 2)], sources('/share', assignment))
+        self.assertEqual([('/share/small/d.bin', 2)], sources('/share/small/d.bin', assignment))
+        self.assertEqual([('/other', 0)], sources('/other', assignment))
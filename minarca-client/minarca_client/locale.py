@@ -10,8 +10,6 @@ import locale
 import os
 import sys
 
-import pkg_resources
-
 # On MacOS, we need to get the language using native API. Because the LANG
 # environment variable is not pass to the application bundle.
 languages = None
@@ -36,7 +34,7 @@ elif sys.platform == 'win32':
         pass
 
 # Load translations
-localedir = pkg_resources.resource_filename(__name__, 'locales')
+localedir = os.path.join(os.path.dirname(__file__), 'locales')
 try:
     t = _gt.translation('messages', localedir, languages=languages)
 except OSError:
@@ -3,26 +3,25 @@
 # Use is subject to license terms.
 
 
+import datetime
 import getpass
 import logging
 import logging.handlers
 import os
 import signal
 import sys
+import time
 import traceback
-from argparse import ArgumentParser
-
-import rdiffbackup.run
+from argparse import ArgumentParser, ArgumentTypeError
 
 from minarca_client import __version__
-from minarca_client.core import Backup
+from minarca_client.core import Backup, download, history
 from minarca_client.core.compat import IS_WINDOWS, RobustRotatingFileHandler, get_default_repository_name, get_log_file
 from minarca_client.core.config import Pattern, Settings
-from minarca_client.core.exceptions import BackupError, NotRunningError, RepositoryNameExistsError
+from minarca_client.core.exceptions import BackupError, NotRunningError, NotScheduleError, RepositoryNameExistsError
 from minarca_client.core.latest import LatestCheck, LatestCheckFailed
+from minarca_client.core.progress import format_progress, format_size
 from minarca_client.locale import _
-from minarca_client.ui.home import HomeDialog
-from minarca_client.ui.setup import SetupDialog
 
 _EXIT_BACKUP_FAIL = 1
 _EXIT_ALREADY_LINKED = 2
@@ -51,16 +50,51 @@ def _prompt_yes_no(msg):
     return answer.lower() in [_("yes"), _("y")]
 
 
-def _backup(force):
+def _agent():
+    """
+    Run the resident agent until stopped.
+    """
+    from minarca_client.core.agent import Agent
+
     signal.signal(signal.SIGINT, signal.default_int_handler)
-    # Check version
     try:
-        latest_check = LatestCheck()
-        if not latest_check.is_latest():
-            logging.info(_('new version %s available') % latest_check.get_latest_version())
-    except LatestCheckFailed:
-        logging.info(_('fail to check for latest version'))
+        Agent().run()
+    except KeyboardInterrupt:
+        pass
+    except BackupError as e:
+        # Print message to stdout and log file.
+        logging.info(str(e))
+        sys.exit(_EXIT_BACKUP_FAIL)
+
+
+def _backup(force, dry_run=False):
+    signal.signal(signal.SIGINT, signal.default_int_handler)
     backup = Backup()
+    if dry_run:
+        _dry_run(backup)
+        return
+    # When the agent is enabled, the OS scheduler only make sure it's running.
+    if not force and backup.get_settings('agent'):
+        from minarca_client.core.agent import Agent
+
+        if not Agent(backup).is_running():
+            logging.info(_('starting agent'))
+            backup.start(action='agent')
+        return
+    # Fast path when called by the scheduler: exit early if it's not the time to run.
+    if not force and not backup.is_backup_time():
+        logging.info(str(NotScheduleError()))
+        sys.exit(_EXIT_BACKUP_FAIL)
+    # The fork server must be started before any thread.
+    backup.start_fork_server()
+    # Check version using the cached value. Refresh it in background to avoid delaying the backup.
+    latest_check = LatestCheck()
+    latest_check.refresh_async()
+    try:
+        if not latest_check.is_latest(cached=True):
+            logging.info(_('new version %s available') % latest_check.get_cached_version())
+    except LatestCheckFailed:
+        logging.debug('latest version not available')
     try:
         backup.backup(force=force)
     except BackupError as e:
@@ -72,13 +106,60 @@ def _backup(force):
         sys.exit(_EXIT_BACKUP_FAIL)
 
 
-def _link(remoteurl=None, username=None, name=None, force=False, password=None):
+def _dry_run(backup):
+    """
+    Print what the next backup would transfer.
+    """
+    try:
+        results = backup.dry_run()
+    except BackupError as e:
+        logging.info(str(e))
+        sys.exit(_EXIT_BACKUP_FAIL)
+    for result in results:
+        print(_("%s (compared with snapshot of %s)") % (result['root'], result['snapshot'] or _('unknown')))
+        print(_("  New files:            %s") % result['new'])
+        print(_("  Changed files:        %s") % result['changed'])
+        print(_("  Deleted files:        %s") % result['deleted'])
+        print(_("  Bytes to send:        %s") % format_size(result['bytes']))
+        if result['eta'] is not None:
+            print(_("  Estimated duration:   %s") % time.strftime('%H:%M:%S', time.gmtime(result['eta'])))
+        else:
+            print(_("  Estimated duration:   %s") % _('Unknown'))
+
+
+def _history(cached=False):
+    """
+    Return the index of the backup history, updated from the server unless `cached`.
+    """
+    backup = Backup()
+    if cached:
+        return history.History(backup.history_file)
+    try:
+        return backup.update_history()
+    except BackupError as e:
+        print(e.message)
+        sys.exit(_EXIT_BACKUP_FAIL)
+
+
+def _format_epoch(epoch):
+    """
+    Return the given epoch as an ISO date usable as `--restore-time`.
+    """
+    return datetime.datetime.fromtimestamp(epoch).astimezone().isoformat()
+
+
+def _find(pattern, cached=False, destination=None):
+    for path, epochs in _history(cached).find(pattern, destination):
+        print('%s  %s  %s' % (_format_epoch(epochs[0]), _format_epoch(epochs[-1]), path))
+
+
+def _link(remoteurl=None, username=None, name=None, force=False, password=None, destination=None):
     """
     Start the linking process in command line.
     """
     backup = Backup()
     # If the backup is already linked, return an error.
-    if backup.is_linked() and not force:
+    if backup.is_linked() and not force and not destination:
         print(_('minarca is already linked, execute `minarca unlink`'))
         sys.exit(_EXIT_ALREADY_LINKED)
     # Prompt remoteurl
@@ -92,12 +173,26 @@ def _link(remoteurl=None, username=None, name=None, force=False, password=None):
     # Start linking process.
     try:
         try:
-            backup.link(remoteurl=remoteurl, username=username, password=password, repository_name=name, force=force)
+            backup.link(
+                remoteurl=remoteurl,
+                username=username,
+                password=password,
+                repository_name=name,
+                force=force,
+                destination=destination,
+            )
             print(_('Linked successfully'))
         except RepositoryNameExistsError as e:
             print(e.message)
             if _prompt_yes_no(_('Do you want to replace the existing repository ?')):
-                backup.link(remoteurl=remoteurl, username=username, password=password, repository_name=name, force=True)
+                backup.link(
+                    remoteurl=remoteurl,
+                    username=username,
+                    password=password,
+                    repository_name=name,
+                    force=True,
+                    destination=destination,
+                )
                 print(_('Linked successfully'))
                 return
             sys.exit(_EXIT_REPO_EXISTS)
@@ -116,9 +211,27 @@ def _link(remoteurl=None, username=None, name=None, force=False, password=None):
         )
 
 
-def _pattern(include, pattern):
+def _epoch(value):
+    """
+    Convert a date time argument into an epoch.
+    """
+    try:
+        return download.epoch(value)
+    except ValueError:
+        raise ArgumentTypeError(_('invalid date time: %s') % value)
+
+
+def _ls(path=None, restore_time=None, cached=False, destination=None):
+    path = os.path.normpath(os.path.join(os.getcwd(), path or '.'))
+    for name, epoch in _history(cached).ls(path, restore_time, destination):
+        print('%s  %s' % (_format_epoch(epoch), name))
+
+
+def _pattern(include, pattern, tier=None):
     backup = Backup()
-    new_patterns = backup.get_patterns()
+    if tier:
+        _add_tier(backup, tier)
+    new_patterns = backup.get_patterns(tier)
     for path in pattern:
         p = Pattern(include, path, None)
         if not p.is_wildcard():
@@ -127,13 +240,32 @@ def _pattern(include, pattern):
             p = Pattern(include, path, None)
         # Add new pattern
         new_patterns.append(p)
-    backup.set_patterns(new_patterns)
+    backup.set_patterns(new_patterns, tier)
+
 
+def _add_tier(backup, tier, schedule=None):
+    try:
+        backup.add_tier(tier, schedule)
+    except ValueError as e:
+        print(str(e))
+        sys.exit(_EXIT_BACKUP_FAIL)
 
-def _patterns():
+
+def _patterns(estimate=False, tier=None):
     backup = Backup()
-    patterns = backup.get_patterns()
-    patterns.write(sys.stdout)
+    patterns = backup.get_patterns(tier)
+    if not estimate:
+        patterns.write(sys.stdout)
+        return
+    # Print number of files and bytes added or removed by each pattern.
+    estimates = backup.estimate_patterns(patterns)
+    for pattern in patterns:
+        files, size = estimates.get(pattern, (0, 0))
+        print(
+            ('+%s\t' if pattern.include else '-%s\t') % pattern.pattern
+            + ('+' if pattern.include else '-')
+            + _('%s files, %s') % (files, format_size(size))
+        )
 
 
 def _pause(delay):
@@ -153,6 +285,9 @@ def _rdiff_backup(options):
     """
     Execute rdiff-backup process within minarca.
     """
+    # Lazy import, only required by this sub command.
+    import rdiffbackup.run
+
     try:
         return rdiffbackup.run.main_run(options)
     except Exception as e:
@@ -161,7 +296,9 @@ def _rdiff_backup(options):
         sys.exit(_EXIT_BACKUP_FAIL)
 
 
-def _restore(restore_time, force, pattern):
+def _restore(
+    restore_time, force, pattern, destination=None, http=False, password=None, differential=False, verify=False
+):
     signal.signal(signal.SIGINT, signal.default_int_handler)
     assert isinstance(pattern, list)
     # Prompt user to confirm restore operation.
@@ -194,7 +331,19 @@ def _restore(restore_time, force, pattern):
 
     # Execute restore operation.
     try:
-        backup.restore(restore_time=restore_time, patterns=pattern)
+        rdiffweb = None
+        if http:
+            # Prompt for password if missing.
+            password = password or getpass.getpass(_('password or access token: ')) or _abort()
+            rdiffweb = backup.get_rdiffweb(password, destination=destination)
+        backup.restore(
+            restore_time=restore_time,
+            patterns=pattern,
+            destination=destination,
+            rdiffweb=rdiffweb,
+            differential=differential,
+            verify=verify,
+        )
     except BackupError as e:
         # Print message to stdout and log file.
         logging.info(str(e))
@@ -214,10 +363,13 @@ def _stop(force):
             sys.exit(_EXIT_NOT_RUNNING)
 
 
-def _schedule(schedule, username=None, password=None):
+def _schedule(schedule, username=None, password=None, tier=None):
     backup = Backup()
     # Define frequency
-    backup.set_settings('schedule', schedule)
+    if tier:
+        _add_tier(backup, tier, schedule)
+    else:
+        backup.set_settings('schedule', schedule)
     # Make sure to schedule job in OS too.
     run_if_logged_out = (username, password) if username or password else None
     try:
@@ -243,11 +395,25 @@ def _status():
     except BackupError:
         connected = False
     print(_("Remote server:          %s") % settings['remotehost'])
+    repo_urls = backup.get_repo_urls()
+    if len(repo_urls) > 1:
+        # Shards and tiers are backup into their own repository.
+        print(_("Repositories:"))
+        for url in repo_urls:
+            print(_("  %s") % url)
     print(_("Connectivity status:    %s" % (_("Connected") if connected else _("Not connected"))))
     print(_("Last successful backup: %s") % status.get('lastsuccess', _('Never')))
+    for tier in settings.tiers():
+        print(_("  Tier %s: %s") % (tier.name, status.tier_lastsuccess(tier.name) or _('Never')))
     print(_("Last backup date:       %s") % status.get('lastdate', _('Never')))
     print(_("Last backup status:     %s") % status.get('lastresult', _('Never')))
     print(_("Details:                %s") % status.get('details', ''))
+    for name, lastresult, details in status.sessions():
+        print(_("  %s: %s %s") % (name, lastresult, details))
+        progress = status.progress(name)
+        if progress and lastresult == 'RUNNING':
+            print(_("    Progress:           %s") % format_progress(progress))
+            print(_("    Current file:       %s") % (progress['path'] or ''))
     if settings['pause_until']:
         print(_("Paused until:           %s") % settings['remotehost'])
 
@@ -256,6 +422,10 @@ def _ui():
     """
     Entry point to start minarca user interface.
     """
+    # Lazy import of graphical user interface.
+    from minarca_client.ui.home import HomeDialog
+    from minarca_client.ui.setup import SetupDialog
+
     # If not linked, let the user configure mianrca
     backup = Backup()
     if not backup.is_linked():
@@ -269,9 +439,13 @@ def _ui():
     home.mainloop()
 
 
-def _unlink():
+def _unlink(destination=None):
     backup = Backup()
-    backup.unlink()
+    try:
+        backup.unlink(destination)
+    except BackupError as e:
+        print(e.message)
+        sys.exit(_EXIT_LINK_ERROR)
 
 
 def _parse_args(args):
@@ -299,20 +473,31 @@ def _parse_args(args):
     sub.add_argument('--force', action='store_true', help=_("force execution of a backup even if it's not time to run"))
     sub.set_defaults(func=_start)
 
+    # Agent
+    sub = subparsers.add_parser('agent', help=_('run backups on schedule from a resident process'))
+    sub.set_defaults(func=_agent)
+
     # Backup
     sub = subparsers.add_parser('backup', help=_('start a backup in foreground mode'))
     sub.add_argument('--force', action='store_true', help=_("force execution of a backup even if it's not time to run"))
+    sub.add_argument(
+        '--dry-run',
+        action='store_true',
+        help=_("report the files and bytes the next backup would transfer without running it"),
+    )
     sub.set_defaults(func=_backup)
 
     # exclude
     sub = subparsers.add_parser('exclude', help=_('exclude files to be backup'))
     sub.add_argument('pattern', nargs='+', help=_('file pattern to be exclude. may contains `*` or `?` wildcard'))
+    sub.add_argument('--tier', help=_("update the patterns of the given tier instead of the default patterns"))
     sub.set_defaults(func=_pattern)
     sub.set_defaults(include=False)
 
     # include
     sub = subparsers.add_parser('include', help=_('include files to be backup'))
     sub.add_argument('pattern', nargs='+', help=_('file pattern to be exclude. may contains `*` or `?` wildcard'))
+    sub.add_argument('--tier', help=_("update the patterns of the given tier instead of the default patterns"))
     sub.set_defaults(func=_pattern)
     sub.set_defaults(include=True)
 
@@ -327,12 +512,44 @@ def _parse_args(args):
     sub.add_argument(
         '--force', action='store_true', help=_("link to remote server even if the repository name already exists")
     )
+    sub.add_argument(
+        '--destination', help=_("name of an additional destination to be linked, receiving the same backup")
+    )
     sub.set_defaults(func=_link)
 
     # patterns
     sub = subparsers.add_parser('patterns', help=_('list the includes / excludes patterns'))
+    sub.add_argument(
+        '--estimate',
+        action='store_true',
+        help=_("print the number of files and bytes added or removed by each pattern"),
+    )
+    sub.add_argument('--tier', help=_("list the patterns of the given tier instead of the default patterns"))
     sub.set_defaults(func=_patterns)
 
+    # ls
+    sub = subparsers.add_parser('ls', help=_('list the files of a folder available in the backup'))
+    sub.add_argument(
+        '--restore-time',
+        type=_epoch,
+        help=_(
+            "Date time to be listed. Default to the latest backup. Accept the same formats as `restore --restore-time`."
+        ),
+    )
+    sub.add_argument('--cached', action='store_true', help=_("use the local index without contacting the server"))
+    sub.add_argument('--destination', help=_("list the backup of the given additional destination"))
+    sub.add_argument('path', nargs='?', help=_('folder to be listed. Default to current folder'))
+    sub.set_defaults(func=_ls)
+
+    # find
+    sub = subparsers.add_parser(
+        'find', help=_('search files in every backup by name or pattern. Print the first and last backup date')
+    )
+    sub.add_argument('--cached', action='store_true', help=_("use the local index without contacting the server"))
+    sub.add_argument('--destination', help=_("search the backup of the given additional destination"))
+    sub.add_argument('pattern', help=_('text contained in the path or a pattern like `*.odt`'))
+    sub.set_defaults(func=_find)
+
     # Restore
     sub = subparsers.add_parser('restore', help=_('restore data from backup'))
     sub.add_argument(
@@ -344,8 +561,26 @@ def _parse_args(args):
     sub.add_argument(
         '--force', action='store_true', help=_("force execution of restore operation without confirmation from user")
     )
+    sub.add_argument('--destination', help=_("restore from the given additional destination"))
+    sub.add_argument(
+        '--http', action='store_true', help=_("download the files from the web server instead of using rdiff-backup")
+    )
+    sub.add_argument(
+        '-p', '--password', help=_("password or access token to use with --http. Will prompt if not provided")
+    )
+    sub.add_argument(
+        '--differential',
+        action='store_true',
+        help=_("only restore the files that differ from the backup. Files not found in the backup are kept"),
+    )
+    sub.add_argument(
+        '--verify',
+        action='store_true',
+        help=_("with --differential, compare the content of the files instead of their size and modification time"),
+    )
     sub.add_argument('pattern', nargs='*', help=_('files and folders to be restore'))
     sub.set_defaults(func=_restore)
+    restore_parser = sub
 
     # Stop
     sub = subparsers.add_parser('stop', help=_('stop the backup'))
@@ -377,6 +612,7 @@ def _parse_args(args):
         const=Settings.WEEKLY,
         help=_("schedule backup to run weekly"),
     )
+    sub.add_argument('--tier', help=_("define the schedule of the given tier instead of the default schedule"))
     if IS_WINDOWS:
         sub.add_argument('-u', '--username', help=_("username required to run task when user is logged out"))
         sub.add_argument('-p', '--password', help=_("password required to run task when user is logged out"))
@@ -388,6 +624,7 @@ def _parse_args(args):
 
     # unlink
     sub = subparsers.add_parser('unlink', help=_('unlink this minarca client from server'))
+    sub.add_argument('--destination', help=_("only unlink the given additional destination"))
     sub.set_defaults(func=_unlink)
 
     # pause
@@ -423,7 +660,13 @@ def _parse_args(args):
     if args and args[0] == 'rdiff-backup':
         args = args.copy()
         args.insert(1, '--')
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
+    if getattr(args, 'func', None) is _restore:
+        if args.verify and not args.differential:
+            restore_parser.error(_('--verify requires --differential'))
+        if args.http and args.differential:
+            restore_parser.error(_('--differential is not supported with --http'))
+    return args
 
 
 def _configure_logging(debug=False):
@@ -10,16 +10,19 @@ import contextlib
 import io
 import logging
 import os
+import subprocess
+import sys
 import tempfile
 import unittest
 from unittest import mock
+from unittest.case import skipUnless
 
 from parameterized import parameterized
 
 from minarca_client import main
 from minarca_client.core import Backup, HttpAuthenticationError
 from minarca_client.core.compat import IS_WINDOWS
-from minarca_client.core.config import Pattern, Patterns, Settings
+from minarca_client.core.config import Pattern, Patterns, Settings, Tier
 from minarca_client.main import (
     _EXIT_LINK_ERROR,
     _backup,
@@ -49,32 +52,37 @@ class TestMainParseArgs(unittest.TestCase):
     @mock.patch('minarca_client.main._backup')
     def test_args_backup(self, mock_backup):
         main.main(['backup'])
-        mock_backup.assert_called_once_with(force=False)
+        mock_backup.assert_called_once_with(force=False, dry_run=False)
 
     @mock.patch('minarca_client.main._backup')
     def test_args_backup_force(self, mock_backup):
         main.main(['backup', '--force'])
-        mock_backup.assert_called_once_with(force=True)
+        mock_backup.assert_called_once_with(force=True, dry_run=False)
+
+    @mock.patch('minarca_client.main._backup')
+    def test_args_backup_dry_run(self, mock_backup):
+        main.main(['backup', '--dry-run'])
+        mock_backup.assert_called_once_with(force=False, dry_run=True)
 
     @mock.patch('minarca_client.main._pattern')
     def test_args_exclude(self, mock_pattern):
         main.main(['exclude', '*.bak'])
-        mock_pattern.assert_called_once_with(include=False, pattern=['*.bak'])
+        mock_pattern.assert_called_once_with(include=False, pattern=['*.bak'], tier=None)
 
     @mock.patch('minarca_client.main._pattern')
     def test_args_exclude_multiple(self, mock_pattern):
         main.main(['exclude', '*.bak', '$~*', '/proc'])
-        mock_pattern.assert_called_once_with(include=False, pattern=['*.bak', '$~*', '/proc'])
+        mock_pattern.assert_called_once_with(include=False, pattern=['*.bak', '$~*', '/proc'], tier=None)
 
     @mock.patch('minarca_client.main._pattern')
     def test_args_include(self, mock_pattern):
         main.main(['include', '*.bak'])
-        mock_pattern.assert_called_once_with(include=True, pattern=['*.bak'])
+        mock_pattern.assert_called_once_with(include=True, pattern=['*.bak'], tier=None)
 
     @mock.patch('minarca_client.main._pattern')
     def test_args_include_multiple(self, mock_pattern):
         main.main(['include', '*.bak', '$~*', '/proc'])
-        mock_pattern.assert_called_once_with(include=True, pattern=['*.bak', '$~*', '/proc'])
+        mock_pattern.assert_called_once_with(include=True, pattern=['*.bak', '$~*', '/proc'], tier=None)
 
     @mock.patch('minarca_client.main._link')
     def test_args_link(self, mock_link):
@@ -82,7 +90,7 @@ class TestMainParseArgs(unittest.TestCase):
             ['link', '--remoteurl', 'https://localhost', '--username', 'foo', '--password', 'bar', '--name', 'repo']
         )
         mock_link.assert_called_once_with(
-            remoteurl='https://localhost', username='foo', password='bar', name='repo', force=False
+            remoteurl='https://localhost', username='foo', password='bar', name='repo', force=False, destination=None
         )
 
     @mock.patch('minarca_client.main.Backup')
@@ -99,14 +107,14 @@ class TestMainParseArgs(unittest.TestCase):
         main.main(['ui'])
         mock_ui.assert_called_once()
 
-    @mock.patch('minarca_client.main.SetupDialog')
+    @mock.patch('minarca_client.ui.setup.SetupDialog')
     def test_args_ui_is_not_linked(self, mock_setup_dlg):
         main.main(['ui'])
         mock_setup_dlg.assert_called_once()
         mock_setup_dlg.return_value.mainloop.assert_called_once()
 
-    @mock.patch('minarca_client.main.SetupDialog')
-    @mock.patch('minarca_client.main.HomeDialog')
+    @mock.patch('minarca_client.ui.setup.SetupDialog')
+    @mock.patch('minarca_client.ui.home.HomeDialog')
     def test_args_ui_is_linked(self, mock_setup_dlg, mock_home_dlg):
         main.main(['ui'])
         mock_setup_dlg.assert_not_called()
@@ -120,7 +128,12 @@ class TestMainParseArgs(unittest.TestCase):
             ['link', '--remoteurl', 'https://localhost', '--username', 'foo', '--password', 'bar', '--name', 'repo']
         )
         mock_backup.return_value.link.assert_called_once_with(
-            remoteurl='https://localhost', username='foo', password='bar', repository_name='repo', force=False
+            remoteurl='https://localhost',
+            username='foo',
+            password='bar',
+            repository_name='repo',
+            force=False,
+            destination=None,
         )
 
     @mock.patch('getpass.getpass')
@@ -130,7 +143,12 @@ class TestMainParseArgs(unittest.TestCase):
         mock_getpass.return_value = 'bar'
         main.main(['link', '--remoteurl', 'https://localhost', '--username', 'foo', '--name', 'repo'])
         mock_backup.return_value.link.assert_called_once_with(
-            remoteurl='https://localhost', username='foo', password='bar', repository_name='repo', force=False
+            remoteurl='https://localhost',
+            username='foo',
+            password='bar',
+            repository_name='repo',
+            force=False,
+            destination=None,
         )
 
     @mock.patch('getpass.getpass')
@@ -172,13 +190,18 @@ class TestMainParseArgs(unittest.TestCase):
             ]
         )
         mock_link.assert_called_once_with(
-            remoteurl='https://localhost', username='foo', password='bar', name='repo', force=True
+            remoteurl='https://localhost', username='foo', password='bar', name='repo', force=True, destination=None
         )
 
     @mock.patch('minarca_client.main._patterns')
     def test_args_patterns(self, mock_patterns):
         main.main(['patterns'])
-        mock_patterns.assert_called_once_with()
+        mock_patterns.assert_called_once_with(estimate=False, tier=None)
+
+    @mock.patch('minarca_client.main._patterns')
+    def test_args_patterns_estimate(self, mock_patterns):
+        main.main(['patterns', '--estimate'])
+        mock_patterns.assert_called_once_with(estimate=True, tier=None)
 
     @parameterized.expand(
         [
@@ -195,10 +218,46 @@ class TestMainParseArgs(unittest.TestCase):
         main.main(['pause'] + args)
         mock_pause.assert_called_once_with(**expected_call)
 
+    @mock.patch('minarca_client.main._ls')
+    def test_args_ls(self, mock_ls):
+        main.main(['ls', '--restore-time', '1682367069', './test'])
+        mock_ls.assert_called_once_with(restore_time=1682367069, cached=False, path='./test', destination=None)
+        # Invalid date time are reported as argument error.
+        with self.assertRaises(SystemExit) as cm, contextlib.redirect_stderr(io.StringIO()) as f:
+            main.main(['ls', '--restore-time', 'invalid'])
+        self.assertEqual(2, cm.exception.code)
+        self.assertIn('invalid date time: invalid', f.getvalue())
+
+    @mock.patch('minarca_client.main._find')
+    def test_args_find(self, mock_find):
+        main.main(['find', '--cached', '--destination', 'offsite', '*.odt'])
+        mock_find.assert_called_once_with(cached=True, pattern='*.odt', destination='offsite')
+
     @mock.patch('minarca_client.main._restore')
     def test_args_restore(self, mock_restore):
         main.main(['restore', './test'])
-        mock_restore.assert_called_once_with(restore_time=None, force=False, pattern=['./test'])
+        mock_restore.assert_called_once_with(
+            restore_time=None,
+            force=False,
+            pattern=['./test'],
+            destination=None,
+            http=False,
+            password=None,
+            differential=False,
+            verify=False,
+        )
+
+    @mock.patch('minarca_client.main._restore')
+    def test_args_restore_invalid_combination(self, mock_restore):
+        for args, message in [
+            (['restore', '--verify', './test'], '--verify requires --differential'),
+            (['restore', '--http', '--differential', './test'], '--differential is not supported with --http'),
+        ]:
+            with self.assertRaises(SystemExit) as cm, contextlib.redirect_stderr(io.StringIO()) as f:
+                main.main(args)
+            self.assertEqual(2, cm.exception.code)
+            self.assertIn(message, f.getvalue())
+        mock_restore.assert_not_called()
 
     @mock.patch('minarca_client.main._stop')
     def test_args_stop(self, mock_stop):
@@ -214,33 +273,33 @@ class TestMainParseArgs(unittest.TestCase):
     def test_args_schedule(self, mock_schedule):
         main.main(['schedule'])
         if IS_WINDOWS:
-            mock_schedule.assert_called_once_with(schedule=Settings.DAILY, username=None, password=None)
+            mock_schedule.assert_called_once_with(schedule=Settings.DAILY, username=None, password=None, tier=None)
         else:
-            mock_schedule.assert_called_once_with(schedule=Settings.DAILY)
+            mock_schedule.assert_called_once_with(schedule=Settings.DAILY, tier=None)
 
     @mock.patch('minarca_client.main._schedule')
     def test_args_schedule_daily(self, mock_schedule):
         main.main(['schedule', '--daily'])
         if IS_WINDOWS:
-            mock_schedule.assert_called_once_with(schedule=Settings.DAILY, username=None, password=None)
+            mock_schedule.assert_called_once_with(schedule=Settings.DAILY, username=None, password=None, tier=None)
         else:
-            mock_schedule.assert_called_once_with(schedule=Settings.DAILY)
+            mock_schedule.assert_called_once_with(schedule=Settings.DAILY, tier=None)
 
     @mock.patch('minarca_client.main._schedule')
     def test_args_schedule_hourly(self, mock_schedule):
         main.main(['schedule', '--hourly'])
         if IS_WINDOWS:
-            mock_schedule.assert_called_once_with(schedule=Settings.HOURLY, username=None, password=None)
+            mock_schedule.assert_called_once_with(schedule=Settings.HOURLY, username=None, password=None, tier=None)
         else:
-            mock_schedule.assert_called_once_with(schedule=Settings.HOURLY)
+            mock_schedule.assert_called_once_with(schedule=Settings.HOURLY, tier=None)
 
     @mock.patch('minarca_client.main._schedule')
     def test_args_schedule_weekly(self, mock_schedule):
         main.main(['schedule', '--weekly'])
         if IS_WINDOWS:
-            mock_schedule.assert_called_once_with(schedule=Settings.WEEKLY, username=None, password=None)
+            mock_schedule.assert_called_once_with(schedule=Settings.WEEKLY, username=None, password=None, tier=None)
         else:
-            mock_schedule.assert_called_once_with(schedule=Settings.WEEKLY)
+            mock_schedule.assert_called_once_with(schedule=Settings.WEEKLY, tier=None)
 
     @mock.patch('minarca_client.main._status')
     def test_args_status(self, mock_status):
@@ -250,11 +309,26 @@ class TestMainParseArgs(unittest.TestCase):
     @mock.patch('minarca_client.main._unlink')
     def test_args_unlink(self, mock_unlink):
         main.main(['unlink'])
-        mock_unlink.assert_called_once_with()
+        mock_unlink.assert_called_once_with(destination=None)
 
     @mock.patch('minarca_client.main.Backup')
     def test_backup(self, mock_backup):
+        mock_backup.return_value.get_settings.return_value = False
+        _backup(force=False)
+        mock_backup.return_value.backup.assert_called_once_with(force=False)
+
+    @mock.patch('minarca_client.main.LatestCheck')
+    @mock.patch('minarca_client.main.Backup')
+    def test_backup_latest_check_cached(self, mock_backup, mock_latest_check):
+        # Given a newer version available in cache
+        mock_backup.return_value.get_settings.return_value = False
+        mock_latest_check.return_value.is_latest.return_value = False
+        # When running the backup
         _backup(force=False)
+        # Then version is checked using cached value and refreshed in background.
+        mock_latest_check.return_value.refresh_async.assert_called_once_with()
+        mock_latest_check.return_value.is_latest.assert_called_once_with(cached=True)
+        mock_latest_check.return_value.get_latest_version.assert_not_called()
         mock_backup.return_value.backup.assert_called_once_with(force=False)
 
     @mock.patch('minarca_client.main.Backup')
@@ -262,6 +336,80 @@ class TestMainParseArgs(unittest.TestCase):
         _backup(force=True)
         mock_backup.return_value.backup.assert_called_once_with(force=True)
 
+    @mock.patch('minarca_client.main.LatestCheck')
+    @mock.patch('minarca_client.main.Backup')
+    def test_backup_not_scheduled(self, mock_backup, mock_latest_check):
+        # Given a backup not scheduled to run
+        mock_backup.return_value.get_settings.return_value = False
+        mock_backup.return_value.is_backup_time.return_value = False
+        # When running backup
+        # Then process exit with an error
+        with self.assertRaises(SystemExit) as capture:
+            _backup(force=False)
+        self.assertEqual(1, capture.exception.code)
+        # Then process exit without checking for latest version
+        mock_latest_check.assert_not_called()
+        mock_backup.return_value.backup.assert_not_called()
+
+    @mock.patch('minarca_client.core.agent.Agent.is_running', return_value=False)
+    @mock.patch('minarca_client.main.Backup')
+    def test_backup_with_agent(self, mock_backup, *unused):
+        # Given the agent is enabled but not running
+        mock_backup.return_value.get_settings.return_value = True
+        # When the scheduler execute the backup
+        _backup(force=False)
+        # Then the agent get started
+        mock_backup.return_value.start.assert_called_once_with(action='agent')
+        mock_backup.return_value.backup.assert_not_called()
+
+    @mock.patch('minarca_client.core.agent.Agent.is_running', return_value=True)
+    @mock.patch('minarca_client.main.Backup')
+    def test_backup_with_agent_running(self, mock_backup, *unused):
+        # Given the agent is enabled and running
+        mock_backup.return_value.get_settings.return_value = True
+        # When the scheduler execute the backup
+        _backup(force=False)
+        # Then nothing is done
+        mock_backup.return_value.start.assert_not_called()
+        mock_backup.return_value.backup.assert_not_called()
+
+    @mock.patch('minarca_client.main._agent')
+    def test_args_agent(self, mock_agent):
+        main.main(['agent'])
+        mock_agent.assert_called_once_with()
+
+    def test_import_lazy(self):
+        # When importing the command line interface
+        output = subprocess.check_output(
+            [
+                sys.executable,
+                '-c',
+                'import sys; import minarca_client.main; print(" ".join(sorted(sys.modules)))',
+            ],
+            text=True,
+        )
+        modules = output.split()
+        # Then graphical user interface, rdiff-backup and requests are not loaded
+        for name in ['tkinter', 'tkvue', 'rdiffbackup', 'requests', 'pkg_resources', 'minarca_client.ui']:
+            self.assertNotIn(name, modules)
+
+    @skipUnless(os.environ.get('MINARCA_BENCHMARK'), reason='benchmark disabled, define MINARCA_BENCHMARK=1')
+    def test_import_time(self):
+        # When importing the command line interface
+        output = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import minarca_client.main'],
+            stderr=subprocess.PIPE,
+            text=True,
+            check=True,
+        ).stderr
+        # Then cumulative import time is within budget
+        budget = int(os.environ.get('MINARCA_IMPORT_BUDGET', 250000))
+        cumulative = max(
+            int(line.split('|')[1]) for line in output.splitlines() if line.strip().endswith('minarca_client.main')
+        )
+        print('minarca_client.main imported in %dus' % cumulative)
+        self.assertLess(cumulative, budget)
+
     @mock.patch('rdiffbackup.run.main_run', return_value=0)
     def test_rdiff_backup(self, mock_main_run):
         # Given multiple arguments pass to rdiff-backup subcommand
@@ -286,7 +434,7 @@ class TestMainParseArgs(unittest.TestCase):
         p = Patterns('pattern.txt')
         mock_backup.return_value.get_patterns.return_value = p
         main.main(['exclude', '*.bak'])
-        mock_backup.return_value.set_patterns.assert_called_once_with(p)
+        mock_backup.return_value.set_patterns.assert_called_once_with(p, None)
         self.assertEqual([Pattern(False, '*.bak', None)], p)
 
     @mock.patch('minarca_client.main.Backup')
@@ -294,7 +442,7 @@ class TestMainParseArgs(unittest.TestCase):
         p = Patterns('pattern.txt')
         mock_backup.return_value.get_patterns.return_value = p
         main.main(['include', '*.bak'])
-        mock_backup.return_value.set_patterns.assert_called_once_with(p)
+        mock_backup.return_value.set_patterns.assert_called_once_with(p, None)
         self.assertEqual([Pattern(True, '*.bak', None)], p)
 
     def test_include_duplicate(self):
@@ -309,6 +457,22 @@ class TestMainParseArgs(unittest.TestCase):
             [Pattern(include=True, pattern='*.bak', comment=None)],
         )
 
+    def test_include_tier(self):
+        # When including a pattern into a tier
+        main.main(['include', '--tier', 'critical', '*.db'])
+        # Then the tier is created.
+        backup = Backup()
+        self.assertEqual([Tier('critical', Settings.DAILY)], backup.get_settings().tiers())
+        # Then pattern is added to the tier only.
+        self.assertEqual([Pattern(include=True, pattern='*.db', comment=None)], backup.get_patterns('critical'))
+        self.assertEqual([], backup.get_patterns())
+        # When defining the schedule of the tier
+        with mock.patch.object(Backup, 'schedule_job'):
+            main.main(['schedule', '--tier', 'critical', '--hourly'])
+        # Then the schedule is updated.
+        self.assertEqual([Tier('critical', Settings.HOURLY)], backup.get_settings().tiers())
+        self.assertEqual(Settings.DAILY, backup.get_settings('schedule'))
+
     def test_include_exclude(self):
         # When galling include multiple time with the same value
         # Not using real path for the test since those get resolve differently on Linux and windows.
@@ -327,7 +491,7 @@ class TestMainParseArgs(unittest.TestCase):
         p = Patterns('pattern.txt')
         mock_backup.return_value.get_patterns.return_value = p
         _pattern(True, ['.'])
-        mock_backup.return_value.set_patterns.assert_called_once_with(p)
+        mock_backup.return_value.set_patterns.assert_called_once_with(p, None)
         self.assertEqual([Pattern(True, os.getcwd(), None)], p)
 
     @mock.patch('minarca_client.main.Backup')
@@ -341,6 +505,31 @@ class TestMainParseArgs(unittest.TestCase):
             main.main(['patterns'])
         self.assertEqual("+/home\n-*.bak\n", f.getvalue())
 
+    @mock.patch('minarca_client.main.Backup')
+    def test_patterns_estimate(self, mock_backup):
+        p = Patterns('pattern.txt')
+        p.append(Pattern(True, '/home', None))
+        p.append(Pattern(False, '*.bak', None))
+        mock_backup.return_value.get_patterns.return_value = p
+        mock_backup.return_value.estimate_patterns.return_value = {p[0]: (12, 2048), p[1]: (1, 10)}
+        f = io.StringIO()
+        with contextlib.redirect_stdout(f):
+            main.main(['patterns', '--estimate'])
+        self.assertEqual("+/home\t+12 files, 2.0 KiB\n-*.bak\t-1 files, 10 B\n", f.getvalue())
+
+    @mock.patch('minarca_client.main.Backup')
+    def test_backup_dry_run(self, mock_backup):
+        mock_backup.return_value.dry_run.return_value = [
+            {'root': '/', 'new': 2, 'changed': 3, 'deleted': 1, 'bytes': 2048, 'eta': 90, 'snapshot': 'now'}
+        ]
+        f = io.StringIO()
+        with contextlib.redirect_stdout(f):
+            _backup(force=False, dry_run=True)
+        mock_backup.return_value.backup.assert_not_called()
+        self.assertIn('New files:            2', f.getvalue())
+        self.assertIn('Bytes to send:        2.0 KiB', f.getvalue())
+        self.assertIn('Estimated duration:   00:01:30', f.getvalue())
+
     @mock.patch('minarca_client.main.Backup')
     def test_pause(self, mock_backup):
         _pause(delay=123)
@@ -349,7 +538,9 @@ class TestMainParseArgs(unittest.TestCase):
     @mock.patch('minarca_client.main.Backup')
     def test_restore(self, mock_backup):
         _restore(restore_time='now', force=True, pattern=["./test"])
-        mock_backup.return_value.restore.assert_called_once_with(restore_time='now', patterns=[mock.ANY])
+        mock_backup.return_value.restore.assert_called_once_with(
+            restore_time='now', patterns=[mock.ANY], destination=None, rdiffweb=None, differential=False, verify=False
+        )
 
     @mock.patch('minarca_client.main.Backup')
     def test_start(self, mock_backup):
@@ -390,4 +581,4 @@ class TestMainParseArgs(unittest.TestCase):
     @mock.patch('minarca_client.main.Backup')
     def test_unlink(self, mock_backup):
         _unlink()
-        mock_backup.return_value.unlink.assert_called_once_with()
+        mock_backup.return_value.unlink.assert_called_once_with(None)
@@ -11,6 +11,7 @@ import pkg_resources
 from minarca_client.core import Backup
 from minarca_client.core.compat import get_home
 from minarca_client.core.config import Pattern
+from minarca_client.core.progress import format_size
 from minarca_client.locale import _
 from minarca_client.ui import tkvue
 
@@ -26,10 +27,44 @@ class PatternsView(tkvue.Component):
             {
                 'patterns': self.backup.get_patterns(),
                 'check_button_text': lambda item: ' ' + (_('Included') if item.include else _('Excluded')),
+                'estimates': {},
+                'estimating': False,
+                'estimate_text': self._estimate_text,
             }
         )
         super().__init__(*args, **kwargs)
 
+    def _estimate_text(self, item):
+        value = self.data['estimates'].get(item)
+        if value is None:
+            return ''
+        files, size = value
+        return ('+' if item.include else '-') + _('%s files, %s') % (files, format_size(size))
+
+    def estimate_patterns(self):
+        """
+        Called when user click to estimate the files selected by each pattern.
+        """
+        self.data.estimating = True
+        self.get_event_loop().create_task(self._estimate_patterns_task())
+
+    async def _estimate_patterns_task(self):
+        try:
+            estimates = await self.get_event_loop().run_in_executor(None, self.backup.estimate_patterns)
+            self.data.estimates = estimates
+            # Refresh the list to display the estimates.
+            self.data.patterns = self.backup.get_patterns()
+        except tkinter.TclError:
+            # Swallow exception raised when application get destroyed.
+            pass
+        except Exception:
+            logger.warning('fail to estimate patterns', exc_info=1)
+        finally:
+            try:
+                self.data.estimating = False
+            except tkinter.TclError:
+                pass
+
     def remove_pattern(self, item):
         """
         Remove the given pattern.
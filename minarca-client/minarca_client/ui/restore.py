@@ -5,6 +5,7 @@ import asyncio
 import logging
 import tkinter
 import tkinter.filedialog
+import tkinter.messagebox
 import tkinter.simpledialog
 import webbrowser
 
@@ -12,7 +13,7 @@ import pkg_resources
 
 from minarca_client.core import Backup
 from minarca_client.core.config import Pattern
-from minarca_client.core.exceptions import BackupError, RunningError
+from minarca_client.core.exceptions import BackupError
 from minarca_client.locale import _
 from minarca_client.ui import tkvue
 
@@ -30,6 +31,7 @@ class RestorePatternDialog(tkvue.Component):
                 'check_button_text': lambda item: _('Restore') if item.include else _('Ignore'),
             }
         )
+        self._backup_patterns = None
         super().__init__(*args, **kwargs)
         self.root.bind('<Return>', self.return_event)
         self.root.bind('<Key-Escape>', self.cancel_event)
@@ -91,16 +93,7 @@ class RestorePatternDialog(tkvue.Component):
 
     async def _fetch_patterns_task(self):
         backup = Backup()
-        # Keep copy of original patterns.
-        bak_patterns = None
-        orig_status = backup.get_status()
-        orig_patterns = backup.get_patterns()
-        try:
-            # First, we need to check if Minarca config could be restore from backup.
-            patterns = [Pattern(True, backup.patterns_file, None)]
-            await self.get_event_loop().run_in_executor(None, backup.restore, None, patterns)
-            bak_patterns = backup.get_patterns()
-        except RunningError:
+        if backup.is_running():
             tkinter.messagebox.showwarning(
                 parent=self.root,
                 icon='warning',
@@ -112,31 +105,57 @@ class RestorePatternDialog(tkvue.Component):
             )
             self.cancel_event()
             return
-        except BackupError:
-            # If not, let the user know previous config was not backup.
-            response = tkinter.messagebox.askyesno(
-                parent=self.root,
-                title=_('Minarca Configuration Retrieval'),
-                message=_("Could not retrieve Minarca Configuration. Do you want to continue?"),
-                detail=_(
-                    "Retrieval of Minarca configuration operation has encountered an error or has failed to locate the configuration file. Continuing without retrieving the Minarca configuration require you to manually verify the selected files otherwise it may result in potential data loss during the restore process."
-                ),
-            )
-            if not response:
-                # Operation cancel by user
-                self.cancel_event()
-                return
-        finally:
-            # Restore original patterns and status.
-            orig_patterns.save()
-            orig_status.save()
+        # The patterns are downloaded once for the lifetime of the dialog.
+        if self._backup_patterns is None:
+            # First, we need to check if Minarca config could be retrieved from backup.
+            self._backup_patterns = await self._download_patterns(backup)
+            if not self._backup_patterns:
+                # If not, let the user know previous config was not backup.
+                response = tkinter.messagebox.askyesno(
+                    parent=self.root,
+                    title=_('Minarca Configuration Retrieval'),
+                    message=_("Could not retrieve Minarca Configuration. Do you want to continue?"),
+                    detail=_(
+                        "Retrieval of Minarca configuration operation has encountered an error or has failed to locate the configuration file. Continuing without retrieving the Minarca configuration require you to manually verify the selected files otherwise it may result in potential data loss during the restore process."
+                    ),
+                )
+                if not response:
+                    # Operation cancel by user
+                    self.cancel_event()
+                    return
 
         # If original patterns could be restore. Use it.
-        patterns = bak_patterns or orig_patterns
+        patterns = self._backup_patterns or backup.get_patterns()
 
         # Keep only include pattern as we cant restore excluded files.
         self.data.patterns = [p for p in patterns if p.include and not p.is_wildcard()]
 
+    async def _download_patterns(self, backup):
+        """
+        Return the patterns downloaded from the server or an empty list. The
+        patterns are restored with the SSH identity first, the user is only
+        asked for a password when it fails.
+        """
+        loop = self.get_event_loop()
+        try:
+            return await loop.run_in_executor(None, backup.fetch_patterns)
+        except BackupError:
+            logger.info('fail to restore patterns with identity, fallback to http', exc_info=1)
+        password = tkinter.simpledialog.askstring(
+            parent=self.root,
+            title=_('Minarca Configuration Retrieval'),
+            prompt=_('Enter your password or access token to retrieve Minarca configuration:'),
+            show='*',
+        )
+        if not password:
+            return []
+        try:
+            rdiffweb = await loop.run_in_executor(None, backup.get_rdiffweb, password)
+            return await loop.run_in_executor(None, backup.fetch_patterns, rdiffweb)
+        except BackupError:
+            logger.info('fail to retrieve patterns from backup', exc_info=1)
+            return []
+
 
 class RestoreView(tkvue.Component):
     template = pkg_resources.resource_string('minarca_client.ui', 'templates/restore.html').decode("utf-8")
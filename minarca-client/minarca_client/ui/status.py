@@ -11,6 +11,7 @@ import webbrowser
 import pkg_resources
 
 from minarca_client.core import Backup
+from minarca_client.core.progress import format_progress
 from minarca_client.locale import _
 from minarca_client.ui import tkvue
 
@@ -22,19 +23,22 @@ class StatusView(tkvue.Component):
 
     def __init__(self, *args, **kwargs):
         self.backup = Backup()
+        status = self.backup.get_status()
+        settings = self.backup.get_settings()
         self.data = tkvue.Context(
             {
                 # Status
-                'action': self.backup.get_status('action'),
-                'lastresult': self.backup.get_status('lastresult'),
-                'lastdate': self.backup.get_status('lastdate'),
-                'details': self.backup.get_status('details'),
+                'action': status['action'],
+                'lastresult': status['lastresult'],
+                'lastdate': status['lastdate'],
+                'details': status['details'],
+                'progress': self._progress_text(status),
                 # settings
-                'remoteurl': self.backup.get_settings('remoteurl'),
-                'username': self.backup.get_settings('username'),
-                'remotehost': self.backup.get_settings('remotehost'),
-                'repositoryname': self.backup.get_settings('repositoryname'),
-                'pause_until': self.backup.get_settings('pause_until'),
+                'remoteurl': settings['remoteurl'],
+                'username': settings['username'],
+                'remotehost': settings['remotehost'],
+                'repositoryname': settings['repositoryname'],
+                'pause_until': settings['pause_until'],
                 # Computed variables
                 'header_text': self.header_text,
                 'status_text': self.status_text,
@@ -106,7 +110,7 @@ class StatusView(tkvue.Component):
         text_table = {
             'SUCCESS': _('Completed successfully on %s.') % context.lastdate,
             'FAILURE': _('Failed on %s\n%s') % (context.lastdate, context.details),
-            'RUNNING': _('Running in background and using system resources.'),
+            'RUNNING': (context.progress or _('Running in background and using system resources.')),
             'STALE': _('Started in background on %s, but is currently stale an may use system resources.')
             % context.lastdate,
             'INTERRUPT': _('Interrupted on %s. May be caused by computer standby or manual interruption.')
@@ -141,16 +145,12 @@ class StatusView(tkvue.Component):
         """
         Used to watch the status file and trigger an update whenever the status changes.
         """
-        last_status = None
         last_pause_until = None
+        unsubscribe = self.backup.status_store.subscribe(self._status_changed)
         try:
             while self.root.winfo_exists():
-                status = self.backup.get_status()
-                if last_status != status:
-                    self.data['action'] = status['action']
-                    self.data['lastresult'] = status['lastresult']
-                    self.data['lastdate'] = status['lastdate']
-                    self.data['details'] = status['details']
+                # Status file is only parsed when modified.
+                self.backup.status_store.poll()
                 pause_until = self.backup.get_settings('pause_until')
                 if last_pause_until != pause_until:
                     self.data['pause_until'] = last_pause_until = pause_until
@@ -159,6 +159,27 @@ class StatusView(tkvue.Component):
         except tkinter.TclError:
             # Swallow exception raised when application get destroyed.
             pass
+        finally:
+            unsubscribe()
+
+    def _status_changed(self, status):
+        self.data['action'] = status['action']
+        self.data['lastresult'] = status['lastresult']
+        self.data['lastdate'] = status['lastdate']
+        self.data['details'] = status['details']
+        self.data['progress'] = self._progress_text(status)
+
+    def _progress_text(self, status):
+        """
+        Return a description of the progress of the running sessions.
+        """
+        if status['lastresult'] != 'RUNNING':
+            return ''
+        return '\n'.join(
+            format_progress(status.progress(name))
+            for name, lastresult, unused in status.sessions()
+            if lastresult == 'RUNNING' and status.progress(name)
+        )
 
     def start_backup(self):
         try: